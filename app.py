@@ -0,0 +1,197 @@
+import argparse
+import io
+import shutil
+import tempfile
+from pathlib import Path
+
+import gradio as gr
+from rich.console import Console
+
+from config.definitions import ROOT_DIR
+from main import agenerate_handout, reset_pipeline, show_pipeline_status
+from src.call_policy import CallPolicy
+from src.client_pool import aclose
+from src.job_queue import JobQueue, JobWorkers
+from src.pipeline_manager import PipelineManager
+
+JOBS_DB = Path(ROOT_DIR) / "data/jobs.sqlite"
+UPLOADS_DIR = Path(ROOT_DIR) / "data/uploads"
+
+queue = JobQueue(JOBS_DB)
+# One policy for every job: retries back off together and the hedging thresholds are learned from all the lessons
+call_policy = CallPolicy()
+
+
+def output_folder(module_num):
+    return Path(ROOT_DIR) / f"data/output/module {module_num:03}"
+
+
+def uploads_folder(module_num):
+    return UPLOADS_DIR / f"module {module_num:03}"
+
+
+def save_uploads(module_num, lesson_num, files, topics):
+    """Copy uploaded materials in a new folder of the lesson and return it"""
+    uploads_folder(module_num).mkdir(parents=True, exist_ok=True)
+    # A new folder per submission: a job already queued or running keeps reading its own copy
+    folder = Path(tempfile.mkdtemp(prefix=f"Lez {lesson_num:03} materials ", dir=uploads_folder(module_num)))
+    for file in files:
+        shutil.copy(file, folder / Path(file).name)
+    (folder / "topics.txt").write_text(topics.strip() + "\n")
+    return folder
+
+
+async def run_job(job):
+    options = dict(job["options"])
+    if options.get("input_folder"):
+        options["input_folder"] = Path(options["input_folder"])
+    await agenerate_handout(job["lesson_num"], job["module_num"], output_folder=output_folder(job["module_num"]),
+                            live_output=False, call_policy=call_policy, **options)
+
+
+def submit(module_num, lesson_num, files, topics, resume, parallel_sections, user):
+    if module_num is None or lesson_num is None:
+        return "Choose the module and the lesson."
+    module_num, lesson_num = int(module_num), int(lesson_num)
+    if files and not topics.strip():
+        return "Uploaded materials need the lesson topics (one per line)."
+    # The uploads are copied before queueing, so that the queue is only locked for the insert of the job
+    folder = save_uploads(module_num, lesson_num, files, topics) if files else None
+    options = {"input_folder": str(folder)} if folder else {}
+    job, created = queue.submit(module_num, lesson_num, submitted_by=user or None, resume=resume,
+                                parallel_sections=parallel_sections, **options)
+    if not created:
+        if folder:
+            shutil.rmtree(folder)
+        return f"Module {module_num}, lesson {lesson_num} is already {job['status']} as job {job['id']}."
+    if folder:
+        # The earlier jobs of the lesson are over (it has a single active job): their uploads are no longer read
+        for previous in uploads_folder(module_num).glob(f"Lez {lesson_num:03} materials *"):
+            if previous != folder:
+                shutil.rmtree(previous, ignore_errors=True)
+    return f"Queued job {job['id']} for module {module_num}, lesson {lesson_num}."
+
+
+def jobs_table():
+    rows = []
+    for job in queue.jobs():
+        error = (job["error"] or "").strip().splitlines()
+        rows.append([job["id"], job["module_num"], job["lesson_num"], job["status"], job["submitted_by"] or "",
+                     error[-1] if error else ""])
+    return rows
+
+
+def lesson_progress(module_num, lesson_num):
+    """Stage checklist and the handout (or the text being generated) of a lesson"""
+    if module_num is None or lesson_num is None:
+        return "", ""
+    pipeline = PipelineManager(int(lesson_num), int(module_num), output_folder(int(module_num)), read_only=True)
+    running = pipeline.state.get("running_fingerprints", {})
+    lines = []
+    for stage in PipelineManager.STAGES:
+        if stage in running:
+            mark = "⏳"
+        elif pipeline.is_stage_completed(stage):
+            mark = "✓"
+        else:
+            mark = "○"
+        duration = pipeline.get_stage_metadata(stage).get("duration_s")
+        lines.append(f"- {mark} {stage}" + (f" ({duration:.1f}s)" if duration is not None and mark == "✓" else ""))
+
+    text = ""
+    for stage in reversed(PipelineManager.STAGES):
+        if stage in running:
+            text = pipeline.get_partial_output(stage) or ""
+            break
+        if pipeline.is_stage_completed(stage) and stage in ("final_handout", "handout_draft"):
+            text = pipeline.get_stage_output(stage) or ""
+            break
+    return "\n".join(lines), text
+
+
+def status_text(module_num, lesson_num):
+    console = Console(record=True, width=120, file=io.StringIO())
+    show_pipeline_status(int(lesson_num), int(module_num), output_folder(int(module_num)), console=console)
+    return console.export_text()
+
+
+def reset(module_num, lesson_num, from_stage):
+    module_num, lesson_num = int(module_num), int(lesson_num)
+    if queue.is_active(module_num, lesson_num):
+        return "The lesson has a queued or running job; wait for it to finish before resetting it."
+    reset_pipeline(lesson_num, module_num, None if from_stage == "all" else from_stage, output_folder(module_num))
+    return f"Module {module_num}, lesson {lesson_num} reset" + ("" if from_stage == "all" else f" from {from_stage}")
+
+
+def cancel(job_id):
+    return f"Job {int(job_id)} cancelled." if queue.cancel(int(job_id)) else "Only queued jobs can be cancelled."
+
+
+def build_app():
+    with gr.Blocks(title="Class notes distiller") as app:
+        gr.Markdown("# Class notes distiller")
+        with gr.Tab("Submit"):
+            with gr.Row():
+                module_num = gr.Number(label="Module", value=7, precision=0)
+                lesson_num = gr.Number(label="Lesson", value=1, precision=0)
+                user = gr.Textbox(label="Your name")
+            files = gr.File(label="Materials (optional, otherwise data/input is used)", file_count="multiple",
+                            file_types=[".pdf"], type="filepath")
+            topics = gr.Textbox(label="Lesson topics, one per line (needed with uploaded materials)", lines=4)
+            with gr.Row():
+                resume = gr.Checkbox(label="Resume from the last checkpoint", value=True)
+                parallel_sections = gr.Checkbox(label="Write the handout section by section", value=False)
+            submit_button = gr.Button("Generate handout", variant="primary")
+            submit_message = gr.Markdown()
+            submit_button.click(submit, [module_num, lesson_num, files, topics, resume, parallel_sections, user],
+                                submit_message)
+
+        with gr.Tab("Jobs"):
+            jobs = gr.Dataframe(headers=["Job", "Module", "Lesson", "Status", "Submitted by", "Error"],
+                                value=jobs_table)
+            with gr.Row():
+                job_id = gr.Number(label="Job", precision=0)
+                cancel_button = gr.Button("Cancel queued job")
+            cancel_message = gr.Markdown()
+            cancel_button.click(cancel, job_id, cancel_message)
+
+        with gr.Tab("Lesson"):
+            with gr.Row():
+                view_module = gr.Number(label="Module", value=7, precision=0)
+                view_lesson = gr.Number(label="Lesson", value=1, precision=0)
+            stages = gr.Markdown()
+            handout = gr.Markdown()
+            with gr.Row():
+                status_button = gr.Button("Pipeline status")
+                from_stage = gr.Dropdown(["all"] + PipelineManager.STAGES, value="all", label="Reset from stage")
+                reset_button = gr.Button("Reset pipeline", variant="stop")
+            status = gr.Textbox(label="Status", lines=12)
+            status_button.click(status_text, [view_module, view_lesson], status)
+            reset_button.click(reset, [view_module, view_lesson, from_stage], status)
+
+        # Live updates: the job list and the progress of the selected lesson are polled from the queue and the
+        # pipeline state files, which the workers update as they go
+        timer = gr.Timer(1.0)
+        timer.tick(jobs_table, None, jobs)
+        timer.tick(lesson_progress, [view_module, view_lesson], [stages, handout])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web app queueing handout generation jobs")
+    parser.add_argument("--workers", type=int, default=2, help="Lessons generated at the same time")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    args = parser.parse_args()
+
+    # Jobs interrupted by a restart are requeued and resume from their checkpoints. The SDK clients the jobs opened
+    # on the loop of the workers are closed there when the app stops
+    workers = JobWorkers(queue, run_job, workers=args.workers, on_stop=aclose).start()
+    try:
+        build_app().queue().launch(server_name=args.host, server_port=args.port)
+    finally:
+        workers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.mock_llm_server import MockLLMServer, MockProfile
+
+
+def make_pdf(pages):
+    """Minimal pdf with one line of text per page"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 12 Tf 20 700 Td ({text}) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode()
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer << /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF" % (len(objects) + 1, xref)
+    return data
+
+
+def create_lessons(root, num_lessons, pdfs_per_lesson, pdf_kb, shared_pdfs=0):
+    """
+    Synthetic module with num_lessons lessons, the first shared_pdfs pdfs of each lesson being the same in every lesson;
+    returns the (module_num, lesson_num) pairs
+    """
+    module_folder = root / "input/module 001"
+    module_folder.mkdir(parents=True)
+    with open(module_folder / "module_topics.md", "w") as f:
+        f.write("Benchmark module\n")
+        for lesson_num in range(1, num_lessons + 1):
+            f.write(f"Lezione {lesson_num}: Lesson {lesson_num}\nTopic A\nTopic B\n")
+    for lesson_num in range(1, num_lessons + 1):
+        folder = module_folder / f"Lez {lesson_num:03} materials"
+        folder.mkdir()
+        (folder / "topics.txt").write_text("Topic A\nTopic B\n")
+        for i in range(pdfs_per_lesson):
+            owner = "Module" if i < shared_pdfs else f"Lesson {lesson_num}"
+            pages = [f"{owner} document {i} page {page} topic A topic B " + "filler " * 40
+                     for page in range(max(1, pdf_kb // 2))]
+            (folder / f"slides_{i}.pdf").write_bytes(make_pdf(pages))
+    return [(1, lesson_num) for lesson_num in range(1, num_lessons + 1)]
+
+
+async def run_batch(main, root, lessons, workers, prefetch=False, **kwargs):
+    """Run the lessons concurrently, returning the latency of each"""
+    semaphore = asyncio.Semaphore(workers)
+    latencies = {}
+    prefetchers = {}
+    if prefetch:
+        for module_num in sorted({module_num for module_num, _ in lessons}):
+            prefetcher = main.ModulePrefetcher(root / f"input/module {module_num:03}")
+            prefetchers[module_num] = await asyncio.to_thread(prefetcher.scan)
+            prefetcher.start([lesson_num for other, lesson_num in lessons if other == module_num])
+
+    async def run_lesson(module_num, lesson_num):
+        async with semaphore:
+            start = time.perf_counter()
+            await main.agenerate_handout(lesson_num, module_num, live_output=False,
+                                         input_folder=root / f"input/module {module_num:03}/Lez {lesson_num:03} materials",
+                                         output_folder=root / f"output/module {module_num:03}",
+                                         prefetcher=prefetchers.get(module_num), lesson_slot=semaphore, **kwargs)
+            latencies[(module_num, lesson_num)] = time.perf_counter() - start
+
+    try:
+        await asyncio.gather(*(run_lesson(*lesson) for lesson in lessons))
+    finally:
+        for prefetcher in prefetchers.values():
+            await prefetcher.aclose()
+    return latencies
+
+
+def report(name, latencies, elapsed, server_stats, traces, material_files):
+    values = np.array(list(latencies.values()))
+    calls = [record for trace in traces for record in trace]
+    hits = sum(1 for record in calls if record.get("response_cache_hit"))
+    uploads = server_stats.get("gemini.uploads", 0)
+    upload_time = server_stats.get("gemini.upload_seconds", 0.0)
+    print(f"\n## {name}")
+    print(f"  lessons: {len(values)} in {elapsed:.2f}s ({len(values) / elapsed * 60:.1f} lessons/min)")
+    print(f"  lesson latency: p50 {np.percentile(values, 50):.2f}s, p95 {np.percentile(values, 95):.2f}s, "
+          f"p99 {np.percentile(values, 99):.2f}s")
+    print(f"  uploads: {uploads} of {material_files} files ({1 - uploads / material_files:.0%} file cache hits), "
+          f"{upload_time:.2f}s server-side")
+    print(f"  context caches created: {server_stats.get('gemini.cache_creates', 0)}")
+    print(f"  agent calls: {len(calls)} ({hits / max(1, len(calls)):.0%} response cache hits), "
+          f"{sum(record.get('retries') or 0 for record in calls)} retries, "
+          f"{sum(1 for record in calls if record.get('error'))} failed")
+    batched = [record for record in calls if record.get("batched") and not record.get("response_cache_hit")]
+    if batched:
+        print(f"  batched calls: {len(batched)} in {server_stats.get('openai.batches', 0)} OpenAI and "
+              f"{server_stats.get('gemini.batches', 0)} Gemini jobs")
+    errors = {key: value for key, value in server_stats.items() if key.endswith((".429", ".500")) and value}
+    if errors:
+        print(f"  injected errors: {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the handout pipeline against local mock LLM servers")
+    parser.add_argument("--lessons", type=int, default=8, help="Number of lessons in the batch")
+    parser.add_argument("--workers", type=int, default=4, help="Lessons processed at the same time")
+    parser.add_argument("--pdfs", type=int, default=3, help="pdf materials per lesson")
+    parser.add_argument("--pdf-kb", type=int, default=20, help="Approximate size of each pdf")
+    parser.add_argument("--latency", type=float, default=0.2, help="Median time to first token (s)")
+    parser.add_argument("--latency-p95", type=float, default=0.6, help="p95 time to first token (s)")
+    parser.add_argument("--tps", type=float, default=2000.0, help="Output tokens per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a 500 reply")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Probability of a 429 reply")
+    parser.add_argument("--upload-s-per-mb", type=float, default=0.5, help="Upload time per MB (s)")
+    parser.add_argument("--response-words", type=int, default=400, help="Length of the canned replies")
+    parser.add_argument("--parallel-sections", action="store_true", help="Write the handout drafts section by section")
+    parser.add_argument("--route-models", action="store_true", help="Route the stages with the default model routes")
+    parser.add_argument("--prefetch", action="store_true", help="Scan and upload the module materials up front")
+    parser.add_argument("--shared-pdfs", type=int, default=0, help="pdfs of each lesson identical in every lesson")
+    parser.add_argument("--batch-api", action="store_true", help="Send the reviews and editing through batch jobs")
+    parser.add_argument("--batch-seconds", type=float, default=2.0, help="Time the mock batch jobs take (s)")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline output")
+    args = parser.parse_args()
+
+    profile = MockProfile(latency_median=args.latency, latency_p95=args.latency_p95, tokens_per_second=args.tps,
+                          error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                          upload_seconds_per_mb=args.upload_s_per_mb, response_words=args.response_words,
+                          batch_seconds=args.batch_seconds)
+    with tempfile.TemporaryDirectory(prefix="cnd-bench-") as tmp, MockLLMServer(profile) as server:
+        root = Path(tmp)
+        # Point the SDKs to the mock server and keep the caches out of data/cache. Set before importing the
+        # pipeline, since the cache location is read at import time
+        os.environ.update(server.env())
+        os.environ["CLASS_NOTES_CACHE_DIR"] = str(root / "cache")
+        import main as pipeline
+        from src.batch_jobs import BatchCollector
+        from src.call_policy import CallPolicy
+        from src.model_router import DEFAULT_ROUTES, ModelRouter
+        from src.pipeline_manager import PipelineManager
+        from src.telemetry import read_trace
+
+        lessons = create_lessons(root, args.lessons, args.pdfs, args.pdf_kb, args.shared_pdfs)
+        material_files = args.lessons * args.pdfs
+        print(f"Mock server at {server.url}; {args.lessons} lessons, {args.workers} workers, profile: {profile}")
+
+        call_policy = CallPolicy(base_delay=0.05, max_delay=1.0)
+        model_router = ModelRouter(DEFAULT_ROUTES) if args.route_models else None
+        batch_collector = BatchCollector(max_wait=0.5, poll_interval=0.2) if args.batch_api else None
+        # Cold: empty caches. Warm: the same lessons from scratch, with files, contexts and replies cached
+        for name in ("cold", "warm"):
+            before = server.stats
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            start = time.perf_counter()
+            with output:
+                latencies = asyncio.run(pipeline.closing_clients(run_batch(
+                    pipeline, root, lessons, args.workers, prefetch=args.prefetch, resume=False, cache_responses=True,
+                    call_policy=call_policy, parallel_sections=args.parallel_sections, model_router=model_router,
+                    batch_collector=batch_collector)))
+            elapsed = time.perf_counter() - start
+            stats = {key: value - before.get(key, 0) for key, value in server.stats.items()}
+            traces = []
+            for module_num, lesson_num in lessons:
+                pipeline_state = PipelineManager(lesson_num, module_num, root / f"output/module {module_num:03}")
+                traces.append(read_trace(pipeline_state.trace_file))
+                pipeline_state.trace_file.unlink(missing_ok=True)
+            report(name, latencies, elapsed, stats, traces, material_files)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+import argparse
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SDK_MODULES = ("openai", "anthropic", "google.genai")
+# Modules the pipeline commands (run, batch) import before their first call: measured without running the pipeline
+PIPELINE_IMPORTS = "import main, src.agents, src.client_pool, src.materials_index"
+
+
+def measure(arguments, repeats):
+    """Wall times of repeats runs of a python command, and the SDKs it imported"""
+    times = []
+    imported = set()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", *arguments], capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(arguments)} failed:\n{result.stderr[-2000:]}")
+        modules = re.findall(r"^import time:\s+\d+ \|\s+\d+ \|\s*(\S+)$", result.stderr, re.MULTILINE)
+        imported.update(module for module in modules if module in SDK_MODULES)
+    return np.array(times), sorted(imported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the start-up time of each CLI command")
+    parser.add_argument("--repeats", type=int, default=5, help="Runs of each command")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="cnd-startup-") as tmp:
+        cli = ["-m", "src.cli"]
+        commands = {
+            "--help": (cli + ["--help"], False),
+            "status": (cli + ["status", "1", "1", "--output-folder", tmp], False),
+            "reset": (cli + ["reset", "1", "1", "--output-folder", tmp], False),
+            "prompts": (cli + ["prompts"], False),
+            "lessons": (cli + ["lessons", "--state-db", f"{tmp}/state.sqlite", "--module", "1"], False),
+            "run, batch, clear-cache (imports)": (["-c", PIPELINE_IMPORTS], True),
+        }
+        regressions = []
+        print(f"{'command':<36} {'p50':>7} {'max':>7}  SDKs imported")
+        for name, (arguments, loads_sdks) in commands.items():
+            times, sdks = measure(arguments, args.repeats)
+            print(f"{name:<36} {np.percentile(times, 50):>6.2f}s {times.max():>6.2f}s  {', '.join(sdks) or '-'}")
+            if sdks and not loads_sdks:
+                regressions.append(name)
+    if regressions:
+        print(f"\nRead-only commands importing an LLM SDK: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,11 @@ except NameError:
     # Fallback for environments where __file__ is not defined (e.g., interactive sessions)
     ROOT_DIR = str(Path.cwd())
 
+# Local caches (uploaded files, LLM responses, materials index). CLASS_NOTES_CACHE_DIR moves them (e.g. for benchmarks)
+CACHE_DIR = os.getenv("CLASS_NOTES_CACHE_DIR") or str(Path(ROOT_DIR) / "data/cache")
+# SQLite database holding the pipeline states of every lesson. If unset, each lesson keeps its own JSON state file
+STATE_DB = os.getenv("CLASS_NOTES_STATE_DB")
+
 openai_api_key = None
 anthropic_api_key = None
 google_api_key = None
@@ -1,61 +1,105 @@
+import asyncio
 import os
 import sys
+from contextlib import nullcontext
 from pathlib import  Path
-from config.definitions import ROOT_DIR, load_api_keys
-from main_bkp import input_folder
-from src.agents import OpenAIAgent, GeminiAgent
+from config.definitions import ROOT_DIR, CACHE_DIR, load_api_keys
+from src.call_policy import CallPolicy
+from src.file_cache import file_sha256
+from src.handout_patch import PatchError, apply_patch, parse_patch
+from src.handout_sections import split_sections, renumber_figures
+from src.history_manager import HistoryManager
+from src.model_router import ModelOption, ModelRouter, StageRoute
+from src.module_materials import ModulePrefetcher, extract_module_structure, extract_topics, load_materials_paths
 from src.pipeline_manager import PipelineManager
+from src.prompt_registry import get_prompt_registry, estimate_tokens
+from src.response_cache import ResponseCache
+from src.review_report import ReviewReport, issue_counts, parse_report, render_report, revision_plan
+from src.scheduler import Stage, StageScheduler
+from src.telemetry import Telemetry, read_trace, summarize_trace
 from time import time
 from rich.markdown import Markdown
 from rich.console import Console
+from rich.live import Live
 
 
-def load_materials_paths(input_folder):
-    all_materials = [Path(os.path.join(input_folder, file)) for file in os.listdir(input_folder)]
-    for material in all_materials:
-        if material.suffix == ".txt":
-            topics = material
-            all_materials.remove(material)
-    return all_materials, topics
+def save_output(path, text):
+    with open(path, "w") as f:
+        f.write(text)
 
-def extract_topics(topics_file_path):
-    topics = []
-    with open(topics_file_path, "r") as file:
-        for line in file:
-            topics.append(line.strip())
-    return topics
+async def stream_stage(pipeline, stage, agent, prompt, console, live_output=True):
+    """
+    Generate a long stage output with a streaming call, checkpointing every chunk to the stage partial file.
 
-def extract_module_structure(module_file_path):
-    module_structure = {}
-    with open(module_file_path, "r") as file:
-        # get title
-        module_structure["title"] = file.readline().strip()
-        for line in file:
-            if line.strip() == "":
-                continue
-            if "lezione" in line.lower():
-                # Extract lesson number and title
-                parts = line.split(":")
-                lesson_num = parts[0].lower().replace("Lezione", "").strip()
-                module_structure[str(lesson_num)] = {"title": parts[1].strip(), "topics": []}
-            else:
-                module_structure[str(lesson_num)]["topics"].append(line.strip())
-    return module_structure
+    If a previous generation of the stage was interrupted, the agent is asked to continue it instead of restarting.
+    The partial file is discarded when the output is saved with pipeline.save_stage_output.
+    """
+    partial = pipeline.start_partial(stage)
+    if partial:
+        console.print(f"Continuing interrupted '{stage}' generation ({len(partial)} characters already written)")
+    text = partial
+    with Live(Markdown(text), console=console, refresh_per_second=4, vertical_overflow="visible") if live_output \
+            else nullcontext() as display:
+        async for chunk in agent.achat_stream(prompt, partial=partial):
+            pipeline.append_partial(stage, chunk)
+            text += chunk
+            if display is not None:
+                display.update(Markdown(text))
+    return text
 
-def load_prompt(prompt_path, **kwargs):
-    with open(prompt_path, "r") as f:
-        prompt = f.read()
-    prompt = prompt.format(**kwargs)
-    return prompt
+async def write_handout_by_sections(agent, summary, lesson_num, language, console, max_concurrency=4, min_chars=15000):
+    """
+    Write the handout one summary section at a time, with concurrent stateless calls, and stitch the sections together.
 
-def save_output(path, text):
-    with open(path, "w") as f:
-        f.write(text)
+    The title and the lesson goals are written by a short call running alongside the sections, figures are renumbered
+    locally, and every section is told its neighbours so that it can handle the transitions. Returns None when the
+    summary has less than two sections.
+    """
+    prompts = get_prompt_registry()
+    _, sections = split_sections(summary)
+    if not sections:
+        return None
+    titles = [title for title, _ in sections]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def write_section(i):
+        title, section = sections[i]
+        section_prompt = prompts.render("notes_section.teacher", lesson_num=lesson_num, summary=summary, section=section,
+                                        language=language, min_chars=max(1500, min_chars // len(sections)),
+                                        previous_title=titles[i - 1] if i > 0 else "(beginning of the lesson)",
+                                        next_title=titles[i + 1] if i + 1 < len(titles) else "(end of the lesson)")
+        async with semaphore:
+            text = await agent.achat(section_prompt, stateless=True)
+        console.print(f"✓ Section {i + 1}/{len(sections)} written: {title}")
+        return text
+
+    stitch_prompt = prompts.render("notes_stitch.teacher", lesson_num=lesson_num, summary=summary, language=language,
+                                   section_titles="\n".join(f"* {title}" for title in titles))
+    opening, *texts = await asyncio.gather(agent.achat(stitch_prompt, stateless=True),
+                                           *(write_section(i) for i in range(len(sections))))
+    return "\n\n".join([opening.strip()] + [text.strip() for text in renumber_figures(texts)]) + "\n"
+
+async def closing_clients(coroutine):
+    """Await a coroutine, then close the SDK clients it opened on the event loop (see src/client_pool.py)"""
+    from src.client_pool import aclose
+
+    try:
+        return await coroutine
+    finally:
+        await aclose()
+
+def generate_handout(lesson_num, module_num, **kwargs):
+    """Generate handout with checkpoint/resume capability (blocking wrapper around agenerate_handout)"""
+    asyncio.run(closing_clients(agenerate_handout(lesson_num, module_num, **kwargs)))
 
-def generate_handout(lesson_num, module_num, resume=True, override_files=None, input_folder=None, output_folder=None,
-                     manage_history=True):
+async def agenerate_handout(lesson_num, module_num, resume=True, override_files=None, input_folder=None,
+                            output_folder=None, manage_history=True, cache_responses=False, live_output=True,
+                            context_cache=True, parallel_sections=False, section_workers=4,
+                            passages_per_section=3, call_policy=None, wandb_project=None, model_router=None,
+                            batch_collector=None, patch_edits=True, structured_reviews=True, prefetcher=None,
+                            history_budget=32_000, lesson_slot=None):
     """
-    Generate handout with checkpoint/resume capability
+    Generate handout with checkpoint/resume capability, awaiting each stage on the agents' async clients
     
     Args:
         lesson_num: Lesson number
@@ -63,7 +107,38 @@ def generate_handout(lesson_num, module_num, resume=True, override_files=None, i
         resume: If True, resume from last checkpoint. If False, start fresh.
         override_files: Dict mapping stage names to file paths for pre-existing files
                        Example: {"summary": "path/to/my_edited_summary.md"}
-        manage_history: If True, use google api automatic chat history. If False, history is handled manually.
+        manage_history: If True, the teacher keeps the chat history across stages.
+        cache_responses: If True, identical requests are answered from the on-disk response cache in data/cache/responses
+        live_output: If True, the long stages (handout draft and final handout) are rendered live while they stream
+        context_cache: If True, the materials and the teacher system prompt are cached once on Gemini's side and the
+                       teacher calls refer to the cached content instead of re-sending them
+        parallel_sections: If True, the handout draft is written one summary section at a time by concurrent calls
+                           and stitched together, instead of with a single long generation
+        section_workers: Maximum number of sections written at the same time
+        passages_per_section: Number of passages of the pdf materials, retrieved from a local index, that the reviewer
+                              and the editor receive for each section of the summary (0 to disable)
+        call_policy: CallPolicy with the timeouts, retries and hedging of the agents' calls (default: CallPolicy())
+        wandb_project: If set, the telemetry of every agent call is also logged to a wandb run in this project. It is
+                       always appended to the lesson trace file, with the run id of the pipeline (see
+                       show_pipeline_status)
+        model_router: ModelRouter choosing the provider and model of each stage (see src/model_router.py). By default
+                      the teacher runs on gemini-2.5-flash and the reviewer and the editor on gpt-4o-mini
+        batch_collector: If set, a BatchCollector sending the review and editing requests through provider batch jobs,
+                         shared with the other lessons being generated (see agenerate_handouts). The jobs are recorded
+                         in the stage metadata, so that an interrupted run waits for them instead of resubmitting
+        patch_edits: If True, the final stage asks the teacher for the editor's corrections as edits, applied locally
+                     to the handout draft, and only rewrites the whole handout when the edits do not apply
+        structured_reviews: If True, the reviewer and the editor report their issues by severity in the structured
+                            output mode of their provider. The following teacher revision is then skipped when they
+                            found no issues, and reduced to edits of the draft when they only found minor ones
+        prefetcher: ModulePrefetcher of the lesson's module (see agenerate_handouts). The lesson then uses its scan of
+                    the materials and of the module structure, and waits for its background uploads
+        history_budget: Estimated tokens of teacher chat history sent with each request. The exchanges of a stage are
+                        replaced by a short note once a later stage supersedes their output (e.g. the first draft once
+                        the revised summary exists), and the oldest ones when the history exceeds the budget.
+                        None only drops the superseded exchanges
+        lesson_slot: Semaphore held by the lesson while it runs (see agenerate_handouts). It is given back while a
+                     request waits for its batch job, and taken again once the reply is there
     """
     if not input_folder:
         input_folder = Path(ROOT_DIR) / f"data/input/module {module_num:03}/Lez {lesson_num:03} materials"
@@ -72,13 +147,25 @@ def generate_handout(lesson_num, module_num, resume=True, override_files=None, i
     stateless = ".sl"
     if manage_history and not resume:
         stateless = ""
+    # The provider SDKs take seconds to import: only the commands that build agents load them
+    from src.agents import AnthropicAgent, OpenAIAgent, GeminiAgent
+    from src.materials_index import MaterialsIndex
+
     api_keys = load_api_keys()
     console = Console()
+    response_cache = ResponseCache(Path(CACHE_DIR) / "responses") if cache_responses else None
+    call_policy = call_policy or CallPolicy()
 
     console.print(Markdown("# Hello from class-notes-distiller!"))
 
     # Initialize pipeline manager
     pipeline = PipelineManager(lesson_num, module_num, output_folder)
+    wandb_run = None
+    if wandb_project:
+        import wandb
+        wandb_run = wandb.init(project=wandb_project, name=f"m{module_num:03}_l{lesson_num:03}", reinit="create_new",
+                               config={"module": module_num, "lesson": lesson_num, "resume": resume})
+    telemetry = Telemetry(pipeline.trace_file, wandb_run, module=module_num, lesson=lesson_num, run_id=pipeline.run_id)
     
     # Clear pipeline if not resuming
     if not resume:
@@ -98,151 +185,499 @@ def generate_handout(lesson_num, module_num, resume=True, override_files=None, i
     # General variables
     subject = "Computer Vision"
     language = "Italian"
+    prompts = get_prompt_registry()
 
     # module folder
     m_folder = Path(ROOT_DIR) / f"data/input/module {module_num:03}"
 
-    # Define Teacher (lazy initialization - only when needed)
+    # Models of each stage. The teacher stages need the materials uploaded to Gemini: they run on a single Gemini
+    # agent, which switches model between stages. The reviewer and the editor get an agent per model they are routed to
+    teacher_stages = ["first_draft", "summary", "handout_draft", "final_handout"]
+    if model_router is None:
+        teacher_model, assistant_model = ModelOption("gemini", "gemini-2.5-flash"), ModelOption("openai", "gpt-4o-mini")
+        model_router = ModelRouter({stage: StageRoute([teacher_model if stage in teacher_stages else assistant_model])
+                                    for stage in PipelineManager.STAGES})
+    for stage in teacher_stages:
+        if any(option.provider != "gemini" for option in model_router.routes[stage].candidates):
+            raise ValueError(f"Stage '{stage}' needs the materials uploaded to Gemini: route it to Gemini models only")
+    system_prompt_T = prompts.render("system.teacher", subject=subject, language=language)
+    system_prompt_R = prompts.render("system.reviewer", subject=subject, language=language)
+    system_prompt_E = prompts.render("system.editor", subject=subject, language=language)
+    agent_classes = {"gemini": GeminiAgent, "openai": OpenAIAgent, "anthropic": AnthropicAgent}
     teacher = None
-    reviewer = None
-    editor = None
-    
-    def get_teacher(manage_history=True):
+    agents = {}
+
+    # Define Teacher (lazy initialization - only when needed)
+    def get_teacher():
         nonlocal teacher
         if teacher is None:
-            system_prompt_T = load_prompt(Path(ROOT_DIR) / "src/prompts/system.teacher.md", subject=subject, language=language)
-            teacher = GeminiAgent("T", "gemini-2.5-flash", system_prompt_T, manage_history, None)
+            teacher = GeminiAgent("T", model_router.routes["first_draft"].candidates[0].model, system_prompt_T,
+                                  manage_history, None, response_cache, call_policy)
+            teacher.telemetry = telemetry
+            teacher.model_router = model_router
+            # Each teacher stage replaces the output of an earlier one: the summary revises the first draft, the
+            # handout is written from the summary and the final handout revises the handout draft
+            teacher.history_manager = HistoryManager(history_budget, supersedes={
+                "first_draft": "summary", "summary": "handout_draft", "handout_draft": "final_handout"})
         return teacher
-    
-    def get_reviewer():
-        nonlocal reviewer
-        if reviewer is None:
-            system_prompt_R = load_prompt(Path(ROOT_DIR) / "src/prompts/system.reviewer.md", subject=subject, language=language)
-            reviewer = OpenAIAgent("R", "gpt-4o-mini", system_prompt_R, None)
-        return reviewer
-    
-    def get_editor():
-        nonlocal editor
-        if editor is None:
-            system_prompt_E = load_prompt(Path(ROOT_DIR) / "src/prompts/system.editor.md", subject=subject, language=language)
-            #editor = GeminiAgent("E", "gemini-2.5-flash", system_prompt_E, False)
-            editor = OpenAIAgent("E", "gpt-4o-mini", system_prompt_E, None)
-        return editor
+
+    def teacher_on(option):
+        teacher = get_teacher()
+        teacher.model = option.model
+        return teacher
+
+    def get_agent(name, system_prompt, option, stage):
+        if (name, option) not in agents:
+            agent = agent_classes[option.provider](name, option.model, system_prompt, tools=None,
+                                                   response_cache=response_cache, call_policy=call_policy)
+            agent.telemetry = telemetry
+            agent.model_router = model_router
+            agent.response_schema = ReviewReport if structured_reviews else None
+            if option.provider == "anthropic":
+                # Anthropic replies stop at max_tokens: leave room over the expected length of the stage, so that a
+                # longer report is not truncated into invalid JSON
+                agent.max_tokens = max(agent.max_tokens, 2 * model_router.routes[stage].output_tokens)
+            agents[(name, option)] = agent
+        return agents[(name, option)]
+
+    async def assistant_chat(stage, agent, prompt):
+        """Reply of the reviewer or the editor, through a batch job in batch mode"""
+        if batch_collector is None or agent.provider not in batch_collector.PROVIDERS:
+            return await agent.achat(prompt)
+        reply = agent.abatch_chat(prompt, batch_collector,
+                                  on_submitted=lambda job: pipeline.record_stage_metadata(stage, batch_job=job),
+                                  submitted=pipeline.get_stage_metadata(stage).get("batch_job"))
+        if lesson_slot is None:
+            return await reply
+        # Another lesson runs meanwhile, and can add its own requests to the same batch job
+        lesson_slot.release()
+        try:
+            return await reply
+        finally:
+            # Shielded: if the lesson is cancelled, the slot is still taken back before its holder releases it
+            await asyncio.shield(lesson_slot.acquire())
+
+    async def routed(stage, prompt, call):
+        """Await call(option) on the model chosen for the stage, falling back to the next candidates if it fails"""
+        options = model_router.rank(stage, estimate_tokens(prompt))
+        for i, option in enumerate(options):
+            console.print(f"'{stage}' on {option.name}")
+            pipeline.record_stage_metadata(stage, model=option.name)
+            try:
+                return await call(option)
+            except Exception as e:
+                if i + 1 == len(options):
+                    raise
+                console.print(f"{option.name} failed on '{stage}' ({e!r}), falling back to {options[i + 1].name}")
+
+    def reviewed(stage, reply):
+        """Output of the review stages: the report in Markdown, with its issue counts recorded for the next stage"""
+        report = parse_report(reply) if structured_reviews else None
+        pipeline.record_stage_metadata(stage, issues=issue_counts(report) if report is not None else None)
+        return render_report(report) if report is not None else reply
+
+    def revision_of(review_stage, stage):
+        """Revision plan of the stage following a review (see revision_plan), recorded in the state"""
+        issues = pipeline.get_stage_metadata(review_stage).get("issues")
+        # A review file registered by hand may not match the issues recorded by an earlier run
+        if pipeline.state.get("fingerprints", {}).get(review_stage) == PipelineManager.OVERRIDE_FINGERPRINT:
+            issues = None
+        plan = revision_plan(issues)
+        pipeline.record_stage_metadata(stage, revision_plan=plan)
+        return plan
+
+    async def apply_edits(stage, teacher, edits_request, draft):
+        """Ask the teacher for edits to a draft and apply them; None if they do not apply (the stage is rewritten)"""
+        report_prompt(stage, edits_request)
+        # Stateless, so that a rejected patch does not stay in the conversation of the rewrite
+        reply = await teacher.achat(edits_request, stateless=True)
+        try:
+            patch = parse_patch(reply)
+            revised = apply_patch(draft, patch)
+        except PatchError as e:
+            console.print(f"The edits do not apply to the draft ({e}): rewriting it")
+            pipeline.record_stage_metadata(stage, revision="rewrite", patch_error=str(e))
+            return None
+        console.print(f"Applied {len(patch.edits)} edits to the draft")
+        pipeline.record_stage_metadata(stage, revision="patch", edits=len(patch.edits), patch_error=None)
+        # Later prompts in chat mode refer to the revised draft as part of the conversation, not to the edits
+        teacher.remember(edits_request, revised)
+        return revised
+
+    def report_prompt(stage, prompt):
+        tokens = estimate_tokens(prompt)
+        pipeline.record_stage_metadata(stage, prompt_tokens=tokens)
+        console.print(f"Prompt for '{stage}': ~{tokens} tokens")
 
     # Check what stage we're at
     next_stage = pipeline.get_next_stage()
     if next_stage:
         console.print(Markdown(f"**Resuming from stage: {next_stage}**"))
     else:
-        console.print(Markdown("**All stages completed!**"))
-        return
+        console.print(Markdown("**All stages completed, checking whether their inputs changed**"))
 
     console.print(Markdown("## Step 0: Uploading pdf resources"))
-    material_paths, topics_file = load_materials_paths(input_folder)
+    prefetched = prefetcher.lesson(input_folder) if prefetcher is not None else None
+    if prefetched is not None:
+        material_paths, topics_file = prefetched["materials"], prefetched["topics"]
+    else:
+        material_paths, topics_file = load_materials_paths(input_folder)
+        if topics_file is None:
+            raise FileNotFoundError(f"No topics (.txt) file in {input_folder}")
+    uploads = None
+
+    async def load_materials():
+        # Prefetched materials are found in the file cache once their module upload is done
+        if prefetched is not None:
+            await prefetcher.wait(prefetched)
+        return await asyncio.to_thread(get_teacher().load_pdfs, material_paths, use_cache=True,
+                                       hashes=prefetched["hashes"] if prefetched is not None else None)
+
+    def start_uploads():
+        nonlocal uploads
+        if uploads is None:
+            uploads = asyncio.create_task(load_materials())
+        return uploads
+
+    # Uploads run in the background while the lesson structure is parsed; stage 1 starts as soon as they finish.
+    # If every stage is completed they are only started when a stage turns out to be stale
+    if next_stage:
+        start_uploads()
     module_structure = {}
-    if os.path.exists(m_folder / "module_topics.md"):
+    if prefetched is not None:
+        module_structure = prefetcher.module_structure
+    elif os.path.exists(m_folder / "module_topics.md"):
         module_structure = extract_module_structure(m_folder / "module_topics.md")
     topics = extract_topics(topics_file)
-    material_files = get_teacher().load_pdfs(material_paths, use_cache=True)
-    materials = {m.name: p.name for m, p in zip(material_files, material_paths)}
-    materials_info = {p.name: p.name for p in material_paths}
+    if prefetched is not None:
+        material_hashes = prefetched["hashes"]
+    else:
+        material_hashes = await asyncio.to_thread(lambda: [file_sha256(path) for path in material_paths])
+    # The reviewer and the editor do not receive the pdfs: they are grounded with passages retrieved from a local index
+    materials_index = None
+    if passages_per_section:
+        materials_index = await asyncio.to_thread(MaterialsIndex.load_or_build, material_paths)
+        console.print(f"Materials index: {len(materials_index.chunks)} passages")
 
-    # First step: draft the summary from the input materials
-    if not pipeline.is_stage_completed("first_draft"):
-        console.print(Markdown("## Step 1: Generating first draft"))
-        summary_instructions = load_prompt(Path(ROOT_DIR) / f"src/prompts/summary.teacher{stateless}.md", topics=topics, subject=subject, language=language, materials=materials, lesson_num=lesson_num)
+    def passages(text):
+        if materials_index is None:
+            return "(Not available)"
+        return materials_index.passages(text, passages_per_section)
+
+    def build_summary_instructions(materials, variant):
+        summary_instructions = prompts.render(f"summary.teacher{variant}", topics=topics, subject=subject,
+                                              language=language, materials=materials, lesson_num=lesson_num)
         if module_structure:
             summary_instructions += f"\n\n##Here I give you the topics for all the lessons in the module: \n{module_structure}"
-        
-        first_draft = get_teacher().chat(summary_instructions)
-        saved_path = pipeline.save_stage_output("first_draft", first_draft)
-        console.print(f"✓ First draft saved to: {saved_path}")
-    else:
-        console.print(Markdown("## Step 1: ✓ First draft already exists (skipping)"))
-        summary_instructions = load_prompt(Path(ROOT_DIR) / f"src/prompts/summary.teacher{stateless}.md", topics=topics, subject=subject, language=language, materials=materials, lesson_num=lesson_num)
-        first_draft = pipeline.get_stage_output("first_draft")
+        return summary_instructions
+
+    # The fingerprints use the local file names, since upload handles change whenever a file is re-uploaded, and the
+    # self-contained (.sl) prompts, so that they do not depend on whether the run resumed or started fresh
+    stable_materials = {path.name: path.name for path in material_paths}
+    stable_context = {"materials": stable_materials, "variant": ".sl",
+                      "summary_instructions": build_summary_instructions(stable_materials, ".sl")}
+    lesson_context = {}
+    lesson_context_lock = asyncio.Lock()
+
+    async def get_lesson_context():
+        """Wait for the uploads and give the lesson request to the teacher, once"""
+        async with lesson_context_lock:
+            if not lesson_context:
+                material_files = await start_uploads()
+                materials = {m.name: p.name for m, p in zip(material_files, material_paths)}
+                summary_instructions = build_summary_instructions(materials, stateless)
+                # The lesson request is sent to the teacher once, as shared context (inside the Gemini context cache
+                # when available): the teacher prompts refer to it instead of embedding a copy each
+                get_teacher().shared_context = {"Lesson request": summary_instructions}
+                console.print(f"Shared teacher context: ~{estimate_tokens(summary_instructions)} tokens")
+                if context_cache:
+                    await asyncio.to_thread(get_teacher().use_context_cache)
+                lesson_context.update(materials=materials, variant=stateless, summary_instructions=summary_instructions)
+        return lesson_context
+
+    teacher_shared = {"summary_instructions": "Lesson request", "instructions": "Lesson request"}
+
+    def handout_values(outputs, context):
+        return dict(lesson_num=lesson_num, summary=outputs["summary"], materials=context["materials"],
+                    language=language, summary_instructions=context["summary_instructions"])
+
+    def first_draft_prompt(outputs, context):
+        return prompts.render("summary_request.teacher", shared=teacher_shared,
+                              summary_instructions=context["summary_instructions"], lesson_num=lesson_num)
+
+    def review_prompt(outputs, context):
+        return prompts.render("review_report.reviewer" if structured_reviews else "review.reviewer",
+                              summary_instructions=context["summary_instructions"],
+                              summary_draft=outputs["first_draft"], lesson_num=lesson_num,
+                              passages=passages(outputs["first_draft"]))
+
+    def summary_prompt(outputs, context):
+        return prompts.render(f"review_summary.teacher{context['variant']}", shared=teacher_shared,
+                              instructions=context["summary_instructions"], summary=outputs["first_draft"],
+                              review=outputs["review"])
+
+    def handout_prompt(outputs, context):
+        return prompts.render(f"notes.teacher{context['variant']}", shared=teacher_shared,
+                              **handout_values(outputs, context))
+
+    def editing_prompt(outputs, context):
+        # The editor does not hold the lesson request in its context, so it receives the full handout instructions
+        return prompts.render("editing_report.editor" if structured_reviews else "editing.editor",
+                              handout=outputs["handout_draft"], passages=passages(outputs["summary"]),
+                              instructions=prompts.render(f"notes.teacher{context['variant']}",
+                                                          **handout_values(outputs, context)))
+
+    def final_prompt(outputs, context):
+        return prompts.render(f"final_notes.teacher{context['variant']}", shared=teacher_shared, lesson_num=lesson_num,
+                              handout_draft=outputs["handout_draft"], review=outputs["editing_instructions"],
+                              summary_instructions=context["summary_instructions"],
+                              handout_instructions=handout_prompt(outputs, context))
+
+    def summary_edits_prompt(outputs, context):
+        return prompts.render("summary_edits.teacher", shared=teacher_shared, lesson_num=lesson_num,
+                              instructions=context["summary_instructions"], summary=outputs["first_draft"],
+                              review=outputs["review"])
+
+    def final_edits_prompt(outputs, context):
+        return prompts.render("final_edits.teacher", shared=teacher_shared, lesson_num=lesson_num,
+                              handout_draft=outputs["handout_draft"], review=outputs["editing_instructions"],
+                              summary_instructions=context["summary_instructions"])
+
+    def fingerprint(model, system_prompt, build_prompt, **extra):
+        """Everything a stage output depends on besides its input stages, for incremental invalidation"""
+        return lambda outputs: {
+            "model": model,
+            "instructions": system_prompt,
+            "prompt": build_prompt(outputs, stable_context),
+            "lesson_request": stable_context["summary_instructions"],
+            "materials": material_hashes,
+            **extra,
+        }
+
+    # First step: draft the summary from the input materials
+    async def run_first_draft(outputs):
+        summary_request = first_draft_prompt(outputs, await get_lesson_context())
+        report_prompt("first_draft", summary_request)
+        return await routed("first_draft", summary_request, lambda option: teacher_on(option).achat(summary_request))
 
     # Second step: review the summary with a different model
-    if not pipeline.is_stage_completed("review"):
-        console.print(Markdown("## Step 2: Reviewing first draft"))
-        # Reload materials info for instructions
-        # material_paths, topics_file = load_materials_paths(input_folder)
-        # module_structure = {}
-        # if os.path.exists(m_folder / "module_topics.md"):
-        #     module_structure = extract_module_structure(m_folder / "module_topics.md")
-        # topics = extract_topics(topics_file)
-        
-        # # Recreate instructions (needed for review context)
-
-        # summarY_instructions = load_prompt(Path(ROOT_DIR) / "src/prompts/summary.teacher.md", topics=topics, subject=subject, language=language, materials=materials_info, lesson_num=lesson_num)
-        # if module_structure:
-        #     summarY_instructions += f"\n\n##Here I give you the topics for all the lessons in the module: \n{module_structure}"
-        
-        review_instructions = load_prompt(Path(ROOT_DIR) / "src/prompts/review.reviewer.md", summary_instructions=summary_instructions, summary_draft=first_draft, lesson_num=lesson_num)
-        review = get_reviewer().chat(review_instructions)
+    async def run_review(outputs):
+        review_instructions = review_prompt(outputs, await get_lesson_context())
+        report_prompt("review", review_instructions)
+        review = await routed("review", review_instructions,
+                              lambda option: assistant_chat("review", get_agent("R", system_prompt_R, option, "review"),
+                                                            review_instructions))
+        review = reviewed("review", review)
         console.print(Markdown(review))
-        saved_path = pipeline.save_stage_output("review", review)
-        console.print(f"✓ Review saved to: {saved_path}")
-    else:
-        console.print(Markdown("## Step 2: ✓ Review already exists (skipping)"))
-        review = pipeline.get_stage_output("review")
+        return review
 
     # Third step: create the revised summary
-    if not pipeline.is_stage_completed("summary"):
-        console.print(Markdown("## Step 3: Updating draft based on review"))
-        update_instructions = load_prompt(Path(ROOT_DIR) / f"src/prompts/review_summary.teacher{stateless}.md", instructions=summary_instructions, summary=first_draft, review=review)
-        revised_summary = get_teacher().chat(update_instructions)
-        saved_path = pipeline.save_stage_output("summary", revised_summary)
-        console.print(f"✓ Summary saved to: {saved_path}")
-    else:
-        console.print(Markdown("## Step 3: ✓ Summary already exists (skipping)"))
-        revised_summary = pipeline.get_stage_output("summary") # it is unused since the teacher agent has internal history management
+    async def run_summary(outputs):
+        context = await get_lesson_context()
+        plan = revision_of("review", "summary")
+        if plan == "skip":
+            console.print("The review found no issues: keeping the first draft as the summary")
+            pipeline.record_stage_metadata("summary", revision="skip", model=None)
+            return outputs["first_draft"]
+        if plan == "patch":
+            edits_request = summary_edits_prompt(outputs, context)
+            summary = await routed("summary", edits_request,
+                                   lambda option: apply_edits("summary", teacher_on(option), edits_request,
+                                                              outputs["first_draft"]))
+            if summary is not None:
+                return summary
+        else:
+            pipeline.record_stage_metadata("summary", revision="rewrite", patch_error=None)
+        update_instructions = summary_prompt(outputs, context)
+        report_prompt("summary", update_instructions)
+        return await routed("summary", update_instructions,
+                            lambda option: teacher_on(option).achat(update_instructions))
 
     # Fourth step: Write notes
-    if not pipeline.is_stage_completed("handout_draft"):
-        console.print(Markdown("## Step 4: Writing Handout"))
-        handout_instructions = load_prompt(Path(ROOT_DIR) / f"src/prompts/notes.teacher{stateless}.md", lesson_num=lesson_num, summary=revised_summary, materials=materials, language=language, summary_instructions=summary_instructions)
-        console.print(Markdown(handout_instructions))
-        handout = get_teacher().chat(handout_instructions)
-        saved_path = pipeline.save_stage_output("handout_draft", handout)
-        console.print(f"✓ Handout draft saved to: {saved_path}")
-    else:
-        handout_instructions = load_prompt(Path(ROOT_DIR) / f"src/prompts/notes.teacher{stateless}.md",
-                                           lesson_num=lesson_num, summary=revised_summary, materials=materials,
-                                           language=language, summary_instructions=summary_instructions)
-        console.print(Markdown("## Step 4: ✓ Handout draft already exists (skipping)"))
-        handout = pipeline.get_stage_output("handout_draft")
+    async def run_handout_draft(outputs):
+        handout_instructions = handout_prompt(outputs, await get_lesson_context())
+
+        async def write_handout(option):
+            teacher = teacher_on(option)
+            if parallel_sections:
+                handout = await write_handout_by_sections(teacher, outputs["summary"], lesson_num, language, console,
+                                                          max_concurrency=section_workers)
+                if handout is not None:
+                    # Later teacher prompts in chat mode refer to the handout as part of the conversation
+                    teacher.remember(handout_instructions, handout)
+                    return handout
+                console.print("The summary has no sections to write in parallel, writing the handout in one call")
+            console.print(Markdown(handout_instructions))
+            report_prompt("handout_draft", handout_instructions)
+            return await stream_stage(pipeline, "handout_draft", teacher, handout_instructions, console,
+                                      live_output=live_output)
+
+        return await routed("handout_draft", handout_instructions, write_handout)
 
     # Fifth step: revise the notes for editorial modifications
-    if not pipeline.is_stage_completed("editing_instructions"):
-        console.print(Markdown("## Step 5: Checking Editorial Constraints"))
-        handout_instructions = load_prompt(Path(ROOT_DIR) / f"src/prompts/notes.teacher{stateless}.md", lesson_num=lesson_num, summary=revised_summary, materials=materials, language=language, summary_instructions=summary_instructions)
-        editing_instructions = load_prompt(Path(ROOT_DIR) / "src/prompts/editing.editor.md", instructions=handout_instructions, handout=handout)
-        editing_response = get_editor().chat(editing_instructions)
-        saved_path = pipeline.save_stage_output("editing_instructions", editing_response)
-        console.print(f"✓ Editing instructions saved to: {saved_path}")
-    else:
-        console.print(Markdown("## Step 5: ✓ Editing instructions already exist (skipping)"))
-        editing_response = pipeline.get_stage_output("editing_instructions")
+    async def run_editing_instructions(outputs):
+        editing_instructions = editing_prompt(outputs, await get_lesson_context())
+        report_prompt("editing_instructions", editing_instructions)
+        feedback = await routed("editing_instructions", editing_instructions,
+                                lambda option: assistant_chat("editing_instructions",
+                                                              get_agent("E", system_prompt_E, option,
+                                                                        "editing_instructions"),
+                                                              editing_instructions))
+        return reviewed("editing_instructions", feedback)
 
     # Sixth step: final revision
-    if not pipeline.is_stage_completed("final_handout"):
-        console.print(Markdown("## Step 6: Updating Final Handout"))
-        editorial_corrections = load_prompt(Path(ROOT_DIR) / f"src/prompts/final_notes.teacher{stateless}.md", lesson_num=lesson_num, handout_draft=handout, review=editing_response,
-                                            summary_instructions=summary_instructions, handout_instructions=handout_instructions)
-        console.print(Markdown(editorial_corrections))
-        final_handout = get_teacher().chat(editorial_corrections)
+    async def run_final_handout(outputs):
+        context = await get_lesson_context()
+        plan = revision_of("editing_instructions", "final_handout")
+        if plan == "skip":
+            console.print("The editor found no issues: keeping the handout draft as the final handout")
+            pipeline.record_stage_metadata("final_handout", revision="skip", model=None)
+            return outputs["handout_draft"]
+        editorial_corrections = final_prompt(outputs, context)
+        edits_request = final_edits_prompt(outputs, context)
+        # Minor issues are fixed with edits even when the handout is otherwise rewritten
+        use_edits = patch_edits or plan == "patch"
+
+        async def revise_handout(option):
+            teacher = teacher_on(option)
+            # An interrupted rewrite is continued rather than replaced by edits
+            if use_edits and not pipeline.get_partial_output("final_handout"):
+                handout = await apply_edits("final_handout", teacher, edits_request, outputs["handout_draft"])
+                if handout is not None:
+                    return handout
+            else:
+                pipeline.record_stage_metadata("final_handout", revision="rewrite", patch_error=None)
+            console.print(Markdown(editorial_corrections))
+            report_prompt("final_handout", editorial_corrections)
+            # After a failure the next model continues the partial output (see stream_stage)
+            return await stream_stage(pipeline, "final_handout", teacher, editorial_corrections, console,
+                                      live_output=live_output)
+
+        return await routed("final_handout", edits_request if use_edits else editorial_corrections, revise_handout)
+
+    stages = [
+        Stage("first_draft", run_first_draft, "Generating first draft",
+              fingerprint=fingerprint(model_router.describe("first_draft"), system_prompt_T, first_draft_prompt)),
+        Stage("review", run_review, "Reviewing first draft",
+              fingerprint=fingerprint(model_router.describe("review"), system_prompt_R, review_prompt,
+                                      structured_reviews=structured_reviews)),
+        Stage("summary", run_summary, "Updating draft based on review",
+              fingerprint=fingerprint(model_router.describe("summary"), system_prompt_T, summary_prompt)),
+        Stage("handout_draft", run_handout_draft, "Writing Handout",
+              fingerprint=fingerprint(model_router.describe("handout_draft"), system_prompt_T, handout_prompt,
+                                      parallel_sections=parallel_sections)),
+        Stage("editing_instructions", run_editing_instructions, "Checking Editorial Constraints",
+              fingerprint=fingerprint(model_router.describe("editing_instructions"), system_prompt_E,
+                                      editing_prompt, structured_reviews=structured_reviews)),
         # Save final handout with timestamp in main output folder
-        final_path = output_folder / f"handout_m{module_num:03}_l{lesson_num:03}_{round(time())}.md"
-        pipeline.save_stage_output("final_handout", final_handout, final_path)
-        console.print(f"✓ Final handout saved to: {final_path}")
-    else:
-        console.print(Markdown("## Step 6: ✓ Final handout already exists"))
+        Stage("final_handout", run_final_handout, "Updating Final Handout",
+              output_file=lambda: output_folder / f"handout_m{module_num:03}_l{lesson_num:03}_{round(time())}.md",
+              fingerprint=fingerprint(model_router.describe("final_handout"), system_prompt_T,
+                                      final_edits_prompt if patch_edits else final_prompt, patch_edits=patch_edits)),
+    ]
+    try:
+        await StageScheduler(pipeline, stages, console).run()
+    finally:
+        if wandb_run is not None:
+            wandb_run.finish()
 
     console.print(Markdown("## ✓ Handout Generation Completed!"))
 
+def find_lessons(module_nums=None, input_root=None):
+    """Find the (module_num, lesson_num) pairs of every lesson materials folder under data/input"""
+    if not input_root:
+        input_root = Path(ROOT_DIR) / "data/input"
+    lessons = []
+    for module_folder in sorted(Path(input_root).glob("module *")):
+        try:
+            module_num = int(module_folder.name.split()[1])
+        except (IndexError, ValueError):
+            continue
+        if module_nums is not None and module_num not in module_nums:
+            continue
+        for lesson_folder in sorted(module_folder.glob("Lez * materials")):
+            try:
+                lesson_num = int(lesson_folder.name.split()[1])
+            except (IndexError, ValueError):
+                continue
+            lessons.append((module_num, lesson_num))
+    return lessons
+
+def generate_handouts(lessons=None, max_workers=4, **kwargs):
+    """Generate the handouts of several lessons concurrently (blocking wrapper around agenerate_handouts)"""
+    return asyncio.run(closing_clients(agenerate_handouts(lessons, max_workers=max_workers, **kwargs)))
+
+async def agenerate_handouts(lessons=None, max_workers=4, warm_up_connections=True, prefetch_materials=True, **kwargs):
+    """
+    Generate the handouts of several lessons concurrently on a single event loop
+
+    Args:
+        lessons: Iterable of (module_num, lesson_num) pairs. If None, every lesson folder under data/input is processed.
+        max_workers: Maximum number of lessons processed at the same time
+        warm_up_connections: If True, the connections to the providers are opened before the first lesson starts
+        prefetch_materials: If True, the materials of every module are scanned once and uploaded in the background,
+                            ahead of the lessons and once for the pdfs shared by several lessons (see ModulePrefetcher)
+        kwargs: Forwarded to agenerate_handout (resume, manage_history, cache_responses...). With resume=True each
+                lesson resumes from its own last checkpoint. With a batch_collector, a lesson waiting for a batch job
+                lets the next one start, so that the lessons share the jobs while at most max_workers of them make
+                real-time calls and uploads.
+
+    Returns:
+        Dict mapping (module_num, lesson_num) to None on success, or to the exception that stopped the lesson
+    """
+    if lessons is None:
+        lessons = find_lessons()
+    lessons = sorted(set(lessons))
+    # Live rendering of concurrent lessons would overwrite each other on the terminal
+    kwargs.setdefault("live_output", False)
+    # A single policy learns the hedging thresholds from the calls of every lesson
+    kwargs.setdefault("call_policy", CallPolicy())
+    if warm_up_connections:
+        from src.client_pool import warm_up
+
+        # Every lesson shares the SDK clients of this event loop, and so their open connections
+        await warm_up(["gemini", "openai"])
+    prefetchers = {}
+    if prefetch_materials:
+        # Completed lessons only upload their materials if a stage turns out to be stale
+        pending = [(module_num, lesson_num) for module_num, lesson_num in lessons if not kwargs.get("resume", True)
+                   or PipelineManager(lesson_num, module_num, kwargs.get("output_folder")
+                                      or Path(ROOT_DIR) / f"data/output/module {module_num:03}").get_next_stage()]
+        for module_num in sorted({module_num for module_num, _ in lessons}):
+            prefetcher = ModulePrefetcher(Path(ROOT_DIR) / f"data/input/module {module_num:03}")
+            prefetchers[module_num] = await asyncio.to_thread(prefetcher.scan)
+            prefetcher.start([lesson_num for other, lesson_num in pending if other == module_num])
+    results = {}
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def run_lesson(module_num, lesson_num):
+        async with semaphore:
+            try:
+                await agenerate_handout(lesson_num, module_num, prefetcher=prefetchers.get(module_num),
+                                        lesson_slot=semaphore, **kwargs)
+                results[(module_num, lesson_num)] = None
+                print(f"✓ Module {module_num}, lesson {lesson_num} completed")
+            except Exception as e:
+                results[(module_num, lesson_num)] = e
+                print(f"✗ Module {module_num}, lesson {lesson_num} failed: {e!r}")
+
+    try:
+        await asyncio.gather(*(run_lesson(module_num, lesson_num) for module_num, lesson_num in lessons))
+    finally:
+        # Uploads that no lesson waited for (e.g. of a lesson that failed first) use the clients closed after this
+        for prefetcher in prefetchers.values():
+            await prefetcher.aclose()
+
+    failed = [key for key, error in results.items() if error is not None]
+    print(f"\nBatch completed: {len(results) - len(failed)}/{len(results)} lessons succeeded")
+    for module_num, lesson_num in sorted(failed):
+        print(f"  ✗ module {module_num}, lesson {lesson_num}: {results[(module_num, lesson_num)]!r}")
+    return results
+
 def clear_cache():
     """Utility function to clear the PDF cache"""
+    from src.agents import GeminiAgent
+
     api_keys = load_api_keys()
     temp_agent = GeminiAgent("temp", "gemini-2.5-flash", "", False, None)
     temp_agent.clear_cache()
@@ -261,19 +696,49 @@ def reset_pipeline(lesson_num, module_num, from_stage=None, output_dir=None):
         pipeline.clear_all()
         print("Pipeline completely reset")
 
-def show_pipeline_status(lesson_num, module_num, pipeline_status_folder):
-    """Show current pipeline status"""
-    pipeline = PipelineManager(lesson_num, module_num, pipeline_status_folder)
+def show_prompt_templates():
+    """Load and validate every prompt template, and show their size and placeholders"""
     console = Console()
+    console.print(Markdown("## Prompt templates"))
+    for name, tokens, fields in get_prompt_registry().describe():
+        console.print(f"  {name}: ~{tokens} tokens, fields: {', '.join(fields) or '-'}")
+
+def show_pipeline_status(lesson_num, module_num, pipeline_status_folder, console=None):
+    """Show current pipeline status (on console, e.g. a recording Console to get it as text)"""
+    pipeline = PipelineManager(lesson_num, module_num, pipeline_status_folder, read_only=True)
+    console = console or Console()
     
     console.print(Markdown(f"## Pipeline Status: Module {module_num}, Lesson {lesson_num}"))
-    console.print(f"State file: {pipeline.state_file}")
+    if pipeline.state_store is not None:
+        console.print(f"State database: {pipeline.state_store.db_file}")
+    else:
+        console.print(f"State file: {pipeline.state_file}")
     console.print(f"\nCompleted stages:")
     
     for stage in PipelineManager.STAGES:
         status = "✓" if pipeline.is_stage_completed(stage) else "○"
         file_path = pipeline.state.get("stage_files", {}).get(stage, "N/A")
-        console.print(f"  {status} {stage}: {file_path}")
+        metadata = pipeline.get_stage_metadata(stage)
+        details = []
+        if metadata.get("model"):
+            details.append(metadata["model"])
+        if metadata.get("issues") is not None:
+            details.append(", ".join(f"{count} {severity}" for severity, count in metadata["issues"].items() if count)
+                           + " issues" if any(metadata["issues"].values()) else "no issues")
+        if metadata.get("revision") == "skip":
+            details.append("skipped, no issues to fix")
+        elif metadata.get("revision") == "patch":
+            details.append(f"{metadata['edits']} edits applied")
+        elif metadata.get("revision") == "rewrite":
+            details.append("rewritten" + (", edits rejected" if metadata.get("patch_error") else ""))
+        if metadata.get("prompt_tokens") is not None:
+            details.append(f"prompt ~{metadata['prompt_tokens']} tokens")
+        if metadata.get("retries") or metadata.get("hedges"):
+            details.append(f"{metadata.get('retries', 0)} retries, {metadata.get('hedges', 0)} hedges")
+        if metadata.get("duration_s") is not None:
+            details.append(f"{metadata['duration_s']:.1f}s")
+        details = f" ({', '.join(details)})" if details else ""
+        console.print(f"  {status} {stage}: {file_path}{details}")
     
     next_stage = pipeline.get_next_stage()
     if next_stage:
@@ -281,6 +746,22 @@ def show_pipeline_status(lesson_num, module_num, pipeline_status_folder):
     else:
         console.print("\n**All stages completed!**")
 
+    # The trace keeps the calls of every run: only those of the runs that produced the current stages are summed
+    run_ids = {run.get("run_id") for run in pipeline.state.get("stage_runs", {}).values()}
+    records = [record for record in read_trace(pipeline.trace_file) if record.get("run_id") in run_ids - {None}]
+    if not records:
+        return
+    console.print(f"\nAgent calls of the current stages ({pipeline.trace_file}):")
+    for key in ("stage", "provider"):
+        for name, totals in summarize_trace(records, key).items():
+            console.print(f"  {name}: {totals['calls']:.0f} calls ({totals['response_cache_hits']:.0f} cached), "
+                          f"{totals['wall_s']:.1f}s, {totals['input_tokens']:.0f} in "
+                          f"({totals['cached_tokens']:.0f} cached) / {totals['output_tokens']:.0f} out tokens, "
+                          f"${totals['cost_usd']:.4f}")
+    totals = summarize_trace(records, "lesson")
+    total = next(iter(totals.values()))
+    console.print(f"  Total: {total['calls']:.0f} calls, {total['wall_s']:.1f}s of calls, ${total['cost_usd']:.4f}")
+
 def main():
     module_num = 7
     lesson_num = 11
@@ -290,6 +771,7 @@ def main():
 
     # Show current status
     # show_pipeline_status(lesson_num, module_num, output_folder)
+    # show_prompt_templates()
     
     # Reset from a specific stage if needed
     """
@@ -310,5 +792,8 @@ def main():
     # Run the pipeline (will resume from last checkpoint)
     generate_handout(lesson_num, module_num, resume=True, override_files=None, input_folder=input_folder, output_folder=output_folder)
 
+    # Or run every lesson of the module concurrently, each one resuming from its own checkpoint
+    # generate_handouts(find_lessons(module_nums=[module_num]), max_workers=4)
+
 if __name__ == "__main__":
     main()
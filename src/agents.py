@@ -1,34 +1,295 @@
-from openai import OpenAI
-from anthropic import Anthropic
 import google.genai as googleai
+from openai.types.chat import ChatCompletion
 from abc import ABC, abstractmethod
 from pathlib import Path
-from config.definitions import ROOT_DIR, google_api_key
+from config.definitions import CACHE_DIR
+import asyncio
+import hashlib
 import json
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from src.call_policy import CallPolicy, CallStats
+from src.client_pool import get_client, get_async_client
+from src.file_cache import FileCache, file_sha256
+
+CONTINUE_PROMPT = ("Your previous answer was interrupted. Continue it exactly from the point where it stops, "
+                   "without repeating any of the text already written.")
 
 
 class Agent(ABC):
+    provider = None
 
-    def __init__(self, name, model, instructions, tools):
+    def __init__(self, name, model, instructions, tools, manage_history=False, response_cache=None, call_policy=None):
         self.name = name
         self.model = model
         self.instructions = instructions
         self.tools = tools
+        self.manage_history = manage_history
+        # Optional ResponseCache; set bypass_cache to always call the provider (the reply is still stored)
+        self.response_cache = response_cache
+        self.bypass_cache = False
+        # Timeouts, retries and hedging of the provider calls
+        self.call_policy = call_policy or CallPolicy()
+        # Optional Telemetry recording every call (latency, tokens, cost...)
+        self.telemetry = None
+        # Optional ModelRouter learning the latencies and error rates of the models from every call
+        self.model_router = None
+        # Optional pydantic model the replies follow, through the structured-output mode of the provider: the reply
+        # text is then a JSON document of that model
+        self.response_schema = None
 
-        self.history = [{"role": "user", "content": None}]
+        # Context sent once at the beginning of every conversation ({title: text}); prompts can refer to it by title
+        self.shared_context = {}
+        # Conversation so far, as provider-neutral {"role": "user" | "assistant", "content": str} messages, tagged with
+        # the "stage" that produced them
+        self.history = []
+        # Optional HistoryManager compacting the history sent in chat mode (see src/history_manager.py)
+        self.history_manager = None
         self.response = None
 
+    def chat(self, prompt, new_chat=False, bypass_cache=False, stateless=False):
+        messages = self._prepare_messages(prompt, new_chat, stateless)
+        with self._traced() as call:
+            text = self._cached_reply(messages, bypass_cache)
+            call["response_cache_hit"] = text is not None
+            if text is None:
+                call["response"] = self.response = self.call_policy.call(
+                    lambda timeout: self._call_llm(messages, timeout), call["stats"])
+                text = self._store_reply(messages, self._response_text(self.response))
+        return text if stateless else self._record_reply(prompt, text)
+
+    async def abatch_chat(self, prompt, batch, on_submitted=None, submitted=None):
+        """
+        Version of achat answered by a provider batch job, collected by batch (a BatchCollector, see
+        src/batch_jobs.py) together with the requests of other agents. on_submitted and submitted let the caller keep
+        track of the job, to wait for it again instead of resubmitting the request (e.g. after a restart)
+        """
+        messages = self._prepare_messages(prompt)
+        with self._traced(batched=True) as call:
+            text = await self._acached_reply(messages)
+            call["response_cache_hit"] = text is not None
+            if text is None:
+                reply = await batch.acall(self.async_api, self.provider, self.model, self._batch_request(messages),
+                                          on_submitted, submitted)
+                call["response"] = self.response = self._batch_response(reply)
+                text = await self._astore_reply(messages, self._response_text(self.response))
+        return self._record_reply(prompt, text)
+
+    async def achat(self, prompt, new_chat=False, bypass_cache=False, stateless=False):
+        """Async version of chat. With stateless=True the history is neither sent nor updated (e.g. concurrent calls)"""
+        messages = self._prepare_messages(prompt, new_chat, stateless)
+        with self._traced() as call:
+            text = await self._acached_reply(messages, bypass_cache)
+            call["response_cache_hit"] = text is not None
+            if text is None:
+                # Short replies (reviews, edits) and long generations have their own hedging thresholds
+                call["response"] = self.response = await self.call_policy.acall(
+                    (CallPolicy.stats().stage, self.model), lambda: self._acall_llm(messages), call["stats"])
+                text = await self._astore_reply(messages, self._response_text(self.response))
+        return text if stateless else self._record_reply(prompt, text)
+
+    @property
+    def agent_api(self):
+        """SDK client shared by every agent of the provider (see src/client_pool.py)"""
+        return get_client(self.provider)
+
+    @property
+    def async_api(self):
+        """Async SDK client shared by every agent of the provider running on the current event loop"""
+        return get_async_client(self.provider)
+
+    def remember(self, prompt, text):
+        """Add to the history an exchange that was produced outside of it (e.g. by concurrent stateless calls)"""
+        return self._record_reply(prompt, text)
+
+    def _attachment_hashes(self):
+        """Content hashes of the files attached to the requests"""
+        return []
+
+    def _cache_request(self, messages):
+        """Everything that determines the reply. In chat mode messages holds the whole conversation so far"""
+        request = {
+            "provider": self.provider,
+            "model": self.model,
+            "instructions": self.instructions,
+            "messages": messages,
+            "attachments": self._attachment_hashes(),
+            "shared_context": self.shared_context,
+        }
+        if self.response_schema is not None:
+            request["response_schema"] = self.response_schema.model_json_schema()
+        return request
+
+    def _shared_context_text(self):
+        return "\n\n".join(f"# {title}\n\n{text}" for title, text in self.shared_context.items())
+
+    def _with_shared_context(self, messages):
+        """Prepend the shared context to the first user message"""
+        if not self.shared_context or not messages:
+            return messages
+        first = {"role": messages[0]["role"], "content": self._shared_context_text() + "\n\n" + messages[0]["content"]}
+        return [first] + messages[1:]
+
+    def _cached_reply(self, messages, bypass_cache=False):
+        if self.response_cache is None or bypass_cache or self.bypass_cache:
+            return None
+        text = self.response_cache.get(self.response_cache.make_key(self._cache_request(messages)))
+        if text is not None:
+            self.response = None
+        return text
+
+    def _store_reply(self, messages, text):
+        if self.response_cache is not None and text is not None:
+            request = self._cache_request(messages)
+            self.response_cache.put(self.response_cache.make_key(request), text, request)
+        return text
+
+    async def _acached_reply(self, messages, bypass_cache=False):
+        """Version of _cached_reply reading the disk cache in a thread, off the event loop shared by the lessons"""
+        if self.response_cache is None:
+            return None
+        return await asyncio.to_thread(self._cached_reply, messages, bypass_cache)
+
+    async def _astore_reply(self, messages, text):
+        if self.response_cache is None:
+            return text
+        return await asyncio.to_thread(self._store_reply, messages, text)
+
+    def chat_stream(self, prompt, new_chat=False, partial="", bypass_cache=False):
+        """
+        Yield the reply chunk by chunk.
+
+        partial is the beginning of a reply that was interrupted: the model is asked to continue it, and only the new
+        text is yielded. The history records the whole reply once the stream is exhausted.
+        """
+        messages = self._prepare_messages(prompt, new_chat)
+        with self._traced(streamed=True) as call:
+            text = None if partial else self._cached_reply(messages, bypass_cache)
+            call["response_cache_hit"] = text is not None
+            if text is not None:
+                yield text
+            else:
+                text = partial
+                for chunk in self._stream_llm(self._continuation(messages, partial)):
+                    call["first_token"] = call["first_token"] or time.monotonic()
+                    text += chunk
+                    yield chunk
+                call["response"] = self.response
+                self._store_reply(messages, text)
+        self._record_reply(prompt, text)
+
+    async def achat_stream(self, prompt, new_chat=False, partial="", bypass_cache=False):
+        """Async version of chat_stream"""
+        messages = self._prepare_messages(prompt, new_chat)
+        with self._traced(streamed=True) as call:
+            text = None if partial else await self._acached_reply(messages, bypass_cache)
+            call["response_cache_hit"] = text is not None
+            if text is not None:
+                yield text
+            else:
+                text = partial
+                # After a failure the policy restarts the stream, continuing from the text received so far
+                continuation = lambda: self._astream_llm(self._continuation(messages, text))
+                async for chunk in self.call_policy.astream(continuation, call["stats"]):
+                    call["first_token"] = call["first_token"] or time.monotonic()
+                    text += chunk
+                    yield chunk
+                call["response"] = self.response
+                await self._astore_reply(messages, text)
+        self._record_reply(prompt, text)
+
+    @contextmanager
+    def _traced(self, streamed=False, batched=False):
+        """
+        Time a call and record it in the telemetry and the model router, with the usage of the response stored in
+        call["response"]
+        """
+        call = {"start": time.monotonic(), "first_token": None, "response": None, "response_cache_hit": False,
+                "stats": CallStats()}
+        error = None
+        try:
+            yield call
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            end = time.monotonic()
+            usage = self._usage(call["response"]) if call["response"] is not None else {}
+            record = dict(stage=CallPolicy.stats().stage, agent=self.name, provider=self.provider, model=self.model,
+                          streamed=streamed, batched=batched, wall_s=end - call["start"],
+                          first_token_s=(call["first_token"] or end) - call["start"],
+                          response_cache_hit=call["response_cache_hit"], error=error, **usage,
+                          **call["stats"].as_dict())
+            if self.telemetry is not None:
+                self.telemetry.record(**record)
+            # Batch jobs take hours whichever the model: they would only mislead the router
+            if self.model_router is not None and not call["response_cache_hit"] and not batched:
+                self.model_router.observe(record)
+
+    def _usage(self, response):
+        """Token counts of a response: input_tokens (including the cached ones), cached_tokens and output_tokens"""
+        return {}
+
+    def _batch_request(self, messages):
+        """JSON body of the request in a provider batch job"""
+        raise NotImplementedError(f"Batch jobs are not supported for {self.provider}")
+
+    def _batch_response(self, reply):
+        """Response object of a batch job reply, as returned by _acall_llm"""
+        return reply
+
+    def _continuation(self, messages, partial):
+        """Messages asking the model to continue an interrupted reply"""
+        if not partial:
+            return messages
+        return messages + [{"role": "assistant", "content": partial}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+    def _prepare_messages(self, prompt, new_chat=False, stateless=False):
+        """Build the message list sent to the provider: the history (in chat mode) followed by the new prompt"""
+        if new_chat:
+            self.history = []
+        history = self.history if self.manage_history and not stateless else []
+        if self.history_manager is not None:
+            history = self.history_manager.compact(history)
+        else:
+            history = [{"role": message["role"], "content": message["content"]} for message in history]
+        return history + [{"role": "user", "content": prompt}]
+
+    def _record_reply(self, prompt, text):
+        """Append the exchange to the history when the agent manages it"""
+        if self.manage_history:
+            stage = CallPolicy.stats().stage
+            self.history += [{"role": "user", "content": prompt, "stage": stage},
+                             {"role": "assistant", "content": text, "stage": stage}]
+        return text
+
     @abstractmethod
-    def chat(self, prompt):
-        return self._call_llm(prompt)
+    def _call_llm(self, messages, timeout=None):
+        """Blocking call, given up by the client after timeout seconds"""
+        raise NotImplementedError()
 
     @abstractmethod
-    def _call_llm(self, prompt):
+    async def _acall_llm(self, messages):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _stream_llm(self, messages):
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def _astream_llm(self, messages):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _response_text(self, response):
         raise NotImplementedError()
 
 
 class GeminiAgent(Agent):
+    provider = "gemini"
     # google_models = set([
     #     "gemini-2.0-flash",
     #     "gemini-2.5-flash",
@@ -36,80 +297,129 @@ class GeminiAgent(Agent):
     #     "gemini-2.5-pro",
     # ])
 
-    def __init__(self, name, model, instructions, manage_history=False, tools=None):
-        Agent.__init__(self, name, model, instructions, tools)
-        self.agent_api = googleai.Client()
-        self.history = manage_history
-        self.current_chat = None
+    def __init__(self, name, model, instructions, manage_history=False, tools=None, response_cache=None,
+                 call_policy=None):
+        Agent.__init__(self, name, model, instructions, tools, manage_history, response_cache, call_policy)
         self.uploaded_pdfs = []
         self.uploaded_pdfs_paths = []
-        self.cache_file = Path(ROOT_DIR) / "data/cache/file_cache.json"
-        self._ensure_cache_directory()
-
-    def _ensure_cache_directory(self):
-        """Ensure the cache directory exists"""
-        cache_dir = self.cache_file.parent
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        if not self.cache_file.exists():
-            self._save_cache({})
-
-    def _load_cache(self):
-        """Load the file cache from disk"""
-        try:
-            with open(self.cache_file, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+        self.file_cache = FileCache(Path(CACHE_DIR) / "file_cache.json")
+        self.uploaded_pdfs_hashes = []
+        # Provider-side cached content holding the uploaded pdfs and the system instruction (see use_context_cache)
+        self.context_cache = None
+        self.context_cache_ttl = timedelta(hours=1)
+
+    def _uses_context_cache(self):
+        """A context cache only serves the model it was created for (the model can be changed between stages)"""
+        return self.context_cache is not None and self.context_cache['model'] == self.model
+
+    def _output_config(self):
+        """Structured-output settings of the requests (response_json_schema takes the pydantic JSON schema as is)"""
+        if self.response_schema is None:
             return {}
+        return {"response_mime_type": "application/json",
+                "response_json_schema": self.response_schema.model_json_schema()}
 
-    def _save_cache(self, cache_data):
-        """Save the file cache to disk"""
-        with open(self.cache_file, 'w') as f:
-            json.dump(cache_data, f, indent=2)
-
-    def _get_file_hash(self, path: Path):
-        """Get a unique identifier for a file based on path and modification time"""
-        stat = path.stat()
-        return f"{path.name}_{stat.st_size}_{stat.st_mtime}"
-
-    def chat(self, prompt, new_chat=False):
-        if self.history:
-            if self.current_chat is None or new_chat:
-                self.current_chat = self.agent_api.chats.create(
-                    model=self.model,
-                    config = googleai.types.GenerateContentConfig(
-                        system_instruction=self.instructions,
-                        temperature=0.0,
-                ))
-            return self._call_llm_chat(prompt).text
-        else:
-            return self._call_llm(prompt).text
-
-    def _call_llm(self, prompt, history=None):
-        messages = []
-        if len(self.uploaded_pdfs) > 0:
-            messages += self.uploaded_pdfs
-        if history is not None:
-            messages.append(history)
-        messages.append(prompt)
-        self.response = self.agent_api.models.generate_content(
+    def _config(self):
+        """Request config; the sync and async calls first refresh the context cache (see _refresh_context_cache)"""
+        if self._uses_context_cache():
+            return googleai.types.GenerateContentConfig(
+                cached_content=self.context_cache['name'],
+                temperature=0.0,
+                **self._output_config(),
+            )
+        return googleai.types.GenerateContentConfig(
+            system_instruction=self.instructions,
+            temperature=0.0,
+            **self._output_config(),
+        )
+
+    def _context_parts(self):
+        """Parts shared by every request: the uploaded pdfs and the shared context"""
+        parts = [googleai.types.Part.from_uri(file_uri=f.uri, mime_type=f.mime_type) for f in self.uploaded_pdfs]
+        if self.shared_context:
+            parts.append(googleai.types.Part.from_text(text=self._shared_context_text()))
+        return parts
+
+    def _contents(self, messages):
+        """Convert the messages to Gemini contents, attaching the shared context to the first user turn"""
+        contents = []
+        for message in messages:
+            parts = []
+            if not contents and not self._uses_context_cache():
+                parts += self._context_parts()
+            parts.append(googleai.types.Part.from_text(text=message["content"]))
+            role = "model" if message["role"] == "assistant" else "user"
+            contents.append(googleai.types.Content(role=role, parts=parts))
+        return contents
+
+    def _call_llm(self, messages, timeout=None):
+        self._refresh_context_cache()
+        config = self._config()
+        if timeout is not None:
+            config.http_options = googleai.types.HttpOptions(timeout=int(timeout * 1000))
+        return self.agent_api.models.generate_content(
+            model=self.model,
+            contents=self._contents(messages),
+            config=config,
+        )
+
+    async def _acall_llm(self, messages):
+        await self._arefresh_context_cache()
+        return await self.async_api.aio.models.generate_content(
             model=self.model,
-            contents=messages,
-            config=googleai.types.GenerateContentConfig(
-                system_instruction=self.instructions,
-                temperature=0.0
-            ))
-        return self.response
-
-    def _call_llm_chat(self, prompt):
-        messages = []
-        if len(self.uploaded_pdfs) > 0:
-            messages += self.uploaded_pdfs
-        messages += prompt
-        response = self.current_chat.send_message(messages)
-        self.response = response
-        return response
-
-    def load_pdfs(self, paths: str | Path | list[str] | list[Path], use_cache=True):
+            contents=self._contents(messages),
+            config=self._config(),
+        )
+
+    def _stream_llm(self, messages):
+        self._refresh_context_cache()
+        for chunk in self.agent_api.models.generate_content_stream(
+                model=self.model,
+                contents=self._contents(messages),
+                config=self._config(),
+        ):
+            self.response = chunk
+            if chunk.text:
+                yield chunk.text
+
+    async def _astream_llm(self, messages):
+        await self._arefresh_context_cache()
+        stream = await self.async_api.aio.models.generate_content_stream(
+            model=self.model,
+            contents=self._contents(messages),
+            config=self._config(),
+        )
+        async for chunk in stream:
+            self.response = chunk
+            if chunk.text:
+                yield chunk.text
+
+    def _batch_request(self, messages):
+        # The SDK moves the system instruction and the cached content of an inlined batch request out of the request
+        # itself, where the API ignores them: the instructions and the shared context open the first turn instead
+        contents = []
+        for message in messages:
+            parts = [] if contents else self._context_parts() + [googleai.types.Part.from_text(text=self.instructions)]
+            parts.append(googleai.types.Part.from_text(text=message["content"]))
+            role = "model" if message["role"] == "assistant" else "user"
+            contents.append(googleai.types.Content(role=role, parts=parts).model_dump(mode="json", exclude_none=True))
+        return {"contents": contents, "config": {"temperature": 0.0, **self._output_config()}}
+
+    def _response_text(self, response):
+        return response.text
+
+    def _usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return {}
+        return {"input_tokens": usage.prompt_token_count, "cached_tokens": usage.cached_content_token_count or 0,
+                "output_tokens": (usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0)}
+
+    def _attachment_hashes(self):
+        return list(self.uploaded_pdfs_hashes)
+
+    def load_pdfs(self, paths: str | Path | list[str] | list[Path], use_cache=True, max_workers=4, hashes=None):
+        """Attach pdfs to the requests, uploading those missing from the file cache. hashes: their SHA-256, if known"""
         if isinstance(paths, str):
             paths = [Path(paths)]
         if isinstance(paths, Path):
@@ -121,58 +431,145 @@ class GeminiAgent(Agent):
                 raise TypeError("paths must be str, Path or list of str, or list of Path")
         
         self.uploaded_pdfs_paths = paths
-        self.uploaded_pdfs = []
-        
-        cache = self._load_cache() if use_cache else {}
-        updated_cache = {}
-        
-        for path in paths:
-            file_hash = self._get_file_hash(path)
-            
-            # Check if file is in cache and still valid
-            if use_cache and file_hash in cache:
-                cached_entry = cache[file_hash]
-                try:
-                    # Try to get the file info to verify it still exists on Google's servers
-                    file_info = self.agent_api.files.get(name=cached_entry['file_name'])
-                    print(f"Using cached file: {path.name} (expires: {cached_entry.get('expires_at', 'N/A')})")
-                    self.uploaded_pdfs.append(file_info)
-                    updated_cache[file_hash] = cached_entry
-                    continue
-                except Exception as e:
-                    print(f"Cached file {path.name} no longer valid, re-uploading...")
-            
+        progress = {"done": 0}
+        progress_lock = threading.Lock()
+
+        def report(message):
+            with progress_lock:
+                progress["done"] += 1
+                print(f"[{progress['done']}/{len(unique_hashes)}] {message}")
+
+        def load_one(file_hash):
+            path = unique_hashes[file_hash]
+
+            # Entries that are not about to expire are trusted without asking Google's servers
+            cached_entry = self.file_cache.get(file_hash) if use_cache else None
+            if cached_entry is not None:
+                report(f"Using cached file: {path.name} (expires: {cached_entry['expires_at']})")
+                return googleai.types.File(name=cached_entry['file_name'], uri=cached_entry['uri'],
+                                           mime_type=cached_entry['mime_type']), None
+
             # Upload new file
-            print(f"Uploading: {path.name}")
             uploaded_file = self.agent_api.files.upload(file=path)
-            self.uploaded_pdfs.append(uploaded_file)
-            
-            # Store in cache
-            updated_cache[file_hash] = {
+            report(f"Uploaded: {path.name}")
+            expires_at = uploaded_file.expiration_time or datetime.now(timezone.utc) + timedelta(days=2)  # Files typically expire after 48 hours
+            cached_entry = {
                 'file_name': uploaded_file.name,
+                'uri': uploaded_file.uri,
+                'mime_type': uploaded_file.mime_type,
                 'path': str(path),
-                'uploaded_at': datetime.now().isoformat(),
-                'expires_at': (datetime.now() + timedelta(days=2)).isoformat()  # Files typically expire after 48 hours
+                'uploaded_at': datetime.now(timezone.utc).isoformat(),
+                'expires_at': expires_at.isoformat()
             }
-        
-        # Merge with existing cache entries that weren't accessed
-        for key, value in cache.items():
-            if key not in updated_cache:
-                updated_cache[key] = value
-        
-        self._save_cache(updated_cache)
+            return uploaded_file, cached_entry
+
+        # Hash the contents concurrently, so identical pdfs are uploaded (and cached) only once
+        workers = max(1, min(max_workers, len(paths)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self.uploaded_pdfs_hashes = list(hashes) if hashes is not None else list(executor.map(file_sha256, paths))
+            unique_hashes = {}
+            for file_hash, path in zip(self.uploaded_pdfs_hashes, paths):
+                unique_hashes.setdefault(file_hash, path)
+
+            # Cache checks and uploads run concurrently; results are mapped back in the same order as paths
+            loaded = dict(zip(unique_hashes, executor.map(load_one, unique_hashes)))
+
+        new_entries = {file_hash: entry for file_hash, (_, entry) in loaded.items() if entry is not None}
+        if new_entries:
+            self.file_cache.put_many(new_entries)
+        self.uploaded_pdfs = [loaded[file_hash][0] for file_hash in self.uploaded_pdfs_hashes]
+        # A context cache holds the previous materials
+        self.context_cache = None
         return self.uploaded_pdfs
 
+    def _context_cache_key(self):
+        request = {"model": self.model, "instructions": self.instructions, "attachments": self._attachment_hashes(),
+                   "shared_context": self.shared_context}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def use_context_cache(self, ttl=None):
+        """
+        Point the following calls to a provider-side cached content with the uploaded pdfs, the shared context and the
+        system instruction.
+
+        The cached content is shared through the file cache by every agent with the same model, instructions and
+        materials, and is reused while it is alive. If it can not be created (e.g. the materials are below the minimum
+        cacheable size) the agent keeps sending the context inline. Returns True if the context cache is in use.
+        """
+        if ttl is not None:
+            self.context_cache_ttl = ttl
+        key = self._context_cache_key()
+        entry = self.file_cache.get(key, section="contexts", margin=timedelta(minutes=5))
+        if entry is not None:
+            print(f"Using cached context: {entry['name']} (expires: {entry['expires_at']})")
+            self.context_cache = entry
+            return True
+
+        try:
+            cached_content = self.agent_api.caches.create(
+                model=self.model,
+                config=googleai.types.CreateCachedContentConfig(
+                    contents=[googleai.types.Content(role="user", parts=self._context_parts())],
+                    system_instruction=self.instructions,
+                    display_name=f"{self.name}-{key[:12]}",
+                    ttl=f"{int(self.context_cache_ttl.total_seconds())}s",
+                ))
+        except Exception as e:
+            print(f"Could not create context cache, sending the materials inline: {e}")
+            self.context_cache = None
+            return False
+
+        self.context_cache = self._store_context_cache(key, cached_content)
+        print(f"Created context cache: {cached_content.name} (expires: {self.context_cache['expires_at']})")
+        return True
+
+    def _store_context_cache(self, key, cached_content):
+        expires_at = cached_content.expire_time or datetime.now(timezone.utc) + self.context_cache_ttl
+        entry = {
+            'name': cached_content.name,
+            'model': self.model,
+            'files': self._attachment_hashes(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'expires_at': expires_at.isoformat()
+        }
+        self.file_cache.put(key, entry, section="contexts")
+        return entry
+
+    def _context_cache_expiring(self):
+        return self._uses_context_cache() and not self.file_cache.is_valid(self.context_cache, timedelta(minutes=5))
+
+    def _ttl_update(self):
+        return googleai.types.UpdateCachedContentConfig(ttl=f"{int(self.context_cache_ttl.total_seconds())}s")
+
+    def _refresh_context_cache(self):
+        """Extend the TTL of the context cache when it is about to expire"""
+        if self._context_cache_expiring():
+            cached_content = self.agent_api.caches.update(name=self.context_cache['name'], config=self._ttl_update())
+            self.context_cache = self._store_context_cache(self._context_cache_key(), cached_content)
+
+    async def _arefresh_context_cache(self):
+        """Async version of _refresh_context_cache, which does not block the event loop"""
+        if self._context_cache_expiring():
+            cached_content = await self.async_api.aio.caches.update(name=self.context_cache['name'],
+                                                                    config=self._ttl_update())
+            # The file cache is written under an inter-process lock, which must not be awaited on the event loop
+            self.context_cache = await asyncio.to_thread(self._store_context_cache, self._context_cache_key(),
+                                                         cached_content)
+
     def clear_cache(self):
-        """Clear the file cache and delete all cached files from Google's servers"""
-        cache = self._load_cache()
-        for file_hash, cached_entry in cache.items():
+        """Clear the file cache and delete all cached files and contexts from Google's servers"""
+        for key, cached_entry in self.file_cache.clear("contexts").items():
+            try:
+                self.agent_api.caches.delete(name=cached_entry['name'])
+                print(f"Deleted cached context: {cached_entry['name']}")
+            except Exception as e:
+                print(f"Could not delete {cached_entry['name']}: {e}")
+        for file_hash, cached_entry in self.file_cache.clear().items():
             try:
                 self.agent_api.files.delete(name=cached_entry['file_name'])
                 print(f"Deleted cached file: {cached_entry['path']}")
             except Exception as e:
                 print(f"Could not delete {cached_entry['path']}: {e}")
-        self._save_cache({})
 
     def __del__(self):
         # Don't delete files automatically - they're cached
@@ -181,6 +578,7 @@ class GeminiAgent(Agent):
 
 
 class AnthropicAgent(Agent):
+    provider = "anthropic"
     # anthropic_models = set([
     #     "claude-opus-4-1-20250805",
     #     "claude-opus-4-1",
@@ -199,38 +597,105 @@ class AnthropicAgent(Agent):
     #     "claude-3-opus-latest",
     #     "claude-3-haiku-20240307"])
 
-    def __init__(self, name, model, instructions, tools):
-        Agent.__init__(self, name, model, instructions, tools)
-        self.agent_api = Anthropic()
+    def __init__(self, name, model, instructions, tools, manage_history=False, response_cache=None, call_policy=None):
+        Agent.__init__(self, name, model, instructions, tools, manage_history, response_cache, call_policy)
+        # Anthropic requires a cap on the reply length: enough for a structured review report
+        self.max_tokens = 4096
+
+    def _request(self, messages):
+        request = dict(model=self.model, system=self.instructions,
+                       messages=self._with_shared_context(messages), max_tokens=self.max_tokens)
+        if self.response_schema is not None:
+            # Claude has no JSON mode: the reply is the input of a tool it is forced to call
+            request.update(tools=[{"name": self.response_schema.__name__, "input_schema":
+                                   self.response_schema.model_json_schema()}],
+                           tool_choice={"type": "tool", "name": self.response_schema.__name__})
+        return request
 
-    def chat(self, prompt):
-        return self._call_llm(prompt).content[0].text
+    def _call_llm(self, messages, timeout=None):
+        return self.agent_api.messages.create(**self._request(messages), timeout=timeout)
 
-    def _call_llm(self, prompt, history=None):
-        if history is None:
-            history = self.history
-        messages = [{"role": "system", "content": self.instructions}] + history + [{"role": "user", "content": prompt}]
-        return self.agent_api.messages.create(model=self.model_api, messages=messages, max_tokens=1000)
+    async def _acall_llm(self, messages):
+        return await self.async_api.messages.create(**self._request(messages))
 
+    def _stream_llm(self, messages):
+        with self.agent_api.messages.stream(**self._request(messages)) as stream:
+            yield from stream.text_stream
+            self.response = stream.get_final_message()
 
-class OpenAIAgent:
+    async def _astream_llm(self, messages):
+        async with self.async_api.messages.stream(**self._request(messages)) as stream:
+            async for text in stream.text_stream:
+                yield text
+            self.response = await stream.get_final_message()
 
-    def __init__(self, name, model, instructions, tools):
-        Agent.__init__(self, name, model, instructions, tools)
-        self.agent_api = OpenAI()
-        self.history = [{"role": "user", "content": None}]
+    def _response_text(self, response):
+        if self.response_schema is not None:
+            return next(json.dumps(block.input, ensure_ascii=False) for block in response.content
+                        if block.type == "tool_use")
+        return response.content[0].text
 
-    def chat(self, prompt):
-        return self._call_llm(prompt).choices[0].message.content
+    def _usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return {}
+        cached = usage.cache_read_input_tokens or 0
+        return {"input_tokens": usage.input_tokens + cached + (usage.cache_creation_input_tokens or 0),
+                "cached_tokens": cached, "output_tokens": usage.output_tokens}
 
-    def _call_llm(self, prompt, history=None):
-        messages = [{"role": "system", "content": self.instructions}]
-        if history is not None:
-            messages += history
-        messages += [{"role": "user", "content": prompt}]
-        self.response = self.agent_api.chat.completions.create(
+
+class OpenAIAgent(Agent):
+    provider = "openai"
+
+    def __init__(self, name, model, instructions, tools, manage_history=False, response_cache=None, call_policy=None):
+        Agent.__init__(self, name, model, instructions, tools, manage_history, response_cache, call_policy)
+
+    def _request(self, messages):
+        request = dict(
             model=self.model,
-            messages=messages,
+            messages=[{"role": "system", "content": self.instructions}] + self._with_shared_context(messages),
             temperature=0.0,
         )
-        return self.response
+        if self.response_schema is not None:
+            request["response_format"] = {"type": "json_schema", "json_schema": {
+                "name": self.response_schema.__name__, "schema": self.response_schema.model_json_schema(),
+                "strict": True}}
+        return request
+
+    def _call_llm(self, messages, timeout=None):
+        return self.agent_api.chat.completions.create(**self._request(messages), timeout=timeout)
+
+    async def _acall_llm(self, messages):
+        return await self.async_api.chat.completions.create(**self._request(messages))
+
+    def _stream_llm(self, messages):
+        for chunk in self.agent_api.chat.completions.create(**self._request(messages), stream=True,
+                                                            stream_options={"include_usage": True}):
+            self.response = chunk
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def _astream_llm(self, messages):
+        stream = await self.async_api.chat.completions.create(**self._request(messages), stream=True,
+                                                              stream_options={"include_usage": True})
+        async for chunk in stream:
+            self.response = chunk
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _batch_request(self, messages):
+        return self._request(messages)
+
+    def _batch_response(self, reply):
+        return ChatCompletion.model_validate(reply)
+
+    def _response_text(self, response):
+        return response.choices[0].message.content
+
+    def _usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return {}
+        details = usage.prompt_tokens_details
+        return {"input_tokens": usage.prompt_tokens, "cached_tokens": (details.cached_tokens or 0) if details else 0,
+                "output_tokens": usage.completion_tokens}
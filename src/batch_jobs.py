@@ -0,0 +1,186 @@
+# src/batch_jobs.py
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Dict
+
+from src.call_policy import is_retryable
+
+OPENAI_ENDPOINT = "/v1/chat/completions"
+OPENAI_FINISHED = {"completed", "failed", "expired", "cancelled"}
+GEMINI_FINISHED = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+def request_key(body: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Request:
+    body: Dict[str, Any]
+    key: str
+    future: asyncio.Future
+    on_submitted: Optional[Callable[[Dict[str, Any]], None]]
+
+
+class BatchCollector:
+    """
+    Collects chat requests, from the stages of many lessons, into provider batch jobs (OpenAI Batch API, Gemini batch
+    mode). Batch jobs cost about half as much and are outside of the real-time rate limits, but take minutes to hours.
+
+    Requests to the same model are submitted together once max_requests are waiting, or max_wait seconds after the
+    first one arrived. Jobs are polled with exponential backoff (poll_interval doubling up to max_poll_interval) until
+    they finish or timeout expires, and every request gets its own reply.
+    """
+    PROVIDERS = ("openai", "gemini")
+
+    def __init__(self, max_requests: int = 1000, max_wait: float = 60.0, poll_interval: float = 10.0,
+                 max_poll_interval: float = 300.0, timeout: float = 24 * 3600):
+        self.max_requests = max_requests
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.pending: Dict[tuple, list[_Request]] = {}
+        self.timers: Dict[tuple, asyncio.TimerHandle] = {}
+        # (provider, job) -> task polling the job, resolving to {request id: reply or exception}
+        self.jobs: Dict[tuple, asyncio.Task] = {}
+        self.tasks = set()
+
+    async def acall(self, client: Any, provider: str, model: str, body: Dict[str, Any],
+                    on_submitted: Optional[Callable[[Dict[str, Any]], None]] = None,
+                    submitted: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Reply to a request body (see Agent._batch_request): the body of a chat completion for OpenAI, a
+        GenerateContentResponse for Gemini. client is the async SDK client of the provider.
+
+        on_submitted receives the job and request ids once the request is in a job; passing them back as submitted
+        (e.g. after a restart) waits for that job instead of submitting the request again.
+        """
+        key = request_key(body)
+        if submitted and submitted.get("request") == key:
+            try:
+                results = await self._results(client, provider, submitted["job"])
+            except Exception as e:
+                print(f"Could not get the results of batch job {submitted['job']}: {e!r}")
+                results = {}
+            if submitted["request_id"] in results:
+                return self._reply(results[submitted["request_id"]])
+            # The job is gone or ended without this reply (e.g. it expired): the request is submitted again
+
+        loop = asyncio.get_running_loop()
+        group = (provider, model)
+        self.pending.setdefault(group, []).append(_Request(body, key, loop.create_future(), on_submitted))
+        request = self.pending[group][-1]
+        if len(self.pending[group]) >= self.max_requests:
+            self._flush(client, group)
+        elif group not in self.timers:
+            self.timers[group] = loop.call_later(self.max_wait, self._flush, client, group)
+        return self._reply(await request.future)
+
+    @staticmethod
+    def _reply(result: Any) -> Any:
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _flush(self, client: Any, group: tuple):
+        timer = self.timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        requests = self.pending.pop(group, [])
+        if requests:
+            task = asyncio.ensure_future(self._submit(client, *group, requests))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _submit(self, client: Any, provider: str, model: str, requests: list[_Request]):
+        job = None
+        try:
+            if provider == "openai":
+                job = await self._create_openai_job(client, requests)
+            else:
+                job = await self._create_gemini_job(client, model, requests)
+            print(f"Submitted {provider} batch job {job}: {len(requests)} requests to {model}")
+            for i, request in enumerate(requests):
+                if request.on_submitted is not None:
+                    request.on_submitted({"provider": provider, "model": model, "job": job, "request_id": str(i),
+                                          "request": request.key})
+            results = await self._results(client, provider, job)
+        except Exception as e:
+            results = {str(i): e for i in range(len(requests))}
+        for i, request in enumerate(requests):
+            if not request.future.done():
+                result = results.get(str(i))
+                request.future.set_result(RuntimeError(f"Batch job {job} has no reply for request {i}")
+                                          if result is None else result)
+
+    @staticmethod
+    async def _create_openai_job(client: Any, requests: list[_Request]) -> str:
+        lines = "".join(json.dumps({"custom_id": str(i), "method": "POST", "url": OPENAI_ENDPOINT,
+                                    "body": request.body}, ensure_ascii=False) + "\n"
+                        for i, request in enumerate(requests))
+        file = await client.files.create(file=("requests.jsonl", lines.encode("utf-8")), purpose="batch")
+        job = await client.batches.create(input_file_id=file.id, endpoint=OPENAI_ENDPOINT, completion_window="24h")
+        return job.id
+
+    @staticmethod
+    async def _create_gemini_job(client: Any, model: str, requests: list[_Request]) -> str:
+        job = await client.aio.batches.create(model=model, src=[request.body for request in requests],
+                                              config={"display_name": f"class-notes-{len(requests)}-requests"})
+        return job.name
+
+    async def _results(self, client: Any, provider: str, job: str) -> Dict[str, Any]:
+        """Replies of a job, polled once however many requests wait for it"""
+        if (provider, job) not in self.jobs:
+            self.jobs[(provider, job)] = asyncio.ensure_future(self._poll(client, provider, job))
+        return await asyncio.shield(self.jobs[(provider, job)])
+
+    async def _poll(self, client: Any, provider: str, job: str) -> Dict[str, Any]:
+        deadline = time.monotonic() + self.timeout
+        interval = self.poll_interval
+        while True:
+            try:
+                if provider == "openai":
+                    batch = await client.batches.retrieve(job)
+                    if batch.status in OPENAI_FINISHED:
+                        return await self._openai_results(client, batch)
+                else:
+                    batch = await client.aio.batches.get(name=job)
+                    if batch.state in GEMINI_FINISHED:
+                        return self._gemini_results(batch)
+            except Exception as e:
+                # A failed status check is retried at the next poll; the job itself is unaffected
+                if not is_retryable(e):
+                    raise
+            if time.monotonic() + interval > deadline:
+                raise TimeoutError(f"Batch job {job} did not finish within {self.timeout:.0f}s")
+            await asyncio.sleep(interval)
+            interval = min(self.max_poll_interval, interval * 2)
+
+    @staticmethod
+    async def _openai_results(client: Any, batch: Any) -> Dict[str, Any]:
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    error = item.get("error") or response.get("body")
+                    results[item["custom_id"]] = RuntimeError(f"Batch request failed: {error}")
+                else:
+                    results[item["custom_id"]] = response["body"]
+        return results
+
+    @staticmethod
+    def _gemini_results(batch: Any) -> Dict[str, Any]:
+        responses = (batch.dest.inlined_responses if batch.dest is not None else None) or []
+        return {str(i): item.response if item.error is None else RuntimeError(f"Batch request failed: {item.error}")
+                for i, item in enumerate(responses)}
@@ -0,0 +1,232 @@
+# src/call_policy.py
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional, Dict
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+@dataclass
+class CallStats:
+    """Counters of the provider calls made while running a stage"""
+    stage: Optional[str] = None
+    calls: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    failures: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {key: value for key, value in asdict(self).items() if key != "stage"}
+
+
+# Stats of the stage running in the current task (see track_stage); calls outside of a stage are not counted
+_current_stats: ContextVar[Optional[CallStats]] = ContextVar("call_stats", default=None)
+
+
+@contextmanager
+def track_stage(stage: str):
+    """Count the calls made in this context (and in the tasks it starts) towards stage"""
+    stats = CallStats(stage)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def is_timeout(error: BaseException) -> bool:
+    """A deadline of the policy, or a timeout of the SDK clients (blocking calls)"""
+    import anthropic
+    import httpx
+    import openai
+
+    return isinstance(error, (TimeoutError, openai.APITimeoutError, anthropic.APITimeoutError, httpx.TimeoutException))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Rate limits, server errors, timeouts and connection failures are worth retrying; bad requests are not"""
+    # Imported here so that the pipeline state and scheduler modules stay importable without loading the SDKs
+    import anthropic
+    import openai
+    from google.genai import errors as genai_errors
+
+    if is_timeout(error):
+        return True
+    if isinstance(error, (ConnectionError, openai.APIConnectionError, anthropic.APIConnectionError)):
+        return True
+    if isinstance(error, (openai.APIStatusError, anthropic.APIStatusError)):
+        return error.status_code in RETRYABLE_STATUS
+    if isinstance(error, genai_errors.APIError):
+        return error.code in RETRYABLE_STATUS
+    return False
+
+
+def _discard(task: asyncio.Future):
+    """Retrieve the outcome of an abandoned task, so that asyncio does not log its error as never retrieved"""
+    if not task.cancelled():
+        task.exception()
+
+
+class CallPolicy:
+    """
+    Timeouts, retries and hedging shared by the provider calls of the agents.
+
+    Every attempt has a deadline (per stage in stage_timeouts, timeout otherwise); retryable failures are retried with
+    exponential backoff and full jitter. With hedge=True, a call that has not answered after the hedge_quantile of the
+    recent latencies of its key (stage and model) gets a duplicate request, and whichever answers first wins. A policy
+    can be shared by several agents and lessons, so that the hedging thresholds are learned from all their calls.
+    """
+
+    def __init__(self, timeout: float = 300.0, stage_timeouts: Optional[Dict[str, float]] = None, max_retries: int = 4,
+                 base_delay: float = 1.0, max_delay: float = 30.0, hedge: bool = False, hedge_quantile: float = 0.9,
+                 hedge_min_samples: int = 5, history_size: int = 100):
+        self.timeout = timeout
+        self.stage_timeouts = dict(stage_timeouts or {})
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.history_size = history_size
+        # Recent latencies of the calls, per key (e.g. stage and model)
+        self.latencies: Dict[Hashable, deque] = {}
+
+    @staticmethod
+    def stats() -> CallStats:
+        """Stats of the current stage (a throwaway object outside of a stage)"""
+        return _current_stats.get() or CallStats()
+
+    @classmethod
+    def _count(cls, call_stats: Optional[CallStats], counter: str):
+        """Increment a counter of the current stage and of the call"""
+        for stats in (cls.stats(), call_stats):
+            if stats is not None:
+                setattr(stats, counter, getattr(stats, counter) + 1)
+
+    def attempt_timeout(self) -> float:
+        return self.stage_timeouts.get(self.stats().stage, self.timeout)
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: a random delay up to the exponential bound, so that concurrent callers spread out"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def record_latency(self, key: Hashable, seconds: float):
+        self.latencies.setdefault(key, deque(maxlen=self.history_size)).append(seconds)
+
+    def hedge_delay(self, key: Hashable) -> Optional[float]:
+        """Seconds after which a call is hedged, or None while there are too few samples"""
+        samples = sorted(self.latencies.get(key, ()))
+        if not self.hedge or len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(self.hedge_quantile * len(samples)))]
+
+    def _should_retry(self, error: BaseException, attempt: int, call_stats: Optional[CallStats]) -> bool:
+        if is_timeout(error):
+            self._count(call_stats, "timeouts")
+        if attempt >= self.max_retries or not is_retryable(error):
+            self._count(call_stats, "failures")
+            return False
+        self._count(call_stats, "retries")
+        return True
+
+    async def _hedged(self, key: Hashable, make_call: Callable[[], Awaitable[Any]],
+                      call_stats: Optional[CallStats]) -> Any:
+        """One attempt: the call, plus a duplicate request if it is slower than usual"""
+        start = time.monotonic()
+        deadline = start + self.attempt_timeout()
+        tasks = [asyncio.ensure_future(make_call())]
+        hedge_delay = self.hedge_delay(key)
+        try:
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=min(hedge_delay, self.attempt_timeout()))
+                if not done and time.monotonic() < deadline:
+                    self._count(call_stats, "hedges")
+                    tasks.append(asyncio.ensure_future(make_call()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f"No answer within {self.attempt_timeout():.0f}s")
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self._count(call_stats, "hedge_wins")
+                        self.record_latency(key, time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+            # Both the call and its hedge failed
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+                # The loser may still fail while it is cancelled: its error is of no interest
+                task.add_done_callback(_discard)
+
+    async def acall(self, key: Hashable, make_call: Callable[[], Awaitable[Any]],
+                    call_stats: Optional[CallStats] = None) -> Any:
+        """
+        Await a provider call under the policy.
+
+        key groups the calls whose latencies are comparable (e.g. the stage and the model). make_call creates a new
+        request at every attempt, including the duplicate request of a hedge. The counters of this call alone are also
+        added to call_stats, if given.
+        """
+        self._count(call_stats, "calls")
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._hedged(key, make_call, call_stats)
+            except Exception as e:
+                if not self._should_retry(e, attempt, call_stats):
+                    raise
+            await asyncio.sleep(self.backoff(attempt))
+
+    def call(self, make_call: Callable[[float], Any], call_stats: Optional[CallStats] = None) -> Any:
+        """
+        Blocking version of acall, without hedging. A blocking call can not be interrupted: make_call receives the
+        attempt timeout, for the client to give up after it
+        """
+        self._count(call_stats, "calls")
+        for attempt in range(self.max_retries + 1):
+            try:
+                return make_call(self.attempt_timeout())
+            except Exception as e:
+                if not self._should_retry(e, attempt, call_stats):
+                    raise
+            time.sleep(self.backoff(attempt))
+
+    async def astream(self, make_stream: Callable[[], AsyncIterator[str]],
+                      call_stats: Optional[CallStats] = None) -> AsyncIterator[str]:
+        """
+        Iterate over a streamed reply under the policy.
+
+        Each chunk must arrive within the attempt timeout. After a retryable failure make_stream is called again: it is
+        expected to continue from the text received so far (see Agent._continuation).
+        """
+        self._count(call_stats, "calls")
+        attempt = 0
+        while True:
+            stream = make_stream()
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(anext(stream), self.attempt_timeout())
+                    except StopAsyncIteration:
+                        return
+                    yield chunk
+            except Exception as e:
+                if not self._should_retry(e, attempt, call_stats):
+                    raise
+            finally:
+                await stream.aclose()
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
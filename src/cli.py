@@ -0,0 +1,194 @@
+# src/cli.py
+import argparse
+import sys
+from pathlib import Path
+
+from config.definitions import ROOT_DIR, STATE_DB
+from src.pipeline_manager import PipelineManager, import_json_states
+from src.state_store import SQLiteStateStore
+
+# Only the light modules are imported at the top: main is imported by each command, and the provider SDKs only by the
+# commands that build agents (run, batch, clear-cache)
+
+
+def output_folder(args):
+    if args.output_folder:
+        return Path(args.output_folder)
+    return Path(ROOT_DIR) / f"data/output/module {args.module:03}"
+
+
+def model_router(args):
+    """One router for the whole command, so that every lesson learns from the calls of the others"""
+    if not args.route_models:
+        return None
+    from src.model_router import DEFAULT_ROUTES, ModelRouter
+
+    return ModelRouter(DEFAULT_ROUTES)
+
+
+def run(args):
+    import main as pipeline
+
+    pipeline.generate_handout(args.lesson, args.module, resume=not args.no_resume, input_folder=args.input_folder,
+                              output_folder=output_folder(args), manage_history=not args.stateless,
+                              cache_responses=args.cache_responses, context_cache=not args.no_context_cache,
+                              parallel_sections=args.parallel_sections, passages_per_section=args.passages,
+                              wandb_project=args.wandb_project, model_router=model_router(args),
+                              patch_edits=not args.rewrite_final, structured_reviews=not args.free_form_reviews,
+                              history_budget=args.history_budget)
+
+
+def batch(args):
+    import main as pipeline
+
+    lessons = pipeline.find_lessons(module_nums=args.modules)
+    if not lessons:
+        print("No lesson materials found under data/input")
+        return 1
+    batch_collector = None
+    if args.batch_api:
+        from src.batch_jobs import BatchCollector
+
+        # Lessons waiting for a batch job let the others run, so that their reviews and editing instructions share
+        # the same batch jobs within the --workers limit
+        batch_collector = BatchCollector()
+    results = pipeline.generate_handouts(lessons, max_workers=args.workers, resume=not args.no_resume,
+                                         manage_history=not args.stateless, cache_responses=args.cache_responses,
+                                         parallel_sections=args.parallel_sections, wandb_project=args.wandb_project,
+                                         model_router=model_router(args), batch_collector=batch_collector,
+                                         patch_edits=not args.rewrite_final,
+                                         structured_reviews=not args.free_form_reviews,
+                                         history_budget=args.history_budget)
+    return 1 if any(error is not None for error in results.values()) else 0
+
+
+def status(args):
+    import main as pipeline
+
+    pipeline.show_pipeline_status(args.lesson, args.module, output_folder(args))
+
+
+def reset(args):
+    import main as pipeline
+
+    pipeline.reset_pipeline(args.lesson, args.module, args.from_stage, output_folder(args))
+
+
+def clear_cache(args):
+    import main as pipeline
+
+    pipeline.clear_cache()
+
+
+def prompts(args):
+    import main as pipeline
+
+    pipeline.show_prompt_templates()
+
+
+def state_store(args):
+    if not args.state_db:
+        raise SystemExit("No state database: pass --state-db or set CLASS_NOTES_STATE_DB")
+    return SQLiteStateStore(Path(args.state_db))
+
+
+def lessons(args):
+    store = state_store(args)
+    if args.stage or args.status:
+        for row in store.stages(module_num=args.module, stage=args.stage, status=args.status):
+            print(f"module {row['module_num']}, lesson {row['lesson_num']}: {row['stage']} {row['status']}"
+                  f" (run {row['run_id'] or '-'}, updated {row['completed_at'] or row['started_at'] or '-'})"
+                  f"  {row['output_dir']}")
+        return
+    for row in store.lessons(module_num=args.module, next_stage=args.next_stage):
+        print(f"module {row['module_num']}, lesson {row['lesson_num']}: next {row['next_stage'] or 'none (done)'}"
+              f" (updated {row['last_updated']})  {row['output_dir']}")
+
+
+def import_state(args):
+    imported = import_json_states(state_store(args), Path(args.output_root))
+    print(f"Imported {imported} lesson states")
+
+
+def add_lesson_arguments(parser):
+    parser.add_argument("module", type=int, help="Module number")
+    parser.add_argument("lesson", type=int, help="Lesson number")
+    parser.add_argument("--output-folder", help="Pipeline folder (default: data/output/module NNN)")
+
+
+def add_generation_arguments(parser):
+    parser.add_argument("--no-resume", action="store_true", help="Start from scratch instead of the last checkpoint")
+    parser.add_argument("--stateless", action="store_true", help="Don't keep the teacher chat history across stages")
+    parser.add_argument("--history-budget", type=int, default=32_000,
+                        help="Estimated tokens of teacher chat history sent with each request (default: 32000)")
+    parser.add_argument("--cache-responses", action="store_true", help="Answer identical requests from the disk cache")
+    parser.add_argument("--parallel-sections", action="store_true", help="Write the handout drafts section by section")
+    parser.add_argument("--wandb-project", help="Also log the telemetry of the agent calls to this wandb project")
+    parser.add_argument("--rewrite-final", action="store_true",
+                        help="Have the teacher rewrite the whole handout in the final stage instead of editing the draft")
+    parser.add_argument("--free-form-reviews", action="store_true",
+                        help="Free-form reviews and editing notes, without issue severities (no revision is skipped)")
+    parser.add_argument("--route-models", action="store_true",
+                        help="Choose the model of each stage from the prompt size and the observed latencies and errors")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="class-notes", description="Distill lesson materials into handouts")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("run", help="Generate the handout of a lesson")
+    add_lesson_arguments(command)
+    add_generation_arguments(command)
+    command.add_argument("--input-folder", type=Path, help="Lesson materials (default: data/input/...)")
+    command.add_argument("--no-context-cache", action="store_true", help="Send the materials with every teacher call")
+    command.add_argument("--passages", type=int, default=3,
+                         help="Retrieved passages per summary section for the reviewer and the editor (0 to disable)")
+    command.set_defaults(handler=run)
+
+    command = commands.add_parser("batch", help="Generate the handouts of every lesson under data/input concurrently")
+    add_generation_arguments(command)
+    command.add_argument("--modules", type=int, nargs="+", help="Only these modules")
+    command.add_argument("--workers", type=int, default=4, help="Lessons generated at the same time")
+    command.add_argument("--batch-api", action="store_true",
+                         help="Send the reviews and editing instructions through OpenAI/Gemini batch jobs: half the "
+                              "cost, but replies can take hours (lessons waiting for a job let the next ones start)")
+    command.set_defaults(handler=batch)
+
+    command = commands.add_parser("status", help="Show the stages, timings and costs of a lesson pipeline")
+    add_lesson_arguments(command)
+    command.set_defaults(handler=status)
+
+    command = commands.add_parser("reset", help="Reset a lesson pipeline, completely or from a stage onwards")
+    add_lesson_arguments(command)
+    command.add_argument("--from-stage", choices=PipelineManager.STAGES, help="First stage to reset")
+    command.set_defaults(handler=reset)
+
+    command = commands.add_parser("lessons", help="Query the lessons of the state database")
+    command.add_argument("--state-db", default=STATE_DB, help="SQLite state database (default: CLASS_NOTES_STATE_DB)")
+    command.add_argument("--module", type=int, help="Only this module")
+    command.add_argument("--next-stage", choices=PipelineManager.STAGES, help="Lessons whose next stage is this one")
+    command.add_argument("--stage", choices=PipelineManager.STAGES, help="List the runs of this stage instead")
+    command.add_argument("--status", choices=["pending", "running", "completed"], help="List stages in this status")
+    command.set_defaults(handler=lessons)
+
+    command = commands.add_parser("import-state", help="Copy the JSON lesson state files into the state database")
+    command.add_argument("--state-db", default=STATE_DB, help="SQLite state database (default: CLASS_NOTES_STATE_DB)")
+    command.add_argument("--output-root", default=str(Path(ROOT_DIR) / "data/output"),
+                         help="Folder searched for state files")
+    command.set_defaults(handler=import_state)
+
+    command = commands.add_parser("clear-cache", help="Delete the cached files and contexts, locally and on Gemini")
+    command.set_defaults(handler=clear_cache)
+
+    command = commands.add_parser("prompts", help="Validate the prompt templates and show their size")
+    command.set_defaults(handler=prompts)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.handler(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
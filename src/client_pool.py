@@ -0,0 +1,116 @@
+# src/client_pool.py
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Iterable
+
+import httpx
+
+# Connections kept open between calls: the stages of a lesson, and the lessons of a batch, reuse them instead of paying
+# a TLS handshake per agent
+POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=120)
+
+# Environment variables identifying the account and endpoint of each provider: one client per distinct combination
+CREDENTIAL_VARIABLES = {
+    "openai": ("OPENAI_API_KEY", "OPENAI_BASE_URL", "OPENAI_ORG_ID"),
+    "anthropic": ("ANTHROPIC_API_KEY", "ANTHROPIC_BASE_URL"),
+    "gemini": ("GOOGLE_API_KEY", "GEMINI_API_KEY", "GOOGLE_GEMINI_BASE_URL"),
+}
+
+_lock = threading.Lock()
+_sync_clients: dict[tuple, Any] = {}
+# Async clients hold connections bound to the event loop that opened them, so they are kept per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, Any]]" = weakref.WeakKeyDictionary()
+
+
+def _key(provider: str) -> tuple:
+    if provider not in CREDENTIAL_VARIABLES:
+        raise ValueError(f"Unknown provider: {provider}")
+    return (provider,) + tuple(os.getenv(variable) for variable in CREDENTIAL_VARIABLES[provider])
+
+
+def _build(provider: str, is_async: bool) -> Any:
+    # The SDKs are imported on first use, so that the commands not calling the providers start quickly.
+    # Their own retries are disabled: the agents retry through their CallPolicy
+    if provider == "openai":
+        import openai
+
+        if is_async:
+            return openai.AsyncOpenAI(max_retries=0, http_client=openai.DefaultAsyncHttpxClient(limits=POOL_LIMITS))
+        return openai.OpenAI(max_retries=0, http_client=openai.DefaultHttpxClient(limits=POOL_LIMITS))
+    if provider == "anthropic":
+        import anthropic
+
+        if is_async:
+            return anthropic.AsyncAnthropic(max_retries=0,
+                                            http_client=anthropic.DefaultAsyncHttpxClient(limits=POOL_LIMITS))
+        return anthropic.Anthropic(max_retries=0, http_client=anthropic.DefaultHttpxClient(limits=POOL_LIMITS))
+    import google.genai as googleai
+
+    # A Gemini client carries both APIs (client.aio for the async one)
+    return googleai.Client(http_options=googleai.types.HttpOptions(client_args={"limits": POOL_LIMITS},
+                                                                   async_client_args={"limits": POOL_LIMITS}))
+
+
+def get_client(provider: str) -> Any:
+    """Process-wide blocking client of a provider, for the current credentials"""
+    key = _key(provider)
+    with _lock:
+        if key not in _sync_clients:
+            _sync_clients[key] = _build(provider, is_async=False)
+        return _sync_clients[key]
+
+
+def get_async_client(provider: str) -> Any:
+    """Async client of a provider shared by everything running on the current event loop"""
+    key = _key(provider)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        if key not in clients:
+            clients[key] = _build(provider, is_async=True)
+        return clients[key]
+
+
+async def aclose():
+    """
+    Close the async clients opened on the current event loop and the blocking clients, e.g. before the program or
+    the loop stops. Later calls open new clients
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        async_clients = list(_async_clients.pop(loop, {}).items())
+        sync_clients = list(_sync_clients.values())
+        _sync_clients.clear()
+    for (provider, *_), client in async_clients:
+        if provider == "gemini":
+            await client.aio.aclose()
+            client.close()
+        else:
+            await client.close()
+    for client in sync_clients:
+        client.close()
+
+
+async def _ping(provider: str):
+    client = get_async_client(provider)
+    if provider == "openai":
+        await client.models.list()
+    elif provider == "anthropic":
+        await client.models.list(limit=1)
+    else:
+        await client.aio.models.list(config={"page_size": 1})
+
+
+async def warm_up(providers: Iterable[str], timeout: float = 10.0):
+    """
+    Open a connection to each provider with a cheap request, so that the first real calls skip the handshakes.
+    Failures are ignored: the calls will report them.
+    """
+    providers = list(providers)
+    results = await asyncio.gather(*(asyncio.wait_for(_ping(provider), timeout) for provider in providers),
+                                   return_exceptions=True)
+    for provider, result in zip(providers, results):
+        if isinstance(result, Exception):
+            print(f"Could not warm up the {provider} connection: {result!r}")
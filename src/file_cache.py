@@ -0,0 +1,129 @@
+# src/file_cache.py
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional, Dict, Any
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def file_sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of the file contents, read in chunks so large pdfs are never held in memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Parse an ISO timestamp, treating naive values as local time"""
+    if not value:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.astimezone()
+
+
+class FileCache:
+    """
+    Content-addressed cache of the files uploaded to a provider.
+
+    Entries are keyed by the SHA-256 of the file contents and stored in one JSON file. Every write happens under an
+    inter-process lock and replaces the file atomically, so several workers can share the same cache. Entries whose
+    expires_at falls within expiry_margin are treated as missing, and expired entries are evicted on the next write.
+    """
+
+    def __init__(self, cache_file: Path, expiry_margin: timedelta = timedelta(hours=1)):
+        self.cache_file = Path(cache_file)
+        self.lock_file = self.cache_file.with_name(self.cache_file.name + ".lock")
+        self.expiry_margin = expiry_margin
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the cache across processes"""
+        with open(self.lock_file, 'a+') as lock:
+            if fcntl:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _read(self) -> dict[str, Any]:
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        # Entries written by the old name/size/mtime cache can not be mapped to content hashes and are dropped
+        return {section: entries for section, entries in data.items()
+                if isinstance(entries, dict) and "file_name" not in entries}
+
+    def _write(self, data: dict[str, Any]):
+        """Write the cache to a temporary file and atomically move it in place"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_file.parent, prefix=self.cache_file.name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.cache_file)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def is_valid(self, entry: Dict[str, Any], margin: Optional[timedelta] = None) -> bool:
+        """Check that an entry does not expire within the safety margin"""
+        if margin is None:
+            margin = self.expiry_margin
+        expires_at = parse_timestamp(entry.get("expires_at"))
+        return expires_at is not None and expires_at > datetime.now(timezone.utc) + margin
+
+    def _evict(self, data: dict[str, Any]):
+        """Drop the expired entries of every section"""
+        for entries in data.values():
+            for key in [key for key, entry in entries.items() if not self.is_valid(entry, timedelta(0))]:
+                del entries[key]
+
+    def update(self, updater: Callable[[dict[str, Any]], Any]):
+        """Apply updater to the cache contents under the lock, evict expired entries and save"""
+        with self._locked():
+            data = self._read()
+            result = updater(data)
+            self._evict(data)
+            self._write(data)
+        return result
+
+    def get(self, key: str, section: str = "files", margin: Optional[timedelta] = None) -> Optional[Dict[str, Any]]:
+        """Return a still valid entry, without contacting the provider"""
+        entry = self._read().get(section, {}).get(key)
+        if entry is not None and self.is_valid(entry, margin):
+            return entry
+        return None
+
+    def put(self, key: str, entry: Dict[str, Any], section: str = "files"):
+        self.put_many({key: entry}, section)
+
+    def put_many(self, entries: Dict[str, Dict[str, Any]], section: str = "files"):
+        self.update(lambda data: data.setdefault(section, {}).update(entries))
+
+    def clear(self, section: str = "files") -> Dict[str, Dict[str, Any]]:
+        """Remove all the entries of a section and return them"""
+        return self.update(lambda data: data.pop(section, {}))
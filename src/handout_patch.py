@@ -0,0 +1,90 @@
+# src/handout_patch.py
+import re
+from typing import Annotated, Literal, Union
+
+from pydantic import BaseModel, Field, ValidationError
+
+from src.handout_sections import HEADING
+
+
+class PatchError(ValueError):
+    """Edits that are malformed or do not match the handout they should be applied to"""
+
+
+class ReplaceText(BaseModel):
+    """Replace a passage quoted from the handout; an empty replacement deletes it"""
+    op: Literal["replace"]
+    find: str = Field(min_length=1)
+    replace: str
+
+
+class ReplaceSection(BaseModel):
+    """Replace a whole section, from its heading to the next heading of the same or a higher level"""
+    op: Literal["replace_section"]
+    heading: str = Field(min_length=1)
+    content: str
+
+
+class HandoutPatch(BaseModel):
+    """Edits to a handout, applied in order; no edits means the handout is fine as it is"""
+    edits: list[Annotated[Union[ReplaceText, ReplaceSection], Field(discriminator="op")]]
+
+
+def parse_patch(reply: str) -> HandoutPatch:
+    """Validate the edits of a model reply: a JSON object, possibly wrapped in a fenced code block"""
+    text = reply.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        return HandoutPatch.model_validate_json(text)
+    except ValidationError as e:
+        error = e.errors()[0]
+        raise PatchError(f"invalid edits ({e.error_count()} errors, first at {error['loc']}: {error['msg']})") from e
+
+
+def _find(handout: str, passage: str) -> list[tuple[int, int]]:
+    """Spans of a passage in the handout: exact matches, else matches ignoring differences in whitespace"""
+    spans = [(match.start(), match.end()) for match in re.finditer(re.escape(passage), handout)]
+    if spans or not passage.strip():
+        return spans
+    loose = r"\s+".join(re.escape(word) for word in passage.split())
+    return [(match.start(), match.end()) for match in re.finditer(loose, handout)]
+
+
+def _section(handout: str, heading: str) -> tuple[int, int]:
+    """Span of the section under a heading, given with or without its leading #"""
+    match = HEADING.match(heading.strip())
+    title = match.group(2) if match else heading.strip()
+    lines = handout.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    headings = [(i, len(match.group(1)), match.group(2)) for i, line in enumerate(lines)
+                if (match := HEADING.match(line))]
+    found = [(position, level) for position, (i, level, text) in enumerate(headings) if text == title]
+    if len(found) != 1:
+        raise PatchError(f"the heading '{title}' appears {len(found)} times in the handout")
+    position, level = found[0]
+    end = next((i for i, other_level, _ in headings[position + 1:] if other_level <= level), len(lines))
+    return offsets[headings[position][0]], offsets[end]
+
+
+def apply_patch(handout: str, patch: HandoutPatch) -> str:
+    """Apply the edits in order, raising PatchError when one does not match exactly one place of the handout"""
+    for number, edit in enumerate(patch.edits, start=1):
+        if isinstance(edit, ReplaceText):
+            spans = _find(handout, edit.find)
+            if len(spans) != 1:
+                raise PatchError(f"edit {number}: the text to replace appears {len(spans)} times in the handout")
+            (start, end), replacement = spans[0], edit.replace
+        else:
+            try:
+                start, end = _section(handout, edit.heading)
+            except PatchError as e:
+                raise PatchError(f"edit {number}: {e}") from e
+            replacement = edit.content
+            # The following heading stays on its own line
+            if end < len(handout):
+                replacement = replacement.rstrip("\n") + "\n\n"
+        handout = handout[:start] + replacement + handout[end:]
+    return handout
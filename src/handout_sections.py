@@ -0,0 +1,59 @@
+# src/handout_sections.py
+import re
+from collections import Counter
+
+HEADING = re.compile(r"^(#{1,6})\s+(.*\S)\s*$")
+# Label of the figure placeholders the notes prompts ask for ([Figura <number>: <title>. <caption>]). The prompts fix it
+# whatever the lesson language: a template asking for another label must pass it to renumber_figures
+FIGURE_LABEL = "Figura"
+
+
+def figure_pattern(label: str) -> re.Pattern:
+    return re.compile(rf"({re.escape(label)}\s+)(\d+)")
+
+
+def split_sections(markdown: str) -> tuple[str, list[tuple[str, str]]]:
+    """
+    Split a Markdown document into its top-level sections.
+
+    The section level is the shallowest heading level used more than once (the lesson title is usually the only level 1
+    heading). Returns the text before the first section and a list of (section title, section text) pairs; the list is
+    empty when the document has less than two sections.
+    """
+    lines = markdown.splitlines(keepends=True)
+    levels = Counter(len(match.group(1)) for line in lines if (match := HEADING.match(line)))
+    repeated = sorted(level for level, count in levels.items() if count > 1)
+    if not repeated:
+        return markdown, []
+
+    level = repeated[0]
+    preamble, sections = [], []
+    for line in lines:
+        match = HEADING.match(line)
+        if match and len(match.group(1)) == level:
+            sections.append((match.group(2), [line]))
+        elif sections:
+            sections[-1][1].append(line)
+        else:
+            preamble.append(line)
+    return "".join(preamble), [(title, "".join(section)) for title, section in sections]
+
+
+def renumber_figures(sections: list[str], label: str = FIGURE_LABEL) -> list[str]:
+    """
+    Number the figures of independently written sections consecutively.
+
+    Each section numbers its figures on its own; references to a figure inside the same section follow its new number.
+    Figures are found by their label ("Figura 3").
+    """
+    figure = figure_pattern(label)
+    renumbered = []
+    next_number = 1
+    for section in sections:
+        mapping = {}
+        for match in figure.finditer(section):
+            if match.group(2) not in mapping:
+                mapping[match.group(2)] = str(next_number)
+                next_number += 1
+        renumbered.append(figure.sub(lambda match: match.group(1) + mapping[match.group(2)], section))
+    return renumbered
@@ -0,0 +1,67 @@
+# src/history_manager.py
+from typing import Any, Optional, Dict
+
+from src.prompt_registry import estimate_tokens
+
+
+class HistoryManager:
+    """
+    Bounds the chat history an agent sends with each request (see Agent.history_manager).
+
+    Exchanges are tagged with the stage that made them. Once a later stage has replaced the artifact of an earlier one
+    (supersedes maps a stage to the stage replacing it, e.g. the first draft to the revised summary), the earlier
+    exchange is collapsed to a short note. If the history still exceeds max_tokens, the oldest exchanges are collapsed
+    too, except the keep_recent most recent ones. The materials and the lesson request are not part of the history
+    (they travel in the shared context), so they are always kept.
+
+    The agent history itself is left intact: compaction only applies to the messages sent.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = 32_000, supersedes: Optional[Dict[str, str]] = None,
+                 keep_recent: int = 1):
+        self.max_tokens = max_tokens
+        self.supersedes = supersedes or {}
+        self.keep_recent = keep_recent
+
+    @staticmethod
+    def _exchanges(history: list[Dict[str, Any]]) -> list[list[Dict[str, Any]]]:
+        """Group the history in exchanges: a user message followed by the replies to it"""
+        exchanges = []
+        for message in history:
+            if message["role"] == "user" or not exchanges:
+                exchanges.append([])
+            exchanges[-1].append(message)
+        return exchanges
+
+    @staticmethod
+    def _collapsed(exchange: list[Dict[str, Any]], reason: str) -> list[Dict[str, Any]]:
+        stage = exchange[0].get("stage") or "an earlier step"
+        return [{"role": message["role"],
+                 "content": f"[Request of {stage} omitted: {reason}]" if message["role"] == "user"
+                 else f"[Reply of {stage} (~{estimate_tokens(message['content'])} tokens) omitted: {reason}]"}
+                for message in exchange]
+
+    def compact(self, history: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
+        """Messages to send for a history, as plain {"role", "content"} dicts"""
+        exchanges = self._exchanges(history)
+        # Exchanges made outside of a stage have no stage, and are never superseded
+        stages = {exchange[0].get("stage") for exchange in exchanges} - {None}
+        compacted, collapsed = [], set()
+        for i, exchange in enumerate(exchanges):
+            later = self.supersedes.get(exchange[0].get("stage"))
+            if later in stages:
+                compacted.append(self._collapsed(exchange, f"superseded by the output of {later}"))
+                collapsed.add(i)
+            else:
+                compacted.append([{"role": message["role"], "content": message["content"]} for message in exchange])
+
+        def tokens():
+            return sum(estimate_tokens(message["content"]) for exchange in compacted for message in exchange)
+
+        if self.max_tokens is not None:
+            for i in range(max(0, len(compacted) - self.keep_recent)):
+                if tokens() <= self.max_tokens:
+                    break
+                if i not in collapsed:
+                    compacted[i] = self._collapsed(exchanges[i], "the conversation exceeded its token budget")
+        return [message for exchange in compacted for message in exchange]
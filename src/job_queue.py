@@ -0,0 +1,201 @@
+# src/job_queue.py
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, Dict
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class JobQueue:
+    """
+    Persistent queue of handout generation jobs, stored in SQLite so that it survives restarts and can be shared by
+    several processes.
+
+    A lesson has at most one active (queued or running) job: submitting it again returns the existing job.
+    """
+
+    def __init__(self, db_file: Path):
+        self.db_file = Path(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        # WAL lets the app read the queue while a worker writes to it; it is a property of the database file, kept
+        # once set
+        db = sqlite3.connect(self.db_file, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+        finally:
+            db.close()
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    module_num INTEGER NOT NULL,
+                    lesson_num INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    options TEXT NOT NULL,
+                    submitted_by TEXT,
+                    submitted_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    @contextmanager
+    def _connect(self, write: bool = True):
+        """
+        Connection running one transaction, committed on exit. A write transaction takes the write lock from the
+        start; a read transaction only reads a snapshot, without waiting for the writers or blocking them
+        """
+        db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _job(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        return job
+
+    def submit(self, module_num: int, lesson_num: int, submitted_by: Optional[str] = None,
+               **options) -> tuple[Dict[str, Any], bool]:
+        """
+        Queue a lesson. Returns the job and whether it was created (False if the lesson already had one).
+
+        The check for an active job and the insert run in one short write transaction, so concurrent submissions of a
+        lesson never both create a job. Anything slow (e.g. copying uploads) is done by the caller beforehand.
+        """
+        with self._connect() as db:
+            active = db.execute(f"SELECT * FROM jobs WHERE module_num = ? AND lesson_num = ? AND status IN "
+                                f"({','.join('?' * len(ACTIVE_STATUSES))}) ORDER BY id LIMIT 1",
+                                (module_num, lesson_num, *ACTIVE_STATUSES)).fetchone()
+            if active is not None:
+                return self._job(active), False
+            cursor = db.execute("INSERT INTO jobs (module_num, lesson_num, status, options, submitted_by, submitted_at)"
+                                " VALUES (?, ?, 'queued', ?, ?, ?)",
+                                (module_num, lesson_num, json.dumps(options, default=str), submitted_by, time.time()))
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (cursor.lastrowid,)).fetchone()), True
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Take the oldest queued job and mark it as running"""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), row["id"]))
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def finish(self, job_id: int, error: Optional[str] = None):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+                       ("failed" if error else "done", time.time(), error, job_id))
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a job that has not started yet"""
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                                "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+            return cursor.rowcount > 0
+
+    def requeue_running(self) -> int:
+        """
+        Put back in the queue the jobs left running by a process that stopped; they resume from their checkpoints.
+        Only the process running the workers may call it, when it starts.
+        """
+        with self._connect() as db:
+            return db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'").rowcount
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._connect(write=False) as db:
+            return self._job(db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def is_active(self, module_num: int, lesson_num: int) -> bool:
+        with self._connect(write=False) as db:
+            return db.execute(f"SELECT 1 FROM jobs WHERE module_num = ? AND lesson_num = ? AND status IN "
+                              f"({','.join('?' * len(ACTIVE_STATUSES))})",
+                              (module_num, lesson_num, *ACTIVE_STATUSES)).fetchone() is not None
+
+    def jobs(self, limit: int = 50) -> list[Dict[str, Any]]:
+        """Most recent jobs first"""
+        with self._connect(write=False) as db:
+            return [self._job(row) for row in db.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))]
+
+
+class JobWorkers:
+    """
+    Fixed pool of workers processing a JobQueue on an event loop running in a background thread.
+
+    The number of workers bounds how many lessons call the providers at the same time, whoever submitted them.
+    on_stop, if given, is awaited on the loop of the workers once they have stopped (e.g. to close their clients).
+    """
+
+    def __init__(self, queue: JobQueue, run_job: Callable[[Dict[str, Any]], Awaitable[None]], workers: int = 2,
+                 poll_interval: float = 1.0, on_stop: Optional[Callable[[], Awaitable[None]]] = None):
+        self.queue = queue
+        self.run_job = run_job
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.on_stop = on_stop
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.stopping = False
+        self.serving: Optional[asyncio.Future] = None
+
+    def start(self) -> "JobWorkers":
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print(f"Requeued {requeued} interrupted jobs")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the workers. Running jobs are cancelled: they stay running and are requeued by the next start"""
+        self.stopping = True
+        if self.serving is not None:
+            self.loop.call_soon_threadsafe(self.serving.cancel)
+        self.thread.join()
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve_workers())
+
+    async def _serve_workers(self):
+        self.serving = asyncio.gather(*(self._worker(i) for i in range(self.workers)))
+        try:
+            await self.serving
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.on_stop is not None:
+                await self.on_stop()
+
+    async def _worker(self, worker_id: int):
+        while not self.stopping:
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            print(f"[worker {worker_id}] job {job['id']}: module {job['module_num']}, lesson {job['lesson_num']}")
+            try:
+                await self.run_job(job)
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+                print(f"[worker {worker_id}] job {job['id']} failed:\n{error}")
+            await asyncio.to_thread(self.queue.finish, job["id"], error)
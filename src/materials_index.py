@@ -0,0 +1,150 @@
+# src/materials_index.py
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+import numpy as np
+from pypdf import PdfReader
+from pypdf.errors import PdfReadError
+
+from config.definitions import CACHE_DIR
+from src.file_cache import file_sha256
+from src.handout_sections import split_sections
+
+TOKEN = re.compile(r"\w{2,}")
+INDEX_VERSION = 1
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(text.lower())
+
+
+def extract_pdf_pages(path: Path) -> list[str]:
+    """Text of every page of a pdf; unreadable files yield no pages"""
+    try:
+        return [page.extract_text() or "" for page in PdfReader(path).pages]
+    except (PdfReadError, OSError, ValueError):
+        return []
+
+
+def chunk_page(text: str, chunk_words: int, overlap: int) -> list[str]:
+    """Split a page into windows of chunk_words words, consecutive windows sharing overlap words"""
+    words = text.split()
+    step = max(1, chunk_words - overlap)
+    return [" ".join(words[start:start + chunk_words]) for start in range(0, max(1, len(words) - overlap), step)
+            if words[start:start + chunk_words]]
+
+
+class MaterialsIndex:
+    """
+    BM25 index of the text of a lesson's pdf materials.
+
+    The text is extracted locally and split into overlapping chunks that never cross a page, so that every passage can
+    be traced back to its file and page. The chunks are stored on disk, keyed by the hashes of the materials, and the
+    index is rebuilt only when a file changes. It lets the agents that do not receive the pdfs (reviewer, editor) be
+    grounded in the materials with a few relevant passages instead of the whole documents.
+    """
+
+    def __init__(self, chunks: list[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        term_counts = [Counter(tokenize(chunk["text"])) for chunk in chunks]
+        self.lengths = np.array([sum(counts.values()) for counts in term_counts], dtype=float)
+        self.avg_length = self.lengths.mean() if chunks else 0.0
+        # Postings: term -> (indexes of the chunks containing it, term frequencies)
+        postings: Dict[str, tuple[list[int], list[int]]] = {}
+        for i, counts in enumerate(term_counts):
+            for term, count in counts.items():
+                docs, freqs = postings.setdefault(term, ([], []))
+                docs.append(i)
+                freqs.append(count)
+        self.postings = {term: (np.array(docs), np.array(freqs, dtype=float))
+                         for term, (docs, freqs) in postings.items()}
+
+    @classmethod
+    def build(cls, paths: list[Path], chunk_words: int = 180, overlap: int = 40) -> "MaterialsIndex":
+        chunks = []
+        for path in paths:
+            if Path(path).suffix.lower() != ".pdf":
+                continue
+            for page_num, text in enumerate(extract_pdf_pages(path), start=1):
+                chunks.extend({"source": Path(path).name, "page": page_num, "text": chunk}
+                              for chunk in chunk_page(text, chunk_words, overlap))
+        return cls(chunks)
+
+    @classmethod
+    def load_or_build(cls, paths: list[Path], index_dir: Optional[Path] = None, chunk_words: int = 180,
+                      overlap: int = 40) -> "MaterialsIndex":
+        """Load the index of these materials from disk, building and storing it if they changed"""
+        if index_dir is None:
+            index_dir = Path(CACHE_DIR) / "materials_index"
+        index_dir = Path(index_dir)
+        hashes = sorted(file_sha256(path) for path in paths)
+        key = hashlib.sha256(json.dumps([INDEX_VERSION, chunk_words, overlap, hashes]).encode("utf-8")).hexdigest()
+        index_file = index_dir / f"{key}.json"
+        try:
+            with open(index_file, 'r') as f:
+                return cls(json.load(f)["chunks"])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+        index = cls.build(paths, chunk_words, overlap)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"files": [Path(path).name for path in paths], "chunks": index.chunks}, f, ensure_ascii=False)
+            os.replace(tmp_path, index_file)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return index
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every chunk for a query"""
+        scores = np.zeros(len(self.chunks))
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / (self.avg_length or 1.0))
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            docs, freqs = self.postings[term]
+            idf = math.log(1 + (len(self.chunks) - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * freqs * (self.k1 + 1) / (freqs + norm[docs])
+        return scores
+
+    def search(self, query: str, k: int = 3) -> list[Dict[str, Any]]:
+        """Top k chunks for a query, best first; chunks sharing no term with the query are never returned"""
+        if not self.chunks or k <= 0:
+            return []
+        scores = self.scores(query)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [self.chunks[i] for i in top if scores[i] > 0]
+
+    def passages(self, markdown: str, k: int = 3) -> str:
+        """
+        The top k passages for every section of a Markdown document, formatted for a prompt.
+
+        A passage relevant to several sections is listed only under the first one.
+        """
+        _, sections = split_sections(markdown)
+        if not sections:
+            sections = [("", markdown)]
+        seen = set()
+        blocks = []
+        for title, text in sections:
+            found = []
+            for chunk in self.search(text, k):
+                key = (chunk["source"], chunk["page"], chunk["text"])
+                if key not in seen:
+                    seen.add(key)
+                    found.append(f"> {chunk['text']}\n> ({chunk['source']}, p. {chunk['page']})")
+            if found:
+                blocks.append((f"## {title}\n" if title else "") + "\n\n".join(found))
+        return "\n\n".join(blocks) if blocks else "(No relevant passages found in the materials)"
@@ -0,0 +1,552 @@
+# src/mock_llm_server.py
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional, Dict
+from urllib.parse import urlparse
+
+DEFAULT_RESPONSE = """# Lezione
+
+## Obiettivi della lezione
+{words}
+
+## Concetti principali
+{words}
+
+[Figura 1: Schema. Esempio di figura]
+
+## Esempi
+{words}
+
+## Riepilogo
+{words}
+"""
+
+# Prompts asking for the edits of a handout as JSON (see src/prompts/final_edits.teacher.md)
+EDITS_REQUEST = '{"edits": ['
+# Sections of the default handout, which the mock edits rewrite
+DEFAULT_HEADINGS = re.findall(r"^## (.+)$", DEFAULT_RESPONSE, re.M)
+
+
+@dataclass
+class MockProfile:
+    """
+    Behaviour of the mock servers.
+
+    Latencies (time to the first token) follow a lognormal distribution with the given median and p95; the rest of
+    the reply is generated at tokens_per_second. error_rate and rate_limit_rate are the probabilities of answering a
+    request with a 500 or a 429 instead. Batch jobs finish batch_seconds after their submission.
+    """
+    latency_median: float = 0.5
+    latency_p95: float = 1.5
+    tokens_per_second: float = 200.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    upload_seconds_per_mb: float = 0.2
+    response_words: int = 400
+    batch_seconds: float = 2.0
+    responses: list[str] = field(default_factory=list)
+
+    def latency(self) -> float:
+        if self.latency_p95 <= self.latency_median:
+            return self.latency_median
+        # p95 of a lognormal: median * exp(1.645 * sigma)
+        sigma = math.log(self.latency_p95 / self.latency_median) / 1.645
+        return random.lognormvariate(math.log(self.latency_median), sigma)
+
+    def response(self) -> str:
+        if self.responses:
+            return random.choice(self.responses)
+        words = " ".join(f"parola{i}" for i in range(max(1, self.response_words // 4)))
+        return DEFAULT_RESPONSE.format(words=words)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def sample_json(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Any:
+    """A random document following a JSON schema (the subset emitted by pydantic)"""
+    root = root or schema
+    if "$ref" in schema:
+        return sample_json(root["$defs"][schema["$ref"].rsplit("/", 1)[-1]], root)
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return random.choice(schema["enum"])
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return sample_json(random.choice(schema[key]), root)
+    kind = schema.get("type", "string")
+    if kind == "object":
+        return {name: sample_json(value, root) for name, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        # Empty arrays too, e.g. reviews without issues
+        return [sample_json(schema.get("items", {}), root) for _ in range(random.randint(0, 2))]
+    if kind in ("integer", "number"):
+        return random.randint(0, 10)
+    if kind == "boolean":
+        return random.random() < 0.5
+    return " ".join(f"parola{i}" for i in range(random.randint(3, 12)))
+
+
+def sample_edits(prompt: str) -> Dict[str, Any]:
+    """Edits rewriting a section of the default handout found in an edits prompt, if any"""
+    headings = [heading for heading in DEFAULT_HEADINGS if prompt.count(f"## {heading}\n") == 1]
+    if not headings:
+        return {"edits": []}
+    heading = random.choice(headings)
+    words = " ".join(f"parola{i}" for i in range(20))
+    return {"edits": [{"op": "replace_section", "heading": f"## {heading}", "content": f"## {heading}\n{words}\n"}]}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    # Plumbing
+
+    def _raw_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _body(self) -> Dict[str, Any]:
+        data = self._raw_body()
+        try:
+            return json.loads(data) if data else {}
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return {}
+
+    def _json(self, payload: Any, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _event(self, data: Any, event: Optional[str] = None):
+        prefix = f"event: {event}\n" if event else ""
+        payload = data if isinstance(data, str) else json.dumps(data)
+        self.wfile.write(f"{prefix}data: {payload}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _injected_error(self, provider: str) -> bool:
+        """Answer with a 429 or a 500, following the profile rates"""
+        profile = self.server.profile
+        roll = random.random()
+        if roll < profile.rate_limit_rate:
+            status, message = 429, "Rate limit exceeded (mock)"
+        elif roll < profile.rate_limit_rate + profile.error_rate:
+            status, message = 500, "Internal error (mock)"
+        else:
+            return False
+        self.server.count(f"{provider}.{status}")
+        time.sleep(self.server.profile.latency() / 10)
+        if provider == "anthropic":
+            kind = "rate_limit_error" if status == 429 else "api_error"
+            payload = {"type": "error", "error": {"type": kind, "message": message}}
+        elif provider == "openai":
+            payload = {"error": {"message": message, "type": "server_error", "code": None}}
+        else:
+            payload = {"error": {"code": status, "message": message,
+                                 "status": "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"}}
+        self._json(payload, status, {"Retry-After": "0"} if status == 429 else None)
+        return True
+
+    def _chunks(self, text: str, size: int = 12):
+        """Split a reply in pieces of about size words, paced at the profile token rate"""
+        words = text.split(" ")
+        for start in range(0, len(words), size):
+            piece = " ".join(words[start:start + size]) + (" " if start + size < len(words) else "")
+            time.sleep(estimate_tokens(piece) / self.server.profile.tokens_per_second)
+            yield piece
+
+    def _reply(self, prompt: str = "", schema: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Reply to a request: a document of the JSON schema of a structured-output request, the JSON edits asked by an
+        edits prompt, a Markdown handout otherwise
+        """
+        if schema is not None:
+            return json.dumps(sample_json(schema))
+        if EDITS_REQUEST in prompt:
+            return json.dumps(sample_edits(prompt))
+        return self.server.profile.response()
+
+    def _generate(self, text: str):
+        """Wait as long as a model would take to write a reply"""
+        time.sleep(self.server.profile.latency() + estimate_tokens(text) / self.server.profile.tokens_per_second)
+
+    # Routing
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path.endswith("/v1/files"):
+            return self._openai_upload()
+        body = self._body()
+        if path.endswith("/v1/batches"):
+            return self._openai_batch(body)
+        if path.endswith(":batchGenerateContent"):
+            return self._gemini_batch(path, body)
+        if path.endswith("/chat/completions"):
+            return self._openai(body)
+        if path.endswith("/messages"):
+            return self._anthropic(body)
+        if path.startswith("/upload/"):
+            return self._gemini_upload(path)
+        if path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+            return self._gemini_generate(path, body)
+        if path.endswith("/cachedContents"):
+            return self._gemini_cache(body)
+        self._json({"error": {"code": 404, "message": f"Unknown endpoint {path}", "status": "NOT_FOUND"}}, 404)
+
+    def do_PATCH(self):
+        path = urlparse(self.path).path
+        self._body()
+        if "/cachedContents/" in path:
+            return self._gemini_cache({}, name=path.split("/", 2)[-1])
+        self._json({"error": {"code": 404, "message": path, "status": "NOT_FOUND"}}, 404)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        name = path.split("/", 2)[-1]
+        if path.startswith("/v1/batches/"):
+            return self._openai_batch_status(path.rsplit("/", 1)[-1])
+        if path.startswith("/v1/files/") and path.endswith("/content"):
+            return self._openai_file_content(path.split("/")[-2])
+        if name in self.server.batches:
+            return self._json(self._gemini_batch_status(name))
+        if name in self.server.files:
+            return self._json(self.server.files[name])
+        self._json({"error": {"code": 404, "message": f"{name} not found", "status": "NOT_FOUND"}}, 404)
+
+    def do_DELETE(self):
+        name = urlparse(self.path).path.split("/", 2)[-1]
+        self.server.files.pop(name, None)
+        self._json({})
+
+    # OpenAI
+
+    @staticmethod
+    def _openai_reply_args(body) -> tuple[str, Optional[Dict[str, Any]]]:
+        """Last prompt and JSON schema (response_format) of a chat completion request"""
+        messages = body.get("messages") or [{}]
+        schema = body.get("response_format", {}).get("json_schema", {}).get("schema")
+        return str(messages[-1].get("content", "")), schema
+
+    def _openai(self, body):
+        self.server.count("openai.requests")
+        if self._injected_error("openai"):
+            return
+        prompt_tokens = estimate_tokens(json.dumps(body.get("messages", [])))
+        model = body.get("model", "mock")
+        text = self._reply(*self._openai_reply_args(body))
+        if not body.get("stream"):
+            self._generate(text)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": estimate_tokens(text),
+                     "total_tokens": prompt_tokens + estimate_tokens(text)}
+            return self._json({"id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                               "model": model, "usage": usage,
+                               "choices": [{"index": 0, "finish_reason": "stop",
+                                            "message": {"role": "assistant", "content": text}}]})
+        time.sleep(self.server.profile.latency())
+        self._start_events()
+        chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        for piece in self._chunks(text):
+            self._event({**chunk, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+        self._event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if body.get("stream_options", {}).get("include_usage"):
+            self._event({**chunk, "choices": [], "usage": {
+                "prompt_tokens": prompt_tokens, "completion_tokens": estimate_tokens(text),
+                "total_tokens": prompt_tokens + estimate_tokens(text)}})
+        self._event("[DONE]")
+
+    def _openai_upload(self):
+        """Batch input file, sent as multipart/form-data"""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+        form = BytesParser(policy=HTTP).parsebytes(header + self._raw_body())
+        content = next(part.get_payload(decode=True) for part in form.iter_parts()
+                       if part.get_param("name", header="content-disposition") == "file")
+        file_id = f"file-mock{next(self.server.ids)}"
+        self.server.files[file_id] = content
+        self._json({"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                    "filename": "requests.jsonl", "purpose": "batch", "status": "processed"})
+
+    def _openai_batch(self, body):
+        self.server.count("openai.batches")
+        requests = [json.loads(line) for line in self.server.files[body["input_file_id"]].splitlines() if line.strip()]
+        self.server.count("openai.batch_requests", len(requests))
+        batch_id = f"batch_mock{next(self.server.ids)}"
+        self.server.batches[batch_id] = {"created": time.time(), "requests": requests, "body": body}
+        self._json(self._openai_batch_object(batch_id))
+
+    def _openai_batch_object(self, batch_id):
+        batch = self.server.batches[batch_id]
+        done = time.time() - batch["created"] >= self.server.profile.batch_seconds
+        if done and "output_file_id" not in batch:
+            lines = []
+            for request in batch["requests"]:
+                text = self._reply(*self._openai_reply_args(request["body"]))
+                prompt_tokens = estimate_tokens(json.dumps(request["body"].get("messages", [])))
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": estimate_tokens(text),
+                         "total_tokens": prompt_tokens + estimate_tokens(text)}
+                completion = {"id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                              "model": request["body"].get("model", "mock"), "usage": usage,
+                              "choices": [{"index": 0, "finish_reason": "stop",
+                                           "message": {"role": "assistant", "content": text}}]}
+                lines.append(json.dumps({"id": f"response-{request['custom_id']}", "custom_id": request["custom_id"],
+                                         "response": {"status_code": 200, "body": completion}, "error": None}))
+            batch["output_file_id"] = f"file-mock{next(self.server.ids)}"
+            self.server.files[batch["output_file_id"]] = "\n".join(lines).encode("utf-8")
+        return {"id": batch_id, "object": "batch", "endpoint": batch["body"]["endpoint"],
+                "input_file_id": batch["body"]["input_file_id"], "completion_window": "24h",
+                "status": "completed" if done else "in_progress", "created_at": int(batch["created"]),
+                "output_file_id": batch.get("output_file_id"),
+                "request_counts": {"total": len(batch["requests"]), "completed": len(batch["requests"]) if done else 0,
+                                   "failed": 0}}
+
+    def _openai_batch_status(self, batch_id):
+        if batch_id not in self.server.batches:
+            return self._json({"error": {"message": f"No batch {batch_id}", "type": "invalid_request_error"}}, 404)
+        self._json(self._openai_batch_object(batch_id))
+
+    def _openai_file_content(self, file_id):
+        content = self.server.files.get(file_id)
+        if not isinstance(content, bytes):
+            return self._json({"error": {"message": f"No file {file_id}", "type": "invalid_request_error"}}, 404)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Anthropic
+
+    def _anthropic(self, body):
+        self.server.count("anthropic.requests")
+        if self._injected_error("anthropic"):
+            return
+        input_tokens = estimate_tokens(json.dumps(body.get("messages", [])) + str(body.get("system", "")))
+        message = {"id": "msg_mock", "type": "message", "role": "assistant", "model": body.get("model", "mock"),
+                   "stop_reason": None, "stop_sequence": None}
+        content = (body.get("messages") or [{}])[-1].get("content", "")
+        prompt = content if isinstance(content, str) else " ".join(block.get("text", "") for block in content)
+        # A forced tool call is how structured output is asked for: its input follows the tool schema
+        forced = body.get("tool_choice", {}).get("name")
+        tool = next((tool for tool in body.get("tools", []) if tool["name"] == forced), None)
+        text = self._reply(prompt, tool["input_schema"] if tool is not None else None)
+        if not body.get("stream"):
+            self._generate(text)
+            block = ({"type": "tool_use", "id": "toolu_mock", "name": forced, "input": json.loads(text)}
+                     if tool is not None else {"type": "text", "text": text})
+            return self._json({**message, "stop_reason": "tool_use" if tool is not None else "end_turn",
+                               "content": [block],
+                               "usage": {"input_tokens": input_tokens, "output_tokens": estimate_tokens(text)}})
+        time.sleep(self.server.profile.latency())
+        self._start_events()
+        self._event({"type": "message_start", "message": {**message, "content": [],
+                                                          "usage": {"input_tokens": input_tokens, "output_tokens": 1}}},
+                    "message_start")
+        self._event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                    "content_block_start")
+        for piece in self._chunks(text):
+            self._event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}},
+                        "content_block_delta")
+        self._event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self._event({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                     "usage": {"output_tokens": estimate_tokens(text)}}, "message_delta")
+        self._event({"type": "message_stop"}, "message_stop")
+
+    # Gemini
+
+    def _gemini_upload(self, path):
+        query = urlparse(self.path).query
+        if "upload_id=" not in query:
+            # Start of a resumable upload: hand out the upload URL
+            upload_id = next(self.server.ids)
+            host, port = self.server.server_address[:2]
+            self.send_response(200)
+            self.send_header("X-Goog-Upload-URL", f"http://{host}:{port}{path}?upload_id={upload_id}")
+            self.send_header("X-Goog-Upload-Status", "active")
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+            return
+        start = time.monotonic()
+        size = int(self.headers.get("Content-Length") or 0)
+        time.sleep(self.server.profile.upload_seconds_per_mb * size / 2 ** 20)
+        name = f"files/mock{query.split('upload_id=')[1]}"
+        expires = datetime.now(timezone.utc) + timedelta(hours=48)
+        file = {"name": name, "uri": f"http://mock/{name}", "mimeType": "application/pdf", "sizeBytes": str(size),
+                "state": "ACTIVE", "expirationTime": expires.isoformat().replace("+00:00", "Z")}
+        self.server.files[name] = file
+        self.server.count("gemini.uploads")
+        self.server.add_time("gemini.upload_seconds", time.monotonic() - start)
+        self.send_response(200)
+        data = json.dumps({"file": file}).encode("utf-8")
+        self.send_header("X-Goog-Upload-Status", "final")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _gemini_cache(self, body, name=None):
+        self.server.count("gemini.cache_updates" if name else "gemini.cache_creates")
+        name = name or f"cachedContents/mock{next(self.server.ids)}"
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        self._json({"name": name, "model": body.get("model", "models/mock"),
+                    "expireTime": expires.isoformat().replace("+00:00", "Z"),
+                    "usageMetadata": {"totalTokenCount": estimate_tokens(json.dumps(body))}})
+
+    @staticmethod
+    def _gemini_reply_args(request) -> tuple[str, Optional[Dict[str, Any]]]:
+        """Last prompt and JSON schema (generationConfig) of a generateContent request"""
+        parts = (request.get("contents") or [{}])[-1].get("parts", [])
+        config = request.get("generationConfig") or {}
+        return " ".join(part.get("text", "") for part in parts), config.get("responseJsonSchema")
+
+    def _gemini_generate(self, path, body):
+        self.server.count("gemini.requests")
+        if self._injected_error("gemini"):
+            return
+        prompt_tokens = estimate_tokens(json.dumps(body.get("contents", [])))
+        cached_tokens = 2000 if body.get("cachedContent") else 0
+
+        def usage(text):
+            return {"promptTokenCount": prompt_tokens + cached_tokens, "cachedContentTokenCount": cached_tokens,
+                    "candidatesTokenCount": estimate_tokens(text),
+                    "totalTokenCount": prompt_tokens + cached_tokens + estimate_tokens(text)}
+
+        def candidate(text, finished):
+            result = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+            return {**result, "finishReason": "STOP"} if finished else result
+
+        text = self._reply(*self._gemini_reply_args(body))
+        if path.endswith(":generateContent"):
+            self._generate(text)
+            return self._json({"candidates": [candidate(text, True)], "usageMetadata": usage(text)})
+        time.sleep(self.server.profile.latency())
+        self._start_events()
+        pieces = list(self._chunks(text))
+        for i, piece in enumerate(pieces):
+            finished = i == len(pieces) - 1
+            self._event({"candidates": [candidate(piece, finished)], **({"usageMetadata": usage(text)} if finished else {})})
+
+    def _gemini_batch(self, path, body):
+        self.server.count("gemini.batches")
+        requests = body["batch"]["inputConfig"]["requests"]["requests"]
+        self.server.count("gemini.batch_requests", len(requests))
+        name = f"batches/mock{next(self.server.ids)}"
+        self.server.batches[name] = {"created": time.time(), "requests": requests,
+                                     "model": path.split("/")[-1].split(":")[0]}
+        self._json(self._gemini_batch_status(name))
+
+    def _gemini_batch_status(self, name):
+        batch = self.server.batches[name]
+        done = time.time() - batch["created"] >= self.server.profile.batch_seconds
+        metadata = {"@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+                    "model": f"models/{batch['model']}", "name": name,
+                    "state": "BATCH_STATE_SUCCEEDED" if done else "BATCH_STATE_PENDING"}
+        if done:
+            if "responses" not in batch:
+                batch["responses"] = []
+                for item in batch["requests"]:
+                    text = self._reply(*self._gemini_reply_args(item["request"]))
+                    prompt_tokens = estimate_tokens(json.dumps(item["request"].get("contents", [])))
+                    batch["responses"].append({"response": {
+                        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0,
+                                        "finishReason": "STOP"}],
+                        "usageMetadata": {"promptTokenCount": prompt_tokens,
+                                          "candidatesTokenCount": estimate_tokens(text),
+                                          "totalTokenCount": prompt_tokens + estimate_tokens(text)}}})
+            metadata["output"] = {"inlinedResponses": {"inlinedResponses": batch["responses"]}}
+        return {"name": name, "metadata": metadata, "done": done}
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, profile: MockProfile):
+        super().__init__(address, _Handler)
+        self.profile = profile
+        # Gemini file metadata, and the content of the OpenAI batch files
+        self.files: Dict[str, Any] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.ids = itertools.count(1)
+        self.stats: Counter = Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1):
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def add_time(self, name: str, seconds: float):
+        with self.stats_lock:
+            self.stats[name] += seconds
+
+
+class MockLLMServer:
+    """
+    Local stand-in for the OpenAI, Anthropic and Gemini endpoints used by the agents (chat, streaming, Gemini file
+    uploads and cached contents, OpenAI and Gemini batch jobs), for measuring the pipeline without network or API costs.
+
+    Use it as a context manager and point the SDKs to it with the variables returned by env().
+    """
+
+    def __init__(self, profile: Optional[MockProfile] = None, host: str = "127.0.0.1", port: int = 0):
+        self.server = _Server((host, port), profile or MockProfile())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self.server.stats_lock:
+            return dict(self.server.stats)
+
+    def env(self) -> Dict[str, str]:
+        """Environment variables pointing the OpenAI, Anthropic and Gemini SDKs to this server"""
+        return {
+            "OPENAI_BASE_URL": f"{self.url}/v1", "OPENAI_API_KEY": "mock",
+            "ANTHROPIC_BASE_URL": self.url, "ANTHROPIC_API_KEY": "mock",
+            "GOOGLE_GEMINI_BASE_URL": self.url, "GOOGLE_API_KEY": "mock",
+        }
+
+    def start(self) -> "MockLLMServer":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "MockLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,153 @@
+# src/model_router.py
+import statistics
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Optional, Dict
+
+
+@dataclass(frozen=True)
+class ModelOption:
+    """A model a stage can run on, with prior performance estimates used until its calls have been observed"""
+    provider: str
+    model: str
+    max_prompt_tokens: int = 100_000
+    first_token_s: float = 1.0
+    tokens_per_second: float = 100.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}/{self.model}"
+
+
+@dataclass
+class StageRoute:
+    """
+    Candidate models of a stage, most preferred first.
+
+    output_tokens is the expected length of the reply: with short replies the time to first token dominates, with long
+    ones the generation speed. With a deadline_s, the most preferred candidate expected to finish in time is chosen;
+    without one, the fastest.
+    """
+    candidates: list[ModelOption]
+    output_tokens: int = 1000
+    deadline_s: Optional[float] = None
+
+
+# Priors: (prompt limit, time to first token, output tokens per second)
+GEMINI_FLASH = ModelOption("gemini", "gemini-2.5-flash", 1_000_000, 3.0, 180.0)
+GEMINI_FLASH_LITE = ModelOption("gemini", "gemini-2.5-flash-lite", 1_000_000, 1.0, 300.0)
+GPT_4O_MINI = ModelOption("openai", "gpt-4o-mini", 120_000, 0.6, 80.0)
+GPT_41_MINI = ModelOption("openai", "gpt-4.1-mini", 1_000_000, 0.8, 90.0)
+CLAUDE_HAIKU = ModelOption("anthropic", "claude-3-5-haiku-latest", 190_000, 0.8, 60.0)
+
+# The teacher stages need the pdfs uploaded to Gemini, so they only route between Gemini models. The reviews are short
+# replies to small prompts (the fastest adequate model wins); the handouts are long generations (the fastest generator
+# wins)
+DEFAULT_ROUTES = {
+    "first_draft": StageRoute([GEMINI_FLASH], output_tokens=4000),
+    "review": StageRoute([GPT_4O_MINI, GPT_41_MINI, CLAUDE_HAIKU], output_tokens=1500),
+    "summary": StageRoute([GEMINI_FLASH], output_tokens=4000),
+    "handout_draft": StageRoute([GEMINI_FLASH, GEMINI_FLASH_LITE], output_tokens=12000),
+    "editing_instructions": StageRoute([GPT_4O_MINI, GPT_41_MINI, CLAUDE_HAIKU], output_tokens=1500),
+    "final_handout": StageRoute([GEMINI_FLASH, GEMINI_FLASH_LITE], output_tokens=12000),
+}
+
+
+@dataclass
+class _ModelStats:
+    first_token_s: deque
+    tokens_per_second: deque
+    # (attempts, failed attempts) of the recent calls
+    outcomes: deque
+
+
+class ModelRouter:
+    """
+    Chooses the model of each stage from its StageRoute, the prompt size and the calls observed so far.
+
+    Agents report their calls through observe (see Agent._traced); a model whose recent attempts failed at least
+    max_error_rate of the time is degraded and only used when every candidate is. A router can be shared by several
+    lessons, so that they all learn from each other's calls.
+    """
+
+    def __init__(self, routes: Dict[str, StageRoute], history_size: int = 50, error_window: int = 10,
+                 min_samples: int = 3, max_error_rate: float = 0.5):
+        self.routes = routes
+        self.history_size = history_size
+        self.error_window = error_window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.models: Dict[tuple, _ModelStats] = {}
+
+    def _stats(self, provider: str, model: str) -> _ModelStats:
+        key = (provider, model)
+        if key not in self.models:
+            self.models[key] = _ModelStats(deque(maxlen=self.history_size), deque(maxlen=self.history_size),
+                                           deque(maxlen=self.error_window))
+        return self.models[key]
+
+    def observe(self, record: Dict[str, Any]):
+        """Learn from a call, given its telemetry record (latencies, output tokens, retries and error)"""
+        stats = self._stats(record["provider"], record["model"])
+        failed = record.get("retries", 0) + (1 if record.get("error") else 0)
+        stats.outcomes.append((record.get("calls", 1) + record.get("retries", 0), failed))
+        output_tokens = record.get("output_tokens")
+        if record.get("error") or not output_tokens:
+            return
+        if record.get("streamed"):
+            generation_s = record["wall_s"] - record["first_token_s"]
+            stats.first_token_s.append(record["first_token_s"])
+            if generation_s > 0:
+                stats.tokens_per_second.append(output_tokens / generation_s)
+        else:
+            # A blocking call only tells the total time: the generation is estimated from the known speed
+            option = next((option for route in self.routes.values() for option in route.candidates
+                           if (option.provider, option.model) == (record["provider"], record["model"])),
+                          ModelOption(record["provider"], record["model"]))
+            speed = self._median(stats.tokens_per_second, option.tokens_per_second)
+            stats.first_token_s.append(max(0.0, record["wall_s"] - output_tokens / speed))
+
+    def _median(self, samples: deque, prior: float) -> float:
+        return statistics.median(samples) if len(samples) >= self.min_samples else prior
+
+    def error_rate(self, option: ModelOption) -> float:
+        outcomes = self._stats(option.provider, option.model).outcomes
+        attempts = sum(attempts for attempts, _ in outcomes)
+        if len(outcomes) < self.min_samples or not attempts:
+            return 0.0
+        return sum(failed for _, failed in outcomes) / attempts
+
+    def is_degraded(self, option: ModelOption) -> bool:
+        return self.error_rate(option) >= self.max_error_rate
+
+    def estimate(self, option: ModelOption, output_tokens: int) -> float:
+        """Expected seconds to generate output_tokens: time to first token plus generation time"""
+        stats = self._stats(option.provider, option.model)
+        return (self._median(stats.first_token_s, option.first_token_s)
+                + output_tokens / self._median(stats.tokens_per_second, option.tokens_per_second))
+
+    def rank(self, stage: str, prompt_tokens: int) -> list[ModelOption]:
+        """Candidates of a stage in the order they should be tried: the chosen one first, then the fallbacks"""
+        route = self.routes[stage]
+        candidates = [option for option in route.candidates if prompt_tokens <= option.max_prompt_tokens]
+        if not candidates:
+            raise ValueError(f"No model of stage '{stage}' accepts a prompt of ~{prompt_tokens} tokens")
+        estimates = {option: self.estimate(option, route.output_tokens) for option in candidates}
+
+        def order(options):
+            in_time = [option for option in options
+                       if route.deadline_s is not None and estimates[option] <= route.deadline_s]
+            return in_time + sorted((option for option in options if option not in in_time), key=estimates.get)
+
+        healthy = [option for option in candidates if not self.is_degraded(option)]
+        return order(healthy) + order([option for option in candidates if option not in healthy])
+
+    def describe(self, stage: str) -> Any:
+        """
+        The models a stage may run on, for its fingerprint. It does not depend on the observed calls, so that a stage
+        is not recomputed because another model happened to be faster; a single model is described by its name alone
+        """
+        candidates = self.routes[stage].candidates
+        if len(candidates) == 1:
+            return candidates[0].model
+        return [option.name for option in candidates]
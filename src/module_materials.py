@@ -0,0 +1,130 @@
+# src/module_materials.py
+import asyncio
+import os
+from pathlib import Path
+from typing import Any, Optional, Dict
+
+from src.file_cache import file_sha256
+
+
+def load_materials_paths(input_folder):
+    """Materials of a lesson folder and its topics (.txt) file, None if it has none"""
+    all_materials = [Path(os.path.join(input_folder, file)) for file in os.listdir(input_folder)]
+    topics = None
+    for material in list(all_materials):
+        if material.suffix == ".txt":
+            topics = material
+            all_materials.remove(material)
+    return all_materials, topics
+
+def extract_topics(topics_file_path):
+    topics = []
+    with open(topics_file_path, "r") as file:
+        for line in file:
+            topics.append(line.strip())
+    return topics
+
+def extract_module_structure(module_file_path):
+    module_structure = {}
+    with open(module_file_path, "r") as file:
+        # get title
+        module_structure["title"] = file.readline().strip()
+        for line in file:
+            if line.strip() == "":
+                continue
+            if "lezione" in line.lower():
+                # Extract lesson number and title
+                parts = line.split(":")
+                lesson_num = parts[0].lower().replace("Lezione", "").strip()
+                module_structure[str(lesson_num)] = {"title": parts[1].strip(), "topics": []}
+            else:
+                module_structure[str(lesson_num)]["topics"].append(line.strip())
+    return module_structure
+
+
+class ModulePrefetcher:
+    """
+    Materials of every lesson of a module, prepared once for the lessons generated together.
+
+    scan lists and hashes the materials of every "Lez NNN materials" folder and parses module_topics.md once. start
+    then uploads the pdfs to Gemini in the background, lesson by lesson in the order the lessons will run: a pdf shared
+    by several lessons is uploaded once, and every lesson finds its materials in the file cache when it starts
+    (see agenerate_handout).
+    """
+
+    def __init__(self, module_folder: Path):
+        self.module_folder = Path(module_folder)
+        self.module_structure = {}
+        # Lesson folder -> {"lesson_num", "materials", "topics", "hashes"}
+        self.lessons: Dict[Path, Dict[str, Any]] = {}
+        # pdf hash -> task of the lesson upload that includes it
+        self.uploads: Dict[str, asyncio.Task] = {}
+        # Set by aclose: the uploads not started yet are skipped
+        self.closed = False
+
+    def scan(self) -> "ModulePrefetcher":
+        if (self.module_folder / "module_topics.md").exists():
+            self.module_structure = extract_module_structure(self.module_folder / "module_topics.md")
+        for folder in sorted(self.module_folder.glob("Lez * materials")):
+            try:
+                lesson_num = int(folder.name.split()[1])
+            except (IndexError, ValueError):
+                # Not a lesson folder
+                continue
+            materials, topics = load_materials_paths(folder)
+            if topics is None:
+                # The lesson run reports it
+                continue
+            self.lessons[folder.resolve()] = {"lesson_num": lesson_num, "materials": materials, "topics": topics,
+                                              "hashes": [file_sha256(path) for path in materials]}
+        distinct = {file_hash for lesson in self.lessons.values() for file_hash in lesson["hashes"]}
+        shared = sum(len(lesson["materials"]) for lesson in self.lessons.values()) - len(distinct)
+        print(f"{self.module_folder.name.capitalize()}: {len(self.lessons)} lessons, {len(distinct)} distinct materials"
+              f"{f' ({shared} shared between lessons)' if shared else ''}")
+        return self
+
+    def lesson(self, input_folder: Path) -> Optional[Dict[str, Any]]:
+        """Prefetched materials of a lesson folder, None if the folder was not scanned"""
+        return self.lessons.get(Path(input_folder).resolve())
+
+    def start(self, lesson_nums: Optional[list[int]] = None):
+        """Start uploading the materials of the given lessons (default: all), in this order"""
+        from src.agents import GeminiAgent
+
+        uploader = GeminiAgent("prefetch", "gemini-2.5-flash", "")
+        order = {lesson_num: i for i, lesson_num in enumerate(lesson_nums or [])}
+        lessons = sorted((lesson for lesson in self.lessons.values()
+                          if lesson_nums is None or lesson["lesson_num"] in order),
+                         key=lambda lesson: order.get(lesson["lesson_num"], lesson["lesson_num"]))
+        previous = None
+        for lesson in lessons:
+            new = {file_hash: path for file_hash, path in zip(lesson["hashes"], lesson["materials"])
+                   if file_hash not in self.uploads}
+            if not new:
+                continue
+            previous = asyncio.create_task(self._upload(uploader, list(new.values()), list(new), previous))
+            self.uploads.update(dict.fromkeys(new, previous))
+
+    async def _upload(self, uploader, paths: list[Path], hashes: list[str], previous: Optional[asyncio.Task]):
+        # One lesson at a time, so that the first lessons to run get their materials first
+        if previous is not None:
+            await asyncio.wait([previous])
+        if not self.closed:
+            await asyncio.to_thread(uploader.load_pdfs, paths, use_cache=True, hashes=hashes)
+
+    async def aclose(self):
+        """
+        Skip the uploads not started yet and wait for the one in progress (a thread that can not be cancelled), so
+        that none is left running when the clients are closed
+        """
+        self.closed = True
+        await asyncio.gather(*set(self.uploads.values()), return_exceptions=True)
+
+    async def wait(self, lesson: Dict[str, Any]):
+        """Wait for the uploads of a lesson's materials. A failed upload is left to the lesson, which retries it"""
+        tasks = {self.uploads[file_hash] for file_hash in lesson["hashes"] if file_hash in self.uploads}
+        for task in tasks:
+            try:
+                await asyncio.shield(task)
+            except Exception as e:
+                print(f"Prefetching the materials of lesson {lesson['lesson_num']} failed: {e!r}")
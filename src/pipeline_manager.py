@@ -1,35 +1,61 @@
 # src/pipeline_manager.py
 import json
+import os
+import uuid
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, Dict, Any
 
+from config.definitions import STATE_DB
+from src.state_store import SQLiteStateStore
+
 
 class PipelineManager:
     """Manages pipeline state and intermediate file checkpoints"""
 
-    STAGES = [
-        "first_draft",
-        "review",
-        "summary",
-        "handout_draft",
-        "editing_instructions",
-        "final_handout"
-    ]
+    # Pipeline graph: the stages whose outputs each stage needs, in topological order. Every stage needs the one
+    # before it, so the stages run one at a time: the graph decides which outputs a changed input invalidates
+    STAGE_INPUTS = {
+        "first_draft": [],
+        "review": ["first_draft"],
+        "summary": ["first_draft", "review"],
+        "handout_draft": ["summary"],
+        "editing_instructions": ["summary", "handout_draft"],
+        "final_handout": ["handout_draft", "editing_instructions"]
+    }
+    STAGES = list(STAGE_INPUTS)
+    # Fingerprint of the stages whose output was provided by the user
+    OVERRIDE_FINGERPRINT = "override"
 
-    def __init__(self, lesson_num: int, module_num: int, output_dir: Path):
+    def __init__(self, lesson_num: int, module_num: int, output_dir: Path,
+                 state_store: Optional[SQLiteStateStore] = None, read_only: bool = False):
         self.lesson_num = lesson_num
         self.module_num = module_num
         self.output_dir = output_dir
+        # States are kept in the JSON state file of the lesson, unless a SQLite store is given or configured
+        if state_store is None and STATE_DB:
+            state_store = SQLiteStateStore(Path(STATE_DB))
+        self.state_store = state_store
+        # Identifies the stages run by this manager (one run of the pipeline) in the state
+        self.run_id = uuid.uuid4().hex[:12]
         self.intermediate_dir = output_dir / "intermediate"
-        self.intermediate_dir.mkdir(parents=True, exist_ok=True)
+        # A manager that only reads the state (e.g. a status view) does not create the folders of the lesson
+        if not read_only:
+            self.intermediate_dir.mkdir(parents=True, exist_ok=True)
 
         # State file for this specific lesson
         self.state_file = self.intermediate_dir / f"lesson_{module_num:03}_{lesson_num:03}_state.json"
+        # Telemetry of the agent calls of this lesson, one JSON record per line (see src/telemetry.py)
+        self.trace_file = self.intermediate_dir / f"lesson_{module_num:03}_{lesson_num:03}_trace.jsonl"
         self.state = self._load_state()
 
     def _load_state(self) -> dict[str, Any]:
         """Load pipeline state from disk"""
+        if self.state_store is not None:
+            state = self.state_store.load(self.output_dir, self.module_num, self.lesson_num)
+            if state is not None:
+                return state
+        # A lesson started with JSON state files continues from its file
         if self.state_file.exists():
             with open(self.state_file, 'r') as f:
                 return json.load(f)
@@ -43,19 +69,95 @@ class PipelineManager:
         }
 
     def _save_state(self):
-        """Save pipeline state to disk"""
+        """Save pipeline state to disk, replacing the file atomically so that readers never see it half written"""
         self.state["last_updated"] = datetime.now().isoformat()
-        with open(self.state_file, 'w') as f:
+        if self.state_store is not None:
+            self.state_store.save(self.output_dir, self.state, self.get_next_stage())
+            return
+        tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+        with open(tmp_file, 'w') as f:
             json.dump(self.state, f, indent=2)
+        os.replace(tmp_file, self.state_file)
 
     def get_stage_file(self, stage: str) -> Path:
         """Get the standard filename for a stage"""
         return self.intermediate_dir / f"{stage}_m{self.module_num:03}_l{self.lesson_num:03}.md"
 
+    def get_partial_file(self, stage: str) -> Path:
+        """Get the file where the output of a stage is written while it is being generated"""
+        return self.intermediate_dir / f"{stage}_m{self.module_num:03}_l{self.lesson_num:03}.partial.md"
+
+    def start_partial(self, stage: str) -> str:
+        """Mark a stage as being generated and return the output already written by an interrupted run"""
+        partial = self.get_partial_output(stage) or ""
+        file_path = self.get_partial_file(stage)
+        if not partial:
+            file_path.write_text("")
+        self.state.setdefault("partial_stages", {})[stage] = str(file_path)
+        self._save_state()
+        return partial
+
+    def append_partial(self, stage: str, chunk: str):
+        """Append a chunk of generated output to the partial file of a stage"""
+        with open(self.state["partial_stages"][stage], 'a') as f:
+            f.write(chunk)
+
+    def get_partial_output(self, stage: str) -> Optional[str]:
+        """Load the output written so far by an interrupted generation"""
+        file_path = self.state.get("partial_stages", {}).get(stage)
+        if file_path and Path(file_path).exists():
+            with open(file_path, 'r') as f:
+                return f.read()
+        return None
+
+    def _discard_partial(self, stage: str):
+        file_path = self.state.get("partial_stages", {}).pop(stage, None)
+        if file_path:
+            Path(file_path).unlink(missing_ok=True)
+
+    def record_stage_metadata(self, stage: str, **metadata):
+        """Record information about a stage run (prompt size, timings...) in the state"""
+        self.state.setdefault("stage_metadata", {}).setdefault(stage, {}).update(metadata)
+        self._save_state()
+
+    def get_stage_metadata(self, stage: str) -> Dict[str, Any]:
+        return self.state.get("stage_metadata", {}).get(stage, {})
+
+    def _record_run(self, stage: str, **times):
+        """Record the run that produced a stage, and when"""
+        run = self.state.setdefault("stage_runs", {}).setdefault(stage, {})
+        if run.get("run_id") != self.run_id:
+            run.clear()
+        run.update(run_id=self.run_id, **times)
+
     def is_stage_completed(self, stage: str) -> bool:
         """Check if a stage has been completed"""
         return stage in self.state.get("completed_stages", [])
 
+    def is_stage_current(self, stage: str, fingerprint: str) -> bool:
+        """
+        Check if a stage has been completed from the inputs identified by fingerprint.
+
+        Files registered with use_existing_file are always current. Stages completed before fingerprints were
+        recorded adopt the given fingerprint.
+        """
+        if not self.is_stage_completed(stage) or self.get_stage_output(stage) is None:
+            return False
+        fingerprints = self.state.setdefault("fingerprints", {})
+        if stage not in fingerprints:
+            fingerprints[stage] = fingerprint
+            self._save_state()
+        return fingerprints[stage] in (fingerprint, self.OVERRIDE_FINGERPRINT)
+
+    def begin_stage(self, stage: str, fingerprint: Optional[str] = None):
+        """Record the fingerprint of a stage about to run, discarding a partial output generated from other inputs"""
+        running = self.state.setdefault("running_fingerprints", {})
+        if running.get(stage) != fingerprint:
+            self._discard_partial(stage)
+        running[stage] = fingerprint
+        self._record_run(stage, started_at=datetime.now().isoformat())
+        self._save_state()
+
     def get_stage_output(self, stage: str) -> Optional[str]:
         """Load output from a completed stage"""
         if stage in self.state.get("stage_files", {}):
@@ -65,8 +167,9 @@ class PipelineManager:
                     return f.read()
         return None
 
-    def save_stage_output(self, stage: str, content: str, file_path: Optional[Path] = None):
-        """Save output for a stage and mark it as completed"""
+    def save_stage_output(self, stage: str, content: str, file_path: Optional[Path] = None,
+                          fingerprint: Optional[str] = None):
+        """Save output for a stage and mark it as completed, recording the fingerprint of its inputs"""
         if file_path is None:
             file_path = self.get_stage_file(stage)
 
@@ -78,6 +181,13 @@ class PipelineManager:
         if stage not in self.state["completed_stages"]:
             self.state["completed_stages"].append(stage)
         self.state["stage_files"][stage] = str(file_path)
+        self._discard_partial(stage)
+        self.state.get("running_fingerprints", {}).pop(stage, None)
+        if fingerprint is not None:
+            self.state.setdefault("fingerprints", {})[stage] = fingerprint
+        else:
+            self.state.get("fingerprints", {}).pop(stage, None)
+        self._record_run(stage, completed_at=datetime.now().isoformat())
         self._save_state()
 
         return file_path
@@ -91,6 +201,8 @@ class PipelineManager:
         if stage not in self.state["completed_stages"]:
             self.state["completed_stages"].append(stage)
         self.state["stage_files"][stage] = str(file_path)
+        self.state.setdefault("fingerprints", {})[stage] = self.OVERRIDE_FINGERPRINT
+        self._record_run(stage, completed_at=datetime.now().isoformat())
         self._save_state()
 
         return True
@@ -103,24 +215,38 @@ class PipelineManager:
                 return stage
         return None
 
+    def get_downstream_stages(self, stage: str) -> list[str]:
+        """Get a stage and every stage that depends on it, directly or not"""
+        downstream = {stage}
+        for s in self.STAGES:
+            if any(dep in downstream for dep in self.STAGE_INPUTS[s]):
+                downstream.add(s)
+        return [s for s in self.STAGES if s in downstream]
+
     def reset_from_stage(self, stage: str):
-        """Reset pipeline from a specific stage onwards"""
-        try:
-            stage_index = self.STAGES.index(stage)
-            stages_to_remove = self.STAGES[stage_index:]
+        """Reset a specific stage and every stage downstream of it"""
+        if stage not in self.STAGE_INPUTS:
+            print(f"Unknown stage: {stage}")
+            return
 
-            for s in stages_to_remove:
-                if s in self.state["completed_stages"]:
-                    self.state["completed_stages"].remove(s)
-                if s in self.state["stage_files"]:
-                    del self.state["stage_files"][s]
+        for s in self.get_downstream_stages(stage):
+            if s in self.state["completed_stages"]:
+                self.state["completed_stages"].remove(s)
+            if s in self.state["stage_files"]:
+                del self.state["stage_files"][s]
+            self._discard_partial(s)
+            self.state.get("stage_metadata", {}).pop(s, None)
+            self.state.get("fingerprints", {}).pop(s, None)
+            self.state.get("running_fingerprints", {}).pop(s, None)
+            self.state.get("stage_runs", {}).pop(s, None)
 
-            self._save_state()
-        except ValueError:
-            print(f"Unknown stage: {stage}")
+        self._save_state()
 
     def clear_all(self):
         """Clear all pipeline state"""
+        for stage in list(self.state.get("partial_stages", {})):
+            self._discard_partial(stage)
+        previous = self.state
         self.state = {
             "lesson_num": self.lesson_num,
             "module_num": self.module_num,
@@ -129,4 +255,26 @@ class PipelineManager:
             "completed_stages": [],
             "stage_files": {}
         }
-        self._save_state()
\ No newline at end of file
+        # The version the state was loaded at (SQLite store), which the save checks
+        if "version" in previous:
+            self.state["version"] = previous["version"]
+        self._save_state()
+
+
+def import_json_states(store: SQLiteStateStore, output_root: Path) -> int:
+    """Copy into store the lesson state files found under output_root that are newer than its records"""
+    imported = 0
+    for state_file in sorted(Path(output_root).glob("**/intermediate/lesson_*_state.json")):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        output_dir = state_file.parent.parent
+        current = store.load(output_dir, state["module_num"], state["lesson_num"])
+        if current is not None and current.get("last_updated", "") >= state.get("last_updated", ""):
+            continue
+        completed = set(state.get("completed_stages", []))
+        next_stage = next((stage for stage in PipelineManager.STAGES if stage not in completed), None)
+        # Replaces the older record of the lesson, if any
+        state["version"] = current.get("version") if current is not None else None
+        store.save(output_dir, state, next_stage)
+        imported += 1
+    return imported
@@ -0,0 +1,73 @@
+# src/prompt_registry.py
+import math
+from functools import lru_cache
+from pathlib import Path
+from string import Formatter
+from typing import Optional, Dict
+
+from config.definitions import ROOT_DIR
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text (about 4 characters per token for the models in use)"""
+    return math.ceil(len(text) / 4)
+
+
+def shared_reference(title: str) -> str:
+    """Text that replaces a value the agent already received in its shared context"""
+    return f'[See "{title}" in the shared context at the beginning of the conversation]'
+
+
+class PromptRegistry:
+    """
+    Loads and validates every prompt template once, and renders them.
+
+    Templates are named after their file without the .md suffix (e.g. "summary.teacher.sl"). Values that an agent
+    already holds in its shared context (see Agent.shared_context) can be passed through `shared`: they are replaced by
+    a short reference instead of being copied in the prompt again.
+    """
+
+    def __init__(self, prompts_dir: Optional[Path] = None):
+        if prompts_dir is None:
+            prompts_dir = Path(ROOT_DIR) / "src/prompts"
+        self.prompts_dir = Path(prompts_dir)
+        self.templates: Dict[str, str] = {}
+        self.fields: Dict[str, set[str]] = {}
+        for path in sorted(self.prompts_dir.glob("*.md")):
+            name = path.name.removesuffix(".md")
+            with open(path, 'r') as f:
+                self.templates[name] = f.read()
+            try:
+                self.fields[name] = {field for _, field, _, _ in Formatter().parse(self.templates[name]) if field}
+            except ValueError as e:
+                raise ValueError(f"Malformed prompt template {path}: {e}") from e
+
+    def render(self, name: str, shared: Optional[Dict[str, str]] = None, **kwargs) -> str:
+        """
+        Render a template.
+
+        Args:
+            name: Template name
+            shared: Dict mapping field names to the title under which the target agent already received their value
+            kwargs: Template values
+        """
+        if name not in self.templates:
+            raise KeyError(f"Unknown prompt template: {name}")
+        values = dict(kwargs)
+        for field, title in (shared or {}).items():
+            if field in self.fields[name]:
+                values[field] = shared_reference(title)
+        missing = self.fields[name] - values.keys()
+        if missing:
+            raise KeyError(f"Prompt template '{name}' is missing values for: {', '.join(sorted(missing))}")
+        return self.templates[name].format(**values)
+
+    def describe(self) -> list[tuple[str, int, list[str]]]:
+        """(name, template tokens, placeholders) of every template"""
+        return [(name, estimate_tokens(text), sorted(self.fields[name])) for name, text in self.templates.items()]
+
+
+@lru_cache(maxsize=None)
+def get_prompt_registry() -> PromptRegistry:
+    """Process-wide registry, loaded on first use"""
+    return PromptRegistry()
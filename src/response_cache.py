@@ -0,0 +1,102 @@
+# src/response_cache.py
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+
+class ResponseCache:
+    """
+    On-disk cache of LLM replies.
+
+    Each reply is stored in its own JSON file named after the SHA-256 of the request key, so concurrent workers never
+    rewrite a shared file. Entries older than max_age are ignored, and the least recently used ones are evicted once
+    the cache grows past max_entries or max_bytes. Eviction scans the whole cache, so it runs every evict_every puts
+    (the cache can exceed its limits by that many entries in between).
+    """
+
+    def __init__(self, cache_dir: Path, max_entries: int = 2000, max_bytes: int = 200 * 1024 * 1024,
+                 max_age: timedelta = timedelta(days=30), evict_every: int = 50):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self._puts = 0
+        self._puts_lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(request: Dict[str, Any]) -> str:
+        """Hash a request description (provider, model, instructions, messages, attachments...)"""
+        canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _entry_file(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached reply for key, or None"""
+        entry_file = self._entry_file(key)
+        try:
+            with open(entry_file, 'r') as f:
+                entry = json.load(f)
+            if time.time() - entry.get("created_at", 0) > self.max_age.total_seconds():
+                entry_file.unlink(missing_ok=True)
+                return None
+            # Record the access for the LRU eviction (the age is the one stored in the entry)
+            os.utime(entry_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry["text"]
+
+    def put(self, key: str, text: str, request: Optional[Dict[str, Any]] = None):
+        """Store a reply atomically, evicting old entries every evict_every puts"""
+        entry = {"created_at": time.time(), "text": text}
+        if request is not None:
+            entry["provider"] = request.get("provider")
+            entry["model"] = request.get("model")
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._entry_file(key))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        with self._puts_lock:
+            self._puts += 1
+            due = self._puts % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Remove long unused entries, then the least recently used ones until the size limits are met"""
+        now = time.time()
+        entries = []
+        for entry_file in self.cache_dir.glob("*.json"):
+            try:
+                stat = entry_file.stat()
+            except FileNotFoundError:
+                continue
+            # The mtime is the last access, never earlier than the creation: an entry unused for max_age has expired
+            if now - stat.st_mtime > self.max_age.total_seconds():
+                entry_file.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry_file))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            _, size, entry_file = entries.pop(0)
+            entry_file.unlink(missing_ok=True)
+            total_bytes -= size
+
+    def clear(self):
+        for entry_file in self.cache_dir.glob("*.json"):
+            entry_file.unlink(missing_ok=True)
@@ -0,0 +1,61 @@
+# src/review_report.py
+from typing import Literal, Optional, Dict
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+SEVERITIES = ("critical", "major", "minor")
+
+
+class Issue(BaseModel):
+    """A problem the reviewer or the editor found in a draft"""
+    model_config = ConfigDict(extra="forbid")
+    severity: Literal["critical", "major", "minor"] = Field(
+        description="critical: wrong or missing required content; major: a gap or a structural problem worth a "
+                    "revision; minor: a local improvement (wording, an example, formatting)")
+    location: str = Field(description="Section heading, or a short quote, locating the problem in the draft")
+    problem: str = Field(description="What is wrong")
+    fix: str = Field(description="How the teacher should fix it")
+
+
+class ReviewReport(BaseModel):
+    """Structured reply of the reviewer and the editor; no issues means the draft can be kept as it is"""
+    model_config = ConfigDict(extra="forbid")
+    assessment: str = Field(description="Overall assessment of the draft, in one or two sentences")
+    issues: list[Issue] = Field(description="Issues worth fixing, empty if the draft is fine as it is")
+
+
+def parse_report(reply: str) -> Optional[ReviewReport]:
+    """The report of a structured reply, or None when the reply does not follow the schema"""
+    try:
+        return ReviewReport.model_validate_json(reply)
+    except ValidationError:
+        return None
+
+
+def issue_counts(report: ReviewReport) -> Dict[str, int]:
+    return {severity: sum(1 for issue in report.issues if issue.severity == severity) for severity in SEVERITIES}
+
+
+def render_report(report: ReviewReport) -> str:
+    """Markdown version of a report, for the stage output files and the teacher prompts"""
+    lines = [report.assessment.strip()]
+    if not report.issues:
+        lines.append("\nNo issues to fix.")
+    for severity in SEVERITIES:
+        issues = [issue for issue in report.issues if issue.severity == severity]
+        if issues:
+            lines.append(f"\n## {severity.capitalize()} issues")
+            lines += [f"- **{issue.location}**: {issue.problem}\n  Fix: {issue.fix}" for issue in issues]
+    return "\n".join(lines) + "\n"
+
+
+def revision_plan(counts: Optional[Dict[str, int]]) -> str:
+    """
+    How the teacher revises a draft after its report: "skip" (keep the draft) without issues, "patch" (edits to the
+    draft) with only minor ones, "rewrite" otherwise, or when the issues are unknown (e.g. a free-form review)
+    """
+    if counts is None:
+        return "rewrite"
+    if not any(counts.values()):
+        return "skip"
+    return "patch" if not counts["critical"] and not counts["major"] else "rewrite"
@@ -0,0 +1,114 @@
+# src/scheduler.py
+import asyncio
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, Union, Dict
+
+from rich.console import Console
+from rich.markdown import Markdown
+
+from src.call_policy import track_stage
+from src.pipeline_manager import PipelineManager
+
+
+class Stage:
+    """
+    How to run a pipeline stage.
+
+    run receives the outputs of the completed stages (stage name -> text) and returns the stage output. The inputs of
+    the stage are declared in the pipeline graph (PipelineManager.STAGE_INPUTS). output_file is the path where the
+    output is saved, or a callable returning it; by default the pipeline intermediate file is used.
+
+    fingerprint receives the same outputs and returns a JSON-serializable description of everything else the stage
+    output depends on (model, system prompt, rendered prompt, material hashes...). Together with the hashes of the
+    input stage outputs, it decides whether a completed stage is still current.
+    """
+
+    def __init__(self, name: str, run: Callable[[Dict[str, str]], Awaitable[str]], title: Optional[str] = None,
+                 output_file: Union[Path, Callable[[], Path], None] = None,
+                 fingerprint: Optional[Callable[[Dict[str, str]], Any]] = None):
+        self.name = name
+        self.run = run
+        self.title = title or name
+        self.output_file = output_file
+        self.fingerprint = fingerprint
+
+
+class StageScheduler:
+    """Runs the stages of a pipeline graph, starting every stage as soon as all its inputs are available"""
+
+    def __init__(self, pipeline: PipelineManager, stages: list[Stage], console: Optional[Console] = None):
+        self.pipeline = pipeline
+        self.stages = {stage.name: stage for stage in stages}
+        self.console = console or Console()
+        unknown = set(self.stages) - set(pipeline.STAGE_INPUTS)
+        if unknown:
+            raise ValueError(f"Stages not declared in the pipeline graph: {', '.join(sorted(unknown))}")
+
+    def _step(self, name: str) -> str:
+        return f"Step {self.pipeline.STAGES.index(name) + 1}: {self.stages[name].title}"
+
+    def fingerprint(self, stage: Stage, outputs: Dict[str, str]) -> str:
+        """Hash of everything that went into a stage: its own configuration and the outputs of its input stages"""
+        inputs = {dep: hashlib.sha256(outputs[dep].encode("utf-8")).hexdigest()
+                  for dep in self.pipeline.STAGE_INPUTS[stage.name]}
+        data = {"stage": stage.name, "inputs": inputs, "config": stage.fingerprint(outputs) if stage.fingerprint else None}
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def _run_stage(self, stage: Stage, outputs: Dict[str, str], fingerprint: str) -> str:
+        self.console.print(Markdown(f"## {self._step(stage.name)}"))
+        self.pipeline.begin_stage(stage.name, fingerprint)
+        start = time.monotonic()
+        with track_stage(stage.name) as call_stats:
+            try:
+                output = await stage.run(outputs)
+            finally:
+                self.pipeline.record_stage_metadata(stage.name, duration_s=round(time.monotonic() - start, 3),
+                                                    **call_stats.as_dict())
+        if call_stats.retries or call_stats.hedges:
+            self.console.print(f"{stage.name}: {call_stats.retries} retries, {call_stats.hedges} hedged requests "
+                               f"({call_stats.hedge_wins} won by the hedge)")
+        output_file = stage.output_file() if callable(stage.output_file) else stage.output_file
+        saved_path = self.pipeline.save_stage_output(stage.name, output, output_file, fingerprint)
+        self.console.print(f"✓ {stage.name} saved to: {saved_path}")
+        return output
+
+    async def run(self) -> Dict[str, str]:
+        """
+        Run the stages concurrently, following the graph. Returns the outputs of all the stages.
+
+        A completed stage is reused only if its fingerprint did not change; otherwise it is recomputed, and so is every
+        stage downstream of it whose inputs change as a result.
+        """
+        outputs = {}
+        pending = [name for name in self.pipeline.STAGES if name in self.stages]
+        running = {}
+        try:
+            while pending or running:
+                ready = [name for name in pending if all(dep in outputs for dep in self.pipeline.STAGE_INPUTS[name])]
+                for name in ready:
+                    pending.remove(name)
+                    fingerprint = self.fingerprint(self.stages[name], outputs)
+                    if self.pipeline.is_stage_current(name, fingerprint):
+                        self.console.print(Markdown(f"## {self._step(name)} ✓ already completed (skipping)"))
+                        outputs[name] = self.pipeline.get_stage_output(name)
+                        continue
+                    if self.pipeline.is_stage_completed(name):
+                        self.console.print(f"↻ '{name}' inputs changed since it was generated, recomputing")
+                    running[asyncio.create_task(self._run_stage(self.stages[name], dict(outputs), fingerprint))] = name
+                if any(all(dep in outputs for dep in self.pipeline.STAGE_INPUTS[name]) for name in pending):
+                    # Skipped stages made more stages ready
+                    continue
+                if not running:
+                    if pending:
+                        raise RuntimeError(f"Stages with unsatisfiable inputs: {', '.join(pending)}")
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outputs[running.pop(task)] = task.result()
+        finally:
+            for task in running:
+                task.cancel()
+        return outputs
@@ -0,0 +1,195 @@
+# src/state_store.py
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Optional, Dict
+
+
+class StateConflictError(RuntimeError):
+    """The state of a lesson was saved by someone else (e.g. a reset from the CLI) since it was loaded"""
+
+
+class SQLiteStateStore:
+    """
+    Pipeline states of every lesson in a single SQLite database, an alternative to one JSON state file per lesson.
+
+    Each save replaces the state of a lesson and its per-stage rows in one transaction, and the database runs in WAL
+    mode, so several workers (and readers such as the web app) can share it. Lessons are identified by their pipeline
+    folder, module and lesson number. The whole state is kept as JSON; the lessons and stages tables index what the
+    queries need (next stage, stage status, fingerprints, run IDs, timestamps).
+
+    Every save increments the version of the lesson, kept in state["version"]: a save from a state loaded before
+    another save of the lesson raises StateConflictError instead of overwriting it. The database and its tables are
+    created by the first write; reading a store that does not exist yet finds no lessons.
+    """
+
+    # Database files whose tables have been set up by this process, so that it is done once per file
+    _initialized: set = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, db_file: Path):
+        self.db_file = Path(db_file)
+
+    def _init(self):
+        """Create the database and its tables, unless done already by this process"""
+        key = self.db_file.resolve()
+        with self._init_lock:
+            if key in self._initialized:
+                return
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.db_file, timeout=30)
+            try:
+                # WAL lets readers work while a worker writes; it is a property of the database file, kept once set
+                db.execute("PRAGMA journal_mode=WAL")
+            finally:
+                db.close()
+            self._create_tables()
+            self._initialized.add(key)
+
+    def _create_tables(self):
+        with self._transaction(write=True) as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS lessons (
+                    output_dir TEXT NOT NULL,
+                    module_num INTEGER NOT NULL,
+                    lesson_num INTEGER NOT NULL,
+                    next_stage TEXT,
+                    created_at TEXT,
+                    last_updated TEXT,
+                    state TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (output_dir, module_num, lesson_num)
+                )""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS stages (
+                    output_dir TEXT NOT NULL,
+                    module_num INTEGER NOT NULL,
+                    lesson_num INTEGER NOT NULL,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    output_file TEXT,
+                    partial_file TEXT,
+                    fingerprint TEXT,
+                    running_fingerprint TEXT,
+                    run_id TEXT,
+                    started_at TEXT,
+                    completed_at TEXT,
+                    metadata TEXT,
+                    PRIMARY KEY (output_dir, module_num, lesson_num, stage)
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS lessons_next_stage ON lessons (module_num, next_stage)")
+            db.execute("CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status, module_num)")
+            # Databases created before the lessons had a version
+            if "version" not in [row["name"] for row in db.execute("PRAGMA table_info(lessons)")]:
+                db.execute("ALTER TABLE lessons ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    @contextmanager
+    def _connect(self, write: bool = True):
+        """
+        Connection running one transaction, committed on exit, or None for a read of a database not created yet. A
+        write transaction takes the write lock from the start; a read transaction only reads a snapshot, without
+        waiting for the writers or blocking them
+        """
+        if write:
+            self._init()
+        elif not self.db_file.exists():
+            yield None
+            return
+        with self._transaction(write) as db:
+            yield db
+
+    @contextmanager
+    def _transaction(self, write: bool):
+        db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            if write:
+                db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _key(output_dir: Path, module_num: int, lesson_num: int) -> tuple:
+        return str(Path(output_dir).resolve()), module_num, lesson_num
+
+    def load(self, output_dir: Path, module_num: int, lesson_num: int) -> Optional[Dict[str, Any]]:
+        with self._connect(write=False) as db:
+            if db is None:
+                return None
+            row = db.execute("SELECT * FROM lessons WHERE output_dir = ? AND module_num = ? AND lesson_num = ?",
+                             self._key(output_dir, module_num, lesson_num)).fetchone()
+        if row is None:
+            return None
+        # A database not written to since lessons have a version has them at 0
+        return {**json.loads(row["state"]), "version": dict(row).get("version", 0)}
+
+    def save(self, output_dir: Path, state: Dict[str, Any], next_stage: Optional[str]):
+        """
+        Replace the state of a lesson, and the rows of its stages, in one transaction. state["version"] must be the
+        version it was loaded at (none for a new lesson); it is set to the new version
+        """
+        key = self._key(output_dir, state["module_num"], state["lesson_num"])
+        completed = state.get("completed_stages", [])
+        running = state.get("running_fingerprints", {})
+        stage_names = list(dict.fromkeys([*completed, *running, *state.get("partial_stages", {}),
+                                          *state.get("stage_metadata", {}), *state.get("stage_runs", {})]))
+        rows = []
+        for stage in stage_names:
+            status = "completed" if stage in completed else "running" if stage in running else "pending"
+            run = state.get("stage_runs", {}).get(stage, {})
+            rows.append((*key, stage, status, state.get("stage_files", {}).get(stage),
+                         state.get("partial_stages", {}).get(stage), state.get("fingerprints", {}).get(stage),
+                         running.get(stage), run.get("run_id"), run.get("started_at"), run.get("completed_at"),
+                         json.dumps(state.get("stage_metadata", {}).get(stage, {}))))
+        with self._connect() as db:
+            row = db.execute("SELECT version FROM lessons WHERE output_dir = ? AND module_num = ? AND lesson_num = ?",
+                             key).fetchone()
+            version = row["version"] if row else None
+            if version != state.get("version"):
+                raise StateConflictError(f"The state of module {key[1]}, lesson {key[2]} was saved by another process "
+                                         f"(version {version}, loaded at {state.get('version')})")
+            version = (version or 0) + 1
+            db.execute("INSERT OR REPLACE INTO lessons (output_dir, module_num, lesson_num, next_stage, created_at, "
+                       "last_updated, state, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (*key, next_stage, state.get("created_at"), state.get("last_updated"),
+                        json.dumps({**state, "version": version}), version))
+            db.execute("DELETE FROM stages WHERE output_dir = ? AND module_num = ? AND lesson_num = ?", key)
+            db.executemany("INSERT INTO stages (output_dir, module_num, lesson_num, stage, status, output_file, "
+                           "partial_file, fingerprint, running_fingerprint, run_id, started_at, completed_at, "
+                           "metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        state["version"] = version
+
+    def _select(self, table: str, filters: Dict[str, Any], order: str) -> list[Dict[str, Any]]:
+        filters = {column: value for column, value in filters.items() if value is not None}
+        where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+        with self._connect(write=False) as db:
+            if db is None:
+                return []
+            return [dict(row) for row in db.execute(f"SELECT * FROM {table} WHERE {where} ORDER BY {order}",
+                                                    tuple(filters.values()))]
+
+    def lessons(self, module_num: Optional[int] = None, next_stage: Optional[str] = None) -> list[Dict[str, Any]]:
+        """Lessons (without their full state), e.g. those of module 7 whose next stage is review"""
+        rows = self._select("lessons", {"module_num": module_num, "next_stage": next_stage},
+                            "module_num, lesson_num, output_dir")
+        for row in rows:
+            del row["state"]
+        return rows
+
+    def stages(self, module_num: Optional[int] = None, lesson_num: Optional[int] = None, stage: Optional[str] = None,
+               status: Optional[str] = None) -> list[Dict[str, Any]]:
+        """Stage rows, e.g. every running summary stage across modules"""
+        rows = self._select("stages", {"module_num": module_num, "lesson_num": lesson_num, "stage": stage,
+                                       "status": status}, "module_num, lesson_num, output_dir")
+        for row in rows:
+            row["metadata"] = json.loads(row["metadata"]) if row["metadata"] else {}
+        return rows
@@ -0,0 +1,92 @@
+# src/telemetry.py
+import json
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Optional, Dict
+
+# USD per million tokens: (input, cached input, output). Update when the providers change their prices
+PRICES = {
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-2.5-pro": (1.25, 0.31, 10.00),
+    "gemini-2.5-flash-lite": (0.10, 0.025, 0.40),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "claude-sonnet-4-0": (3.00, 0.30, 15.00),
+    "claude-3-5-haiku-latest": (0.80, 0.08, 4.00),
+}
+# Batch jobs (OpenAI Batch API, Gemini batch mode) are billed at this fraction of the prices above
+BATCH_PRICE_FACTOR = 0.5
+
+
+def estimate_cost(model: str, input_tokens: Optional[int], output_tokens: Optional[int],
+                  cached_tokens: Optional[int] = None) -> Optional[float]:
+    """Cost of a call in USD, or None for unknown models. input_tokens includes the cached ones"""
+    prices = PRICES.get(model)
+    if prices is None or input_tokens is None or output_tokens is None:
+        return None
+    cached_tokens = cached_tokens or 0
+    input_price, cached_price, output_price = prices
+    return ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + output_tokens * output_price) / 1e6
+
+
+class Telemetry:
+    """
+    Records one JSON line per agent call (stage, latency, tokens, cost, retries...) in a trace file.
+
+    With a wandb run, every record is also logged to it. Records are written as soon as the call ends, so the trace of
+    an interrupted run is still complete up to that point.
+    """
+
+    def __init__(self, trace_file: Path, wandb_run: Any = None, **context):
+        self.trace_file = Path(trace_file)
+        self.wandb_run = wandb_run
+        # Fields added to every record (e.g. module and lesson numbers)
+        self.context = context
+        self.lock = threading.Lock()
+        self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+
+    def record(self, **fields):
+        record = {"timestamp": time.time(), **self.context, **fields}
+        if record.get("cost_usd") is None and not record.get("response_cache_hit"):
+            record["cost_usd"] = estimate_cost(record.get("model"), record.get("input_tokens"),
+                                               record.get("output_tokens"), record.get("cached_tokens"))
+            if record["cost_usd"] is not None and record.get("batched"):
+                record["cost_usd"] *= BATCH_PRICE_FACTOR
+        with self.lock:
+            with open(self.trace_file, 'a') as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        if self.wandb_run is not None:
+            self.wandb_run.log({key: value for key, value in record.items() if isinstance(value, (int, float, str))})
+
+
+def read_trace(trace_file: Path) -> list[Dict[str, Any]]:
+    """Records of a trace file, skipping a truncated last line"""
+    records = []
+    try:
+        with open(trace_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def summarize_trace(records: list[Dict[str, Any]], key: str = "stage") -> Dict[str, Dict[str, float]]:
+    """Totals of the records grouped by a field (stage, provider, model...)"""
+    totals = defaultdict(lambda: defaultdict(float))
+    for record in records:
+        group = totals[record.get(key) or "-"]
+        group["calls"] += 1
+        group["response_cache_hits"] += bool(record.get("response_cache_hit"))
+        for field in ("wall_s", "input_tokens", "output_tokens", "cached_tokens", "cost_usd", "retries", "hedges"):
+            group[field] += record.get(field) or 0
+    return {name: dict(group) for name, group in totals.items()}
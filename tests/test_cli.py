@@ -0,0 +1,56 @@
+import pytest
+
+import main
+import src.agents
+import src.materials_index
+from src import cli
+
+
+class Stop(Exception):
+    """Raised by the teacher as soon as it is asked for the materials, before any provider call"""
+
+
+@pytest.fixture
+def teachers(tmp_path, monkeypatch):
+    """Teachers built by the run command, which stops at the upload of the materials"""
+    built = []
+
+    class RecordingGeminiAgent(src.agents.GeminiAgent):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            built.append(self)
+
+        def load_pdfs(self, *args, **kwargs):
+            raise Stop()
+
+    for module in (main, src.agents, src.materials_index):
+        monkeypatch.setattr(module, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(src.agents, "GeminiAgent", RecordingGeminiAgent)
+    return built
+
+
+def run(tmp_path, *options):
+    materials = tmp_path / "Lez 001 materials"
+    materials.mkdir()
+    (materials / "topics.txt").write_text("Topic\n")
+    with pytest.raises(Stop):
+        cli.main(["run", "1", "1", "--input-folder", str(materials),
+                  "--output-folder", str(tmp_path / "output"), *options])
+
+
+def test_stateless_teacher_sends_no_history(tmp_path, teachers):
+    run(tmp_path, "--stateless")
+    [teacher] = teachers
+    assert teacher.manage_history is False
+    teacher.remember("first prompt", "first reply")
+    assert teacher.history == []
+    assert teacher._prepare_messages("second prompt") == [{"role": "user", "content": "second prompt"}]
+
+
+def test_teacher_keeps_history_by_default(tmp_path, teachers):
+    run(tmp_path)
+    [teacher] = teachers
+    assert teacher.manage_history is True
+    teacher.remember("first prompt", "first reply")
+    assert [message["content"] for message in teacher._prepare_messages("second prompt")] == \
+           ["first prompt", "first reply", "second prompt"]